@@ -0,0 +1,239 @@
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import tempfile
+import threading
+import urllib
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from datetime import datetime
+from requests.adapters import HTTPAdapter
+import reddit_watcher
+from reddit_watcher import *
+
+# offline benchmarks that replay recorded reddit and pushbullet responses
+# from bench_fixtures through a local http server. Run with --save-baseline
+# once, later runs fail if a benchmark got slower than the baseline by more
+# than the threshold.
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_fixtures')
+BASELINE = 'bench_baseline.json'
+THRESHOLD = 0.25 # a 25% slowdown is a regression
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+# answers every reddit GET with the recorded listing and every POST with the
+# recorded pushbullet push
+class FixtureServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FixtureHandler)
+        self.listing = load_fixture('search_new.json')
+        self.push = load_fixture('pushbullet_push.json')
+        self.thread = threading.Thread(target = self.serve_forever, daemon = True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, like the real apis
+    disable_nagle_algorithm = True # or small replies wait on delayed acks
+
+    def do_GET(self):
+        self._reply(self.server.listing)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._reply(self.server.push)
+
+    def _reply(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+# sends every request to the fixture server instead of the real host
+class RedirectAdapter(HTTPAdapter):
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        parts = urllib.parse.urlsplit(request.url)
+        request.url = self.base_url + urllib.parse.urlunsplit(('', '', parts.path, parts.query, ''))
+        return super().send(request, **kwargs)
+
+# points the shared pool, limiter and cache at the fixture server
+def install_fixture_transport(server):
+    pool = HTTPPool()
+    pool.mount(RedirectAdapter(server.url, pool_maxsize = HTTP_POOL_MAXSIZE))
+    set_default_http_pool(pool)
+    set_default_rate_limiter(RateLimiter(per_minute = 10 ** 9, burst = 10 ** 6))
+    set_default_response_cache(ResponseCache(ttl = 0))
+
+# runs 'func' 'repeat' times, returns the fastest run time in seconds. The
+# fastest run is the one least disturbed by the rest of the machine, and
+# fast functions are looped for at least MIN_SAMPLE seconds per run, so that
+# noise does not read as a regression.
+MIN_SAMPLE = 0.05
+
+def timed(func, repeat, setup = None):
+    number = 1
+    if setup is None:
+        start = time.perf_counter()
+        func()
+        number = max(1, int(MIN_SAMPLE / max(time.perf_counter() - start, 1e-9)))
+
+    times = []
+    for _ in range(repeat):
+        if setup is not None: setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return min(times)
+
+def fixture_children():
+    return json.loads(load_fixture('search_new.json'))['data']['children']
+
+def bench_decode(repeat):
+    children = fixture_children() * 10 # 1000 posts
+    return {
+        'decode_1000_posts': timed(lambda: [RedditPost.decode(c) for c in children], repeat),
+        'decode_children_1000_posts': timed(lambda: RedditPost.decode_children(children), repeat)
+    }
+
+def bench_deals(repeat):
+    searches = [RedditWatchedSearch(uuid = uuid.uuid4(), title = 'Search {}'.format(i), \
+            query = 'q{}'.format(i), user_agent_base = 's{}'.format(i), \
+            last_run_utc = datetime.utcfromtimestamp(0)) for i in range(10)]
+    posted = datetime.utcfromtimestamp(1700000000)
+    results = {}
+    for n in (10, 100, 1000, 10000, 100000):
+        # every post is hit by two overlapping searches
+        deals = [RedditDeal(searches[i % 10], RedditPost('Deal {}'.format(i // 2), \
+                'https://www.example.com/{}'.format(i // 2), posted, 't3_{}'.format(i // 2))) \
+                for i in range(n)]
+        def add_all():
+            collected = Deals()
+            for d in deals:
+                collected.add(d)
+        results['deals_add_{}'.format(n)] = timed(add_all, repeat)
+    return results
+
+# binds the models to a fresh database file, with 'n_searches' searches
+def fresh_database(path, n_searches):
+    if os.path.exists(path): os.remove(path)
+    reddit_watcher.db.init(path, pragmas = DATABASE_PRAGMAS)
+    create_tables()
+    with reddit_watcher.db:
+        for i in range(n_searches):
+            RedditWatchedSearch.create(uuid = uuid.uuid4(), title = 'Search {}'.format(i), \
+                    query = 'subreddit:buildapcsales search{}'.format(i), \
+                    user_agent_base = 'search{}'.format(i), \
+                    last_run_utc = datetime.utcfromtimestamp(0), urgent = i % 2 == 0)
+
+def bench_push_fanout(server, repeat, tmpdir):
+    path = os.path.join(tmpdir, 'push.db')
+    pushes = [RedditPost('Deal {}'.format(i), 'https://www.example.com/{}'.format(i), \
+            datetime.utcfromtimestamp(1700000000)) for i in range(200)]
+    pb = PushbulletAccount('bench')
+
+    def setup():
+        fresh_database(path, 0)
+        install_fixture_transport(server)
+        PushDelivery(pb, print_pushes = False).enqueue(pushes)
+
+    return {'push_fanout_200': timed(lambda: PushDelivery(pb, print_pushes = False).flush(), repeat, setup)}
+
+def bench_main_cycle(server, repeat, tmpdir):
+    path = os.path.join(tmpdir, 'cycle.db')
+    stdout = sys.stdout
+
+    def setup():
+        fresh_database(path, 50)
+        install_fixture_transport(server)
+
+    def cycle():
+        # main() prints every push, which is not what is being measured
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            main([])
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    return {'main_cycle_50_searches': timed(cycle, repeat, setup)}
+
+def run_benchmarks(repeat):
+    results = {}
+    results.update(bench_decode(repeat))
+    results.update(bench_deals(repeat))
+    with FixtureServer() as server, tempfile.TemporaryDirectory() as tmpdir:
+        results.update(bench_push_fanout(server, repeat, tmpdir))
+        results.update(bench_main_cycle(server, repeat, tmpdir))
+    reddit_watcher.db.init(DATABASE, pragmas = DATABASE_PRAGMAS)
+    return results
+
+# returns the names of the benchmarks that are slower than the baseline by
+# more than 'threshold'
+def regressions(results, baseline, threshold = THRESHOLD):
+    slower = []
+    for name, seconds in results.items():
+        base = baseline.get(name)
+        if base is not None and seconds > base * (1 + threshold):
+            slower.append(name)
+    return slower
+
+def main_bench(argv = None):
+    parser = argparse.ArgumentParser(description = 'Run the offline reddit_watcher benchmarks.')
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--baseline', default = BASELINE)
+    parser.add_argument('--save-baseline', action = 'store_true')
+    parser.add_argument('--threshold', type = float, default = THRESHOLD)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.repeat)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    for name, seconds in results.items():
+        line = '{:<30} {:>10.3f} ms'.format(name, seconds * 1000)
+        if name in baseline:
+            line += ' ({:+.0%} vs baseline)'.format(seconds / baseline[name] - 1)
+        print(line)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent = 2, sort_keys = True)
+        print('Saved the baseline to ' + args.baseline)
+        return 0
+
+    slower = regressions(results, baseline, args.threshold)
+    if len(slower) > 0:
+        print('Regressions over {:.0%}: {}'.format(args.threshold, ', '.join(slower)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main_bench())
@@ -1,9 +1,29 @@
+import time
+_import_started = time.perf_counter()
+
 import secrets
+import sys
 import json
-import urllib
-import requests
-from datetime import datetime
+import urllib.parse
+import argparse
+import signal
+import threading
+import heapq
+import random
+import itertools
+import re
+import functools
+import bisect
+import hashlib
+import struct
+import os
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from peewee import *
+# requests, asyncio, concurrent.futures, http.server, multiprocessing and
+# playhouse are imported where they are used, so that a cron run with nothing
+# due never pays for them
 
 VERSION = 'v1.0.0'
 DATABASE = 'reddit_watcher.db'
@@ -12,36 +32,968 @@ USER_AGENT_END = 'reddit_watcher:' + VERSION
 
 PB_ACCESS_TOKEN = secrets.pb_access_token
 
-db = SqliteDatabase(DATABASE)
+# maximum number of searches that are fetched from reddit at the same time
+POLL_CONCURRENCY = 8
+
+# connection pool settings shared by every request to reddit and pushbullet
+HTTP_POOL_CONNECTIONS = 4 # number of hosts that keep a pool
+HTTP_POOL_MAXSIZE = POLL_CONCURRENCY # kept-alive connections per host
+HTTP_TIMEOUT = (3.05, 10) # (connect, read) seconds
+
+# the response headers a --record capture keeps, the ones the poller reads
+CAPTURE_HEADERS = ('content-type', 'retry-after', 'x-ratelimit-remaining', \
+        'x-ratelimit-reset', 'x-ratelimit-used')
+
+# how long a pushed post is remembered, and how many keys go in one query
+SEEN_POST_TTL = timedelta(days = 14)
+SQLITE_BATCH_SIZE = 500
+
+# per-search polling intervals in seconds, adapted to how often a search hits
+DEFAULT_POLL_INTERVAL = 300
+MIN_POLL_INTERVAL = 60
+MAX_POLL_INTERVAL = 3600
+POLL_BACKOFF = 1.5 # quiet searches wait this many times longer
+POLL_SPEEDUP = 0.5 # searches with hits wait this fraction as long
+# the share of REDDIT_REQUESTS_PER_MINUTE that scheduled polls may use, what
+# the searches outside their active hours leave of it goes to the searches
+# inside a cadence window
+POLL_BUDGET_SHARE = 0.8
+
+# every request to reddit shares this budget, the X-Ratelimit headers of the
+# responses can lower it further
+REDDIT_REQUESTS_PER_MINUTE = 60
+REDDIT_BURST = 10
+REDDIT_MAX_RETRIES = 3
+REDDIT_BACKOFF = 2.0 # seconds before the first retry, doubled after each one
+REDDIT_MAX_QUERY_LENGTH = 512 # reddit answers longer search queries with an error
+
+# parsed reddit responses are reused for this many seconds without asking
+# reddit, then revalidated with their ETag/Last-Modified
+RESPONSE_CACHE_TTL = 30
+RESPONSE_CACHE_SIZE = 256 # entries, the least recently used are evicted
+
+# pushes are queued in the outbox table and sent by this many workers, a
+# failed push is retried after PUSH_BACKOFF seconds, doubled per attempt
+PUSH_WORKERS = 4
+PUSH_BACKOFF = 30
+PUSH_MAX_BACKOFF = 3600
+
+# deals of searches that are not urgent are held for up to DIGEST_WINDOW
+# seconds, or until DIGEST_MAX_DEALS are held, and then pushed as one digest
+DIGEST_WINDOW = 300
+DIGEST_MAX_DEALS = 10
+
+# a new deal waits this many seconds for other searches that hit the same post
+# before it is queued, at most DEDUP_MAX_OPEN deals wait at once
+DEDUP_WINDOW = 10
+DEDUP_MAX_OPEN = 1000
+# searches that are done are saved in batches of this many, unless a batch of
+# deals is queued first
+STREAM_SAVE_BATCH = 100
+
+# posts whose title shingles are at least this similar (jaccard), or whose
+# urls are the same once tracking parameters are removed, are one deal. The
+# index of recent deals covers NEAR_DUP_WINDOW seconds of post times and at
+# most NEAR_DUP_MAX deals.
+NEAR_DUP_SIMILARITY = 0.7
+NEAR_DUP_WINDOW = 24 * 60 * 60
+NEAR_DUP_MAX = 5000
+# minhash signatures of MINHASH_BANDS * MINHASH_ROWS values, titles that agree
+# on all the rows of any one band are compared
+MINHASH_BANDS = 8
+MINHASH_ROWS = 4
+
+# archived deals are written once per cycle, or sooner once this many wait
+ARCHIVE_BATCH = 1000
+ARCHIVE_PAGE_SIZE = 50
+
+# points per shard on the consistent hash ring, more points spread the
+# searches more evenly
+SHARD_REPLICAS = 64
+
+# upper bounds in seconds of the latency histogram buckets, the last bucket
+# (+Inf) is implied
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# WAL lets readers (e.g. BaseModel.list) run while the poller writes
+DATABASE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal', # safe with WAL, fsyncs only at checkpoints
+    'cache_size': -8 * 1024, # in KiB, i.e. 8MB
+    'busy_timeout': 5000 # ms to wait on a lock before failing
+}
+
+db = SqliteDatabase(DATABASE, pragmas = DATABASE_PRAGMAS)
+
+def main(argv = None):
+    profile = StartupProfile()
+    args = parse_args(argv)
+    profile.enabled = args.profile_startup
+    profile.mark('parse args')
+
+    if args.history is not None or args.history_count:
+        with db:
+            print_history(args)
+        return
+    if args.import_searches is not None or args.export_searches is not None:
+        with db:
+            manage_searches(args)
+        return
+
+    if args.replay is not None:
+        replay(args)
+        return
+
+    # a cron run leaves without opening the database when the last run saved
+    # that nothing is due yet
+    if not args.daemon and not args.all and nothing_due(datetime.utcnow(), args.shard):
+        profile.mark('check next due')
+        profile.report()
+        return
+    profile.mark('check next due')
 
-def main():
     db.connect()
-    pb = PushbulletAccount(PB_ACCESS_TOKEN)
-
-    # Create an empty Deals object of the deals we will push so that we do not
-    # push multiples of overlapping search hits
-    deals_to_push = Deals()
-    for search in RedditWatchedSearch.select(): # iterate through all searches
-        curr_time = datetime.utcnow()
-        result_posts = search.result(print_search_url=False, print_json_result=False)
-
-        for post in result_posts:
-            if post.posted_utc < search.last_run_utc:
+    profile.mark('connect database')
+    if args.record is not None:
+        record(args.record)
+    sinks = [make_sink(spec, PB_ACCESS_TOKEN) for spec in args.sink or ['pushbullet']]
+    if args.local_match:
+        poller = LocalMatchPoller()
+    elif args.processes > 1:
+        poller = ShardedPoller(args.processes)
+    else:
+        poller = RedditPoller()
+    server = None
+    if args.metrics_file is not None or args.metrics_port is not None:
+        set_default_metrics(Metrics())
+    if args.metrics_port is not None:
+        server = default_metrics().serve(args.metrics_port)
+    if args.daemon:
+        profile.report()
+        PollDaemon(sinks, poller = poller, metrics_file = args.metrics_file, shard = args.shard).run()
+    else:
+        searches = cron_searches(args, poller)
+        profile.mark('load searches')
+        default_http_pool()
+        profile.mark('import requests')
+        profile.report()
+
+        delivery = PushDelivery(sinks)
+        # send whatever an earlier run left in the outbox first
+        delivery.flush()
+        poll_cycle(searches, sinks, poller = poller, delivery = delivery)
+        delivery.close()
+        if args.metrics_file is not None: default_metrics().dump_json(args.metrics_file)
+        next_due = [t for t in (next_due_utc(args.shard), delivery.next_attempt()) if t is not None]
+    if server is not None: server.shutdown()
+    poller.close()
+    db.close()
+    default_http_pool().close()
+    if not args.daemon:
+        # saved after closing, so that the database files are in their final state
+        save_next_due(min(next_due) if len(next_due) > 0 else None, args.shard)
+
+# sends the default pool's traffic through a RecordingTransport into 'directory'
+def record(directory):
+    capture = Capture(directory)
+    capture.save_database(db)
+    pool = default_http_pool()
+    pool.mount(RecordingTransport(pool.session.get_adapter('https://'), capture))
+
+# runs --replay: cycles over every search, as fast as they go, against a
+# copy of the recorded database, until a cycle serves no recorded response
+# that was not served before. The cycles run on the recorded clock, see
+# ReplayTransport.now(), and the digest that is open when the capture ends
+# is sent as it would have been once its window closed.
+def replay(args):
+    import shutil
+    import tempfile
+    capture = Capture(args.replay)
+    if not os.path.exists(capture.database_path):
+        sys.exit('{} has no recorded database'.format(args.replay))
+    transport = ReplayTransport(capture)
+    pool = HTTPPool()
+    pool.mount(transport)
+    previous_pool = set_default_http_pool(pool)
+    previous_limiter = set_default_rate_limiter(RateLimiter(per_minute = 1e9, burst = 1e6))
+    # every request should reach the capture, none should be answered by a cache
+    previous_cache = set_default_response_cache(ResponseCache())
+    database = db.database
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'replay.db')
+        shutil.copyfile(capture.database_path, path)
+        db.init(path, pragmas = DATABASE_PRAGMAS)
+        try:
+            with db:
+                sinks = [make_sink(spec, PB_ACCESS_TOKEN) for spec in args.sink or ['pushbullet']]
+                poller = LocalMatchPoller() if args.local_match else RedditPoller()
+                delivery = PushDelivery(sinks)
+                transport.advance()
+                delivery.flush(transport.now())
+                cycles = 0
+                while True:
+                    pending = transport.pending
+                    transport.advance()
+                    poll_cycle(RedditWatchedSearch.iter_due(None, due_only = False), sinks, \
+                            poller = poller, delivery = delivery, clock = transport.now)
+                    cycles += 1
+                    if transport.pending in (0, pending): break
+                delivery.flush(transport.now() + timedelta(seconds = delivery.digest_window))
+                delivery.close()
+                poller.close()
+                print('replayed {} cycles, {} of {} recorded responses served'.format(cycles, \
+                        len(capture.entries()) - transport.pending, len(capture.entries())), file = sys.stderr)
+        finally:
+            db.init(database, pragmas = DATABASE_PRAGMAS)
+            set_default_http_pool(previous_pool)
+            set_default_rate_limiter(previous_limiter)
+            set_default_response_cache(previous_cache)
+            pool.close()
+
+# the searches a cron run polls: the due ones of its shard, or every one of
+# its shard with --all. They are read lazily, in batches, as the cycle needs
+# them.
+def cron_searches(args, poller):
+    searches = RedditWatchedSearch.iter_due(datetime.utcnow(), due_only = not args.all)
+    if isinstance(poller, LocalMatchPoller):
+        searches = list(searches)
+        if not args.all and len(searches) > 0:
+            searches = poller.expand(searches, RedditWatchedSearch.select())
+    if args.shard is not None:
+        ring = HashRing(args.shard[1])
+        searches = (s for s in searches if ring.shard_of(s.uuid) == args.shard[0])
+    return searches
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description = 'Push new reddit posts that match the watched searches.')
+    parser.add_argument('--daemon', action = 'store_true',
+            help = 'keep running and poll each search on its own schedule')
+    parser.add_argument('--local-match', action = 'store_true',
+            help = 'fetch each subreddit once and match the searches confined to it locally')
+    parser.add_argument('--metrics-file', metavar = 'PATH',
+            help = 'record stage and per-search timings and write them to PATH as json after each cycle')
+    parser.add_argument('--metrics-port', type = int, metavar = 'PORT',
+            help = 'record stage and per-search timings and serve them for prometheus on localhost:PORT/metrics')
+    parser.add_argument('--sink', action = 'append', metavar = 'SINK',
+            help = 'deliver to pushbullet (the default), stdout, jsonl:PATH or webhook:URL, can be repeated')
+    parser.add_argument('--processes', type = int, default = 1, metavar = 'N',
+            help = 'poll the searches from N worker processes, each with 1/N of the rate budget')
+    parser.add_argument('--shard', type = parse_shard, metavar = 'I/N',
+            help = 'only poll the searches of shard I out of N, for hosts that share the database')
+    parser.add_argument('--all', action = 'store_true',
+            help = 'poll every search now, not only the ones that are due')
+    parser.add_argument('--profile-startup', action = 'store_true',
+            help = 'print how long the import and each step of startup took to stderr')
+    capture = parser.add_mutually_exclusive_group()
+    capture.add_argument('--record', metavar = 'DIR',
+            help = 'save every reddit and push request and response, and the database before the first, to DIR')
+    capture.add_argument('--replay', metavar = 'DIR',
+            help = 'run cycles against a copy of the database recorded in DIR, answering requests from DIR '
+                   'instead of the network, back to back until every recorded response was served')
+    manage = parser.add_argument_group('search management', 'import or export the searches instead of polling')
+    manage.add_argument('--import-searches', metavar = 'FILE',
+            help = 'add or replace searches from a json or csv FILE (- for stdin) in one transaction')
+    manage.add_argument('--export-searches', metavar = 'FILE', help = 'write every search to FILE (- for stdout)')
+    manage.add_argument('--format', choices = ('json', 'csv'),
+            help = 'the format of the import or export, by default from the file extension or else json')
+    history = parser.add_argument_group('deal history', 'print archived deals instead of polling')
+    history.add_argument('--history', nargs = '?', const = '', metavar = 'TEXT',
+            help = 'list archived deals, newest first, optionally only those whose title matches TEXT')
+    history.add_argument('--history-search', metavar = 'TITLE', help = 'only deals hit by this search')
+    history.add_argument('--history-domain', metavar = 'DOMAIN', help = 'only deals linking to DOMAIN')
+    history.add_argument('--history-since', type = parse_date, metavar = 'YYYY-MM-DD')
+    history.add_argument('--history-until', type = parse_date, metavar = 'YYYY-MM-DD')
+    history.add_argument('--history-before', metavar = 'CURSOR', help = 'the page after this cursor')
+    history.add_argument('--history-limit', type = int, default = ARCHIVE_PAGE_SIZE, metavar = 'N')
+    history.add_argument('--history-count', action = 'store_true', help = 'only print how many deals match')
+    args = parser.parse_args(argv)
+    if args.processes < 1:
+        parser.error('--processes must be at least 1')
+    for spec in args.sink or []:
+        try:
+            make_sink(spec)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.local_match and (args.processes > 1 or args.shard is not None):
+        parser.error('--local-match can not be combined with --processes or --shard')
+    # worker processes have http pools of their own
+    if (args.record is not None or args.replay is not None) and args.processes > 1:
+        parser.error('--record and --replay can not be combined with --processes')
+    if args.replay is not None and args.daemon:
+        parser.error('--replay runs its own cycles and can not be combined with --daemon')
+    return args
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected 'YYYY-MM-DD', got {!r}".format(value))
+
+# runs --import-searches and --export-searches
+def manage_searches(args):
+    def file_format(path):
+        if args.format is not None: return args.format
+        return 'csv' if path.lower().endswith('.csv') else 'json'
+
+    if args.import_searches is not None:
+        path = args.import_searches
+        if path == '-':
+            rows = read_searches(sys.stdin, file_format(path))
+        else:
+            with open(path, newline = '') as f:
+                rows = read_searches(f, file_format(path))
+        try:
+            inserted, updated = import_searches(rows)
+        except SearchImportError as e:
+            sys.exit('nothing imported:\n{}'.format(e))
+        print('imported {} new and {} replaced searches'.format(inserted, updated), file = sys.stderr)
+    if args.export_searches is not None:
+        path = args.export_searches
+        if path == '-':
+            export_searches(sys.stdout, file_format(path))
+        else:
+            with open(path + '.tmp', 'w', newline = '') as f:
+                export_searches(f, file_format(path))
+            os.replace(path + '.tmp', path)
+
+# prints a page of the archived deals that match the --history options
+def print_history(args):
+    filters = {
+            'search': args.history_search,
+            'text': args.history or None,
+            'domain': args.history_domain,
+            'since': args.history_since,
+            'until': args.history_until
+        }
+    try:
+        if args.history_count:
+            print(ArchivedDeal.count_matching(**filters))
+            return
+        deals = ArchivedDeal.query(before = args.history_before, limit = args.history_limit, **filters)
+    except OperationalError as e:
+        # sqlite rejects TEXT that is not FTS5 syntax, e.g. '"rtx 4070'
+        if filters['text'] is None:
+            raise
+        sys.exit('--history {!r} is not a valid full text query: {}'.format(args.history, e))
+    for deal in deals:
+        print(deal)
+    if len(deals) == args.history_limit:
+        print('next page: --history-before {}'.format(deals[-1].cursor))
+
+# parses the 'I/N' of --shard into (I, N), I counts from 0
+def parse_shard(value):
+    try:
+        index, shards = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected 'I/N', got {!r}".format(value))
+    if shards < 1 or not 0 <= index < shards:
+        raise argparse.ArgumentTypeError('shard {} is not in 0..{}'.format(index, shards - 1))
+    return (index, shards)
+
+# polls the searches, queues their new deals in the outbox in the same
+# transaction that saves the searches' state, and then delivers the outbox to
+# 'sinks', a PushSink or a list of them. Returns the pushes that were
+# delivered.
+def poll_cycle(searches, sinks, poller = None, delivery = None, print_pushes = True, \
+        window = DEDUP_WINDOW, max_open = DEDUP_MAX_OPEN, clusters = None, clock = None):
+    if poller is None: poller = RedditPoller(concurrency = POLL_CONCURRENCY)
+    if delivery is None: delivery = PushDelivery(sinks, print_pushes = print_pushes)
+    with default_metrics().stage('cycle'):
+        return PollCycle(poller, delivery, window = window, max_open = max_open, \
+                clusters = clusters, clock = clock).run(searches)
+
+# one poll cycle as a pipeline. The searches, any iterable, are fetched
+# 'concurrency' at a time as the pipeline asks for them, their posts become
+# deals that wait in a DedupWindow for the other searches that hit the same
+# post, and each batch of deals the window releases is queued in the outbox
+# and delivered right away. Only the deals in the window and the searches
+# still waiting on them are kept, so memory does not grow with the number of
+# searches. Near duplicate posts collapse into one deal through 'clusters',
+# by default an index of the deals archived within NEAR_DUP_WINDOW. 'clock'
+# returns the current utc time, the cycle starts at 'now' or its time.
+class PollCycle:
+    def __init__(self, poller, delivery, window = DEDUP_WINDOW, max_open = DEDUP_MAX_OPEN, now = None, \
+            clusters = None, clock = None):
+        self.poller = poller
+        self.delivery = delivery
+        self.clock = clock or datetime.utcnow
+        self.now = now or self.clock() # saved as the searches' last run
+        if clusters is None:
+            clusters = DealClusters()
+            clusters.load_recent(self.now)
+        self.window = DedupWindow(window, max_open, clusters)
+        # the spare polling budget goes to the searches in a cadence window
+        self.speedup = RedditWatchedSearch.budget_speedup(self.now)
+        self._skipped = [] # searches outside their active hours
+        self.delivered = []
+        self.archive = DealArchive()
+        self.filter = DealFilter()
+        self._pending = {} # search -> number of its deals in the window
+        self._fetched = set() # searches whose posts are all in the window
+        self._released = Deals()
+        self._ready = [] # fetched searches without deals in the window
+
+    # returns the pushes that were delivered
+    def run(self, searches):
+        # wake up now and then, so that windows close on time while the
+        # slowest searches are still being fetched
+        tick = min(max(self.window.window, 0.01), 0.25)
+        for result in self.poller.iter_results(self._active(searches), timeout = tick):
+            if result is not None:
+                self._add(*result)
+            self._release(self.window.release(time.monotonic()))
+            if len(self._released) > 0 or len(self._ready) >= STREAM_SAVE_BATCH:
+                self._commit()
+        self._release(self.window.release())
+        self._commit(final = True)
+        return self.delivered
+
+    # the searches in their active hours, the others are moved to their next
+    # active time without being polled
+    def _active(self, searches):
+        for search in searches:
+            if not hasattr(search, 'is_active') or search.is_active(self.now):
+                yield search
+            else:
+                search.next_poll_utc = search.next_active(self.now)
+                self._skipped.append(search)
+
+    def _add(self, search, posts):
+        metrics = default_metrics()
+        # a search that failed keeps its old state, so that the next run
+        # fetches its posts again
+        error = self.poller.errors.get(search)
+        if error is not None:
+            print('Search {} failed: {}'.format(search, error))
+            metrics.count('reddit_watcher_search_errors_total', search = metrics_label(search))
+            search.retry_soon(self.now)
+        else:
+            search.reschedule(len(posts), self.now, speedup = self.speedup)
+        if metrics.enabled:
+            metrics.count('reddit_watcher_search_hits_total', len(posts), search = metrics_label(search))
+
+        with metrics.stage('filter'):
+            kept = self.filter.filter(search, posts)
+        if len(kept) < len(posts) and metrics.enabled:
+            metrics.count('reddit_watcher_filtered_total', len(posts) - len(kept), search = metrics_label(search))
+        posts = kept
+
+        pending = 0
+        now = time.monotonic()
+        with metrics.stage('dedup'):
+            for post in posts:
+                # poll() only returns posts that are new since the last run
+                if self.window.add(RedditDeal(search, post), now):
+                    pending += 1
+            self._pending[search] = pending
+            self._fetched.add(search)
+        if pending == 0:
+            self._ready.append(search)
+
+    def _release(self, deals):
+        for deal in deals:
+            self._released.add(deal)
+            for s in deal.searches:
+                self._pending[s] -= 1
+                if self._pending[s] == 0 and s in self._fetched:
+                    self._ready.append(s)
+
+    # queues the released deals and saves the ready searches in one
+    # transaction, then delivers the outbox. The state of a search only moves
+    # forward once all of its deals are in the outbox, where they survive a
+    # crash. The transaction takes the write lock up front, so that when
+    # shards on several hosts share the database only the first one to mark
+    # a post seen pushes it.
+    def _commit(self, final = False):
+        deals, self._released = self._released, Deals()
+        ready, self._ready = self._ready, []
+        skipped = []
+        if final: skipped, self._skipped = self._skipped, []
+        if len(deals) == 0 and len(ready) == 0 and not final:
+            return
+
+        with default_metrics().stage('db_write'), RedditWatchedSearch._meta.database.atomic('IMMEDIATE'):
+            # drop anything that an earlier run, or another shard, already pushed
+            deals.drop_seen()
+            self.delivery.enqueue(deals, self.now)
+            if final: self.poller.save_state()
+            advanced = [s for s in ready if s not in self.poller.errors]
+            RedditWatchedSearch.save_poll_state(advanced, self.now)
+            RedditWatchedSearch.save_schedule(ready + skipped)
+            SeenPost.mark_seen([key for d in deals for key in d.source_keys], self.now)
+            if final: SeenPost.prune(self.now - SEEN_POST_TTL)
+            self.archive.add(deals, self.now)
+            if final or len(self.archive) >= ARCHIVE_BATCH:
+                self.archive.write()
+
+        for s in ready:
+            del self._pending[s]
+            self._fetched.discard(s)
+        # pushes still in flight are recorded by a later commit, only the
+        # last one waits for them
+        if len(deals) > 0 or final:
+            self.delivered.extend(self.delivery.flush(self.clock(), wait = final))
+
+# holds each new deal for 'window' seconds so that the other searches that
+# hit the same post join it before it is released. Past 'max_open' deals the
+# oldest is released early, which keeps memory flat. With 'clusters', near
+# duplicates of a waiting deal are merged into it, and near duplicates of a
+# deal that was already released are dropped.
+class DedupWindow:
+    def __init__(self, window = DEDUP_WINDOW, max_open = DEDUP_MAX_OPEN, clusters = None):
+        self.window = window
+        self.max_open = max_open
+        self.clusters = clusters
+        self._open = OrderedDict() # dedup_key -> (deadline, RedditDeal), oldest first
+
+    # returns True if the deal's search was not waiting on this post yet
+    def add(self, deal, now):
+        own_key = deal.dedup_key
+        key = own_key if self.clusters is None else self.clusters.key(deal)
+        entry = self._open.get(key)
+        if entry is None:
+            if key != own_key:
+                return False
+            self._open[key] = (now + self.window, deal)
+            return True
+        open_deal = entry[1]
+        added = not deal.searches <= open_deal.searches
+        if key != own_key:
+            open_deal.merge(deal)
+        elif added:
+            open_deal.combine_searches(deal)
+        return added
+
+    # removes and returns the deals whose window closed by 'now', all of them
+    # if 'now' is None, plus the oldest ones past max_open
+    def release(self, now = None):
+        released = []
+        while len(self._open) > 0:
+            key, (deadline, deal) = next(iter(self._open.items()))
+            if now is not None and deadline > now and len(self._open) <= self.max_open:
                 break
+            del self._open[key]
+            released.append(deal)
+        return released
+
+    def __len__(self):
+        return len(self._open)
+
+_AMOUNT = r'(?:\d{1,3}(?:,\d{3})+(?:\.\d{1,2})?|\d+(?:\.\d{1,2})?)(?:k\b)?'
+_CURRENCY_CODES = r'usd|cad|aud|eur|gbp'
+# prices like $199.99, $1.2k, $199 CAD, CAD $199, 199 EUR and €199, and
+# discounts like 33% off or -33%, all found in one pass over a title
+_DEAL_TOKEN = re.compile(
+        r'(?P<symbol>[$€£])\s?(?P<symbol_amount>{a})(?:\s?(?P<symbol_code>{c})\b)?'
+        r'|\b(?P<code>{c})\s?\$?(?P<code_amount>{a})'
+        r'|(?P<amount_code>{a})\s?(?P<trailing_code>{c})\b'
+        r'|(?P<percent>\d{{1,2}}(?:\.\d+)?)\s?%\s?off\b'
+        r'|-\s?(?P<minus_percent>\d{{1,2}}(?:\.\d+)?)\s?%'.format(a = _AMOUNT, c = _CURRENCY_CODES),
+        re.IGNORECASE)
+_CURRENCY_SYMBOLS = {'$': 'USD', '€': 'EUR', '£': 'GBP'}
+# what comes before the price a title works out or changes to, as in
+# '$299 - $100 = $199' or '$599 -> $499'
+_NEW_PRICE_MARKS = ('=', '->', '=>', '→', '⇒', '➜', '➔', '➡', '⟶')
+# second level labels of country domains, e.g. the co of amazon.co.uk
+_SECOND_LEVEL_LABELS = {'co', 'com', 'net', 'org', 'ac', 'gov'}
+
+# the price, currency, discount and vendor of a deal as far as its title and
+# url tell them, any of which may be None
+class DealInfo:
+    __slots__ = ('price', 'currency', 'percent_off', 'vendor')
+
+    def __init__(self, price = None, currency = None, percent_off = None, vendor = None):
+        self.price       = price
+        self.currency    = currency
+        self.percent_off = percent_off
+        self.vendor      = vendor
+
+    # the price is the first one in the title, e.g. '[GPU] RTX 4070 - $549
+    # ($599 - $50)', unless the title works it out or changes it, e.g. '$299
+    # - $100 = $199' or '$599 -> $499', then it is the last one after an '='
+    # or arrow, or strikes it through, e.g. '~~$599~~ $499', then it is the
+    # first one that is not struck through. The discount is worked out from
+    # the first price if the title does not state it.
+    @classmethod
+    def extract(cls, post):
+        title = post.title
+        prices, percents = [], []
+        for m in _DEAL_TOKEN.finditer(title):
+            if m.group('symbol') is not None:
+                amount = m.group('symbol_amount')
+                currency = (m.group('symbol_code') or _CURRENCY_SYMBOLS[m.group('symbol')]).upper()
+            elif m.group('code') is not None:
+                amount, currency = m.group('code_amount'), m.group('code').upper()
+            elif m.group('trailing_code') is not None:
+                amount, currency = m.group('amount_code'), m.group('trailing_code').upper()
+            else:
+                percents.append(float(m.group('percent') or m.group('minus_percent')))
+                continue
+            value = float(amount.rstrip('kK').replace(',', ''))
+            if amount[-1] in 'kK': value *= 1000
+            before = title[:m.start()].rstrip()
+            new = before.endswith(_NEW_PRICE_MARKS)
+            struck = before.endswith('~~') and title[m.end():].lstrip().startswith('~~')
+            prices.append((currency, value, new, struck))
+
+        info = cls(vendor = url_vendor(post.url))
+        if len(prices) > 0:
+            first_currency, first_price, _, _ = prices[0]
+            same = [p for p in prices if p[0] == first_currency]
+            new = [price for _, price, is_new, _ in same if is_new]
+            kept = [price for _, price, _, struck in same if not struck]
+            info.currency, info.price = first_currency, first_price
+            if len(new) > 0:
+                info.price = new[-1]
+            elif prices[0][3] and len(kept) > 0:
+                info.price = kept[0]
+            if len(percents) == 0 and first_price > info.price:
+                percents.append(round(100 * (1 - info.price / first_price), 1))
+        if len(percents) > 0:
+            info.percent_off = max(percents)
+        return info
+
+# the name of the shop a url points to, e.g. 'amazon' for smile.amazon.co.uk
+def url_vendor(url):
+    domain = url_domain(url)
+    if domain is None:
+        return None
+    labels = domain.split('.')[:-1]
+    if len(labels) > 1 and labels[-1] in _SECOND_LEVEL_LABELS:
+        labels.pop()
+    return labels[-1] if len(labels) > 0 else None
+
+# a pattern that matches a title containing every comma separated keyword,
+# as whole words and ignoring case
+@functools.lru_cache(maxsize = 1024)
+def keywords_pattern(keywords):
+    lookaheads = ''.join(r'(?=.*\b{}\b)'.format(re.escape(k.strip())) \
+            for k in keywords.split(',') if k.strip() != '')
+    return re.compile(lookaheads, re.IGNORECASE | re.DOTALL)
+
+# drops the posts that miss a search's thresholds, before they become deals.
+# The DealInfo of a post is extracted once per cycle however many searches
+# hit it, and only for searches that have thresholds. A threshold only drops
+# a post when the post tells the value, e.g. max_price keeps posts without a
+# price.
+class DealFilter:
+    def __init__(self):
+        self._info = {} # dedup_key -> DealInfo
+
+    def info(self, post):
+        key = post.dedup_key
+        info = self._info.get(key)
+        if info is None:
+            info = self._info[key] = DealInfo.extract(post)
+        return info
+
+    def filter(self, search, posts):
+        max_price = getattr(search, 'max_price', None)
+        min_percent_off = getattr(search, 'min_percent_off', None)
+        keywords = getattr(search, 'required_keywords', None)
+        if max_price is None and min_percent_off is None and not keywords:
+            return posts
+
+        pattern = keywords_pattern(keywords) if keywords else None
+        kept = []
+        for post in posts:
+            if pattern is not None and pattern.match(post.title) is None:
+                continue
+            if max_price is not None or min_percent_off is not None:
+                info = self.info(post)
+                if max_price is not None and info.price is not None and info.price > max_price:
+                    continue
+                if min_percent_off is not None and info.percent_off is not None \
+                        and info.percent_off < min_percent_off:
+                    continue
+            kept.append(post)
+        return kept
+
+# the features of a title that near duplicates share, its words and pairs of
+# neighbouring words
+def title_shingles(title):
+    words = _WORD.findall(title.lower())
+    return frozenset(words + [a + ' ' + b for a, b in zip(words, words[1:])])
+
+# the words of a title that name a model rather than describe it, those with
+# digits, e.g. 4070 or 2x, and variant names like ti, without its prices
+def title_models(title):
+    words = _WORD.findall(_DEAL_TOKEN.sub(' ', title).lower())
+    return frozenset(w for w in words if w in _MODEL_VARIANTS or any(c.isdigit() for c in w))
+
+_MODEL_VARIANTS = frozenset(['ti', 'super', 'xt', 'xtx', 'gre', 'pro', 'max', 'plus', 'ultra', 'mini', 'lite'])
+
+# a signature whose values agree with another title's at about the rate of
+# their shingles' jaccard similarity. Each shingle is hashed once, and the
+# 16 bit slices of its digest stand in for the permutations.
+def minhash(shingles):
+    rows = [struct.unpack(_MINHASH_FORMAT, hashlib.blake2b(s.encode('utf-8'), digest_size = _MINHASH_SIZE).digest()) \
+            for s in shingles]
+    return tuple(map(min, zip(*rows)))
+
+_MINHASH_FORMAT = '<{}H'.format(MINHASH_BANDS * MINHASH_ROWS)
+_MINHASH_SIZE = 2 * MINHASH_BANDS * MINHASH_ROWS
+
+# what DealClusters looks a post up by: the title's shingles, its packed
+# minhash (b'' for a title without words) and the url without tracking
+# parameters or www. (None for a site's front page, which says nothing about
+# the deal). The archive keeps the last two, so that loading it hashes nothing.
+def cluster_fields(post):
+    shingles = title_shingles(post.title)
+    signature = struct.pack(_MINHASH_FORMAT, *minhash(shingles)) if len(shingles) > 0 else b''
+    parts = urllib.parse.urlsplit(normalize_url(post.url))
+    if parts.path in ('', '/'):
+        return shingles, signature, None
+    netloc = parts.netloc[4:] if parts.netloc.startswith('www.') else parts.netloc
+    return shingles, signature, urllib.parse.urlunsplit(parts._replace(netloc = netloc))
+
+# the LSH bands of a packed minhash
+def minhash_bands(signature):
+    if not signature:
+        return []
+    values = struct.unpack(_MINHASH_FORMAT, signature)
+    return [(band, values[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]) for band in range(MINHASH_BANDS)]
+
+class _Clustered:
+    # the shingles and info of an archived deal are worked out from 'post'
+    # once it is a candidate
+    __slots__ = ('cluster', 'shingles', 'models', 'bands', 'url', 'info', 'posted_utc', 'post')
+
+# the recent deals indexed for near duplicate lookups, a locality sensitive
+# hash over title minhashes plus the urls without tracking parameters. Two
+# posts are only near duplicates if their prices, vendors and urls, when both
+# tell them, and the models their titles name agree too.
+class DealClusters:
+    def __init__(self, window = NEAR_DUP_WINDOW, max_size = NEAR_DUP_MAX, similarity = NEAR_DUP_SIMILARITY):
+        self.window = timedelta(seconds = window)
+        self.max_size = max_size
+        self.similarity = similarity
+        self._entries = OrderedDict() # dedup_key -> _Clustered, oldest first
+        self._bands = {} # (band, values) -> set of dedup_keys
+        self._urls = {} # normalized url -> dedup_key
+        self._newest = None
+        self._load_since = None # the archive still to load, see load_recent()
+
+    # the dedup key of the deal the post is a near duplicate of, or of the
+    # post itself if it is not one. Either way, the post joins the index.
+    def key(self, post):
+        if self._load_since is not None: self._load()
+        own_key = post.dedup_key
+        entry = self._entries.get(own_key)
+        if entry is not None:
+            return entry.cluster
+        entry = self._entry(post)
+        match = self._match(entry)
+        entry.cluster = own_key if match is None else match.cluster
+        self._add(own_key, entry)
+        return entry.cluster
+
+    # indexes the archived deals posted within the window before 'now', so
+    # that a run also catches reposts of deals pushed by earlier runs. The
+    # archive is read by the first key(), a cycle without posts never does.
+    def load_recent(self, now):
+        self._load_since = now - self.window
+
+    def _load(self):
+        since, self._load_since = self._load_since, None
+        query = ArchivedDeal.select(ArchivedDeal.post_key, ArchivedDeal.title, ArchivedDeal.url, \
+                ArchivedDeal.posted_utc, ArchivedDeal.signature, ArchivedDeal.match_url) \
+                .where(ArchivedDeal.posted_utc >= since) \
+                .order_by(ArchivedDeal.posted_utc.desc()).limit(self.max_size).namedtuples()
+        for deal in reversed(list(query)):
+            if deal.post_key in self._entries:
+                continue
+            post = RedditPost._from_fields(deal.title, deal.url, deal.posted_utc, deal.post_key)
+            if deal.signature is None:
+                # archived before the signatures were
+                entry = self._entry(post)
+            else:
+                entry = _Clustered()
+                entry.shingles = entry.models = entry.info = None
+                entry.post = post
+                entry.bands = minhash_bands(deal.signature)
+                entry.url = deal.match_url or None
+                entry.posted_utc = deal.posted_utc
+            entry.cluster = deal.post_key
+            self._add(deal.post_key, entry)
+
+    def _entry(self, post):
+        entry = _Clustered()
+        entry.shingles, signature, entry.url = cluster_fields(post)
+        entry.models = title_models(post.title)
+        entry.bands = minhash_bands(signature)
+        entry.info = DealInfo.extract(post)
+        entry.posted_utc = post.posted_utc
+        return entry
 
-            deals_to_push.add(RedditDeal(search, post))
-
-        # remember to only update if the pushables were actually sent
-        search.last_run_utc = curr_time
-        search.save()
+    @staticmethod
+    def _details(entry):
+        if entry.info is None:
+            entry.shingles = title_shingles(entry.post.title)
+            entry.models = title_models(entry.post.title)
+            entry.info = DealInfo.extract(entry.post)
+            entry.post = None
+        return entry
+
+    def _match(self, entry):
+        if entry.url is not None and entry.url in self._urls:
+            return self._entries[self._urls[entry.url]]
+        candidates = set()
+        for band in entry.bands:
+            candidates |= self._bands.get(band, set())
+        best, best_similarity = None, self.similarity
+        for key in candidates:
+            other = self._details(self._entries[key])
+            # a post without a vendor or price must not link deals that differ in them
+            cluster = self._details(self._entries.get(other.cluster, other))
+            if not self._compatible(entry, other) or not self._compatible(entry, cluster):
+                continue
+            similarity = len(entry.shingles & other.shingles) / len(entry.shingles | other.shingles)
+            if similarity >= best_similarity:
+                best, best_similarity = other, similarity
+        return best
 
-    pb.push_iterable(deals_to_push, print_pushes=True)
-    db.close()
+    @staticmethod
+    def _compatible(entry, other):
+        a, b = entry.info, other.info
+        if a.price is not None and b.price is not None and (a.price, a.currency) != (b.price, b.currency):
+            return False
+        # links to reddit itself are self posts, not a vendor
+        vendor_a, vendor_b = (None if v in ('reddit', 'redd') else v for v in (a.vendor, b.vendor))
+        if vendor_a is not None and vendor_b is not None:
+            if vendor_a != vendor_b or entry.url is not None and other.url is not None and entry.url != other.url:
+                return False
+        # a variant one title names and the other does not, e.g. 4070 and
+        # 4070 ti, or models each names and the other does not, e.g. 4070 and
+        # 4080. A model only one title names, e.g. 12gb, is a detail.
+        variants = (entry.models ^ other.models) & _MODEL_VARIANTS
+        return len(variants) == 0 and not (entry.models - other.models and other.models - entry.models)
+
+    def _add(self, key, entry):
+        self._entries[key] = entry
+        for band in entry.bands:
+            self._bands.setdefault(band, set()).add(key)
+        if entry.url is not None:
+            self._urls.setdefault(entry.url, key)
+        if self._newest is None or entry.posted_utc > self._newest:
+            self._newest = entry.posted_utc
+        self._evict()
+
+    def _evict(self):
+        oldest = self._newest - self.window
+        while len(self._entries) > 0:
+            key, entry = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_size and entry.posted_utc >= oldest:
+                break
+            del self._entries[key]
+            for band in entry.bands:
+                keys = self._bands[band]
+                keys.discard(key)
+                if len(keys) == 0: del self._bands[band]
+            if entry.url is not None and self._urls.get(entry.url) == key:
+                del self._urls[entry.url]
+
+    def __len__(self):
+        return len(self._entries)
+
+# times the steps of startup for --profile-startup, each mark() records the
+# time since the previous one, starting when the profile is created
+class StartupProfile:
+    def __init__(self, enabled = True):
+        self.enabled = enabled
+        self.steps = [('import reddit_watcher', _import_finished - _import_started)]
+        self._last = time.perf_counter()
+
+    def mark(self, step):
+        now = time.perf_counter()
+        self.steps.append((step, now - self._last))
+        self._last = now
+
+    def report(self, file = None):
+        if not self.enabled:
+            return
+        if file is None: file = sys.stderr
+        for step, seconds in self.steps:
+            print('{:<24} {:>8.1f} ms'.format(step, seconds * 1000), file = file)
+        total = sum(seconds for _, seconds in self.steps)
+        print('{:<24} {:>8.1f} ms'.format('total', total * 1000), file = file)
+
+# the file where a cron run saves when the next one has work, next to the
+# database file (db's by default) and per shard
+def next_due_path(shard = None, database = None):
+    path = (database or db.database) + '.next_due'
+    if shard is not None: path += '.{}of{}'.format(*shard)
+    return path
+
+# the mtime and size of the database files, a write by anything else changes
+# them and so voids the saved next due time
+def database_stamp(database = None):
+    if database is None: database = db.database
+    stamp = []
+    for suffix in ('', '-wal'):
+        try:
+            st = os.stat(database + suffix)
+        except OSError:
+            stamp.append(None)
+        else:
+            stamp.append([st.st_mtime_ns, st.st_size])
+    return stamp
+
+# the next time one of the shard's searches is due, None if it has none
+def next_due_utc(shard = None):
+    if shard is None:
+        return RedditWatchedSearch.next_due_utc()
+    query = RedditWatchedSearch.select(RedditWatchedSearch.uuid, RedditWatchedSearch.next_poll_utc)
+    due_times = [s.next_poll_utc or datetime.utcfromtimestamp(0) \
+            for s in HashRing(shard[1]).owned(shard[0], query)]
+    return min(due_times) if len(due_times) > 0 else None
+
+# 'next_due' of None means there is nothing to do until the database changes
+def save_next_due(next_due, shard = None, database = None):
+    if database is None: database = db.database
+    if database == ':memory:':
+        return
+    if next_due is not None:
+        next_due = (next_due - datetime.utcfromtimestamp(0)).total_seconds()
+    data = {'next_due_utc': next_due, 'database': database_stamp(database)}
+    path = next_due_path(shard, database)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+# True if the last cron run saved that nothing is due before 'now' and the
+# database has not changed since
+def nothing_due(now, shard = None, database = None):
+    try:
+        with open(next_due_path(shard, database)) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if data.get('database') != database_stamp(database):
+        return False
+    if data.get('next_due_utc') is None:
+        return True
+    return now < datetime.utcfromtimestamp(data['next_due_utc'])
 
 # helper function to create tables
 def create_tables():
     with db:
-        db.create_tables([RedditWatchedSearch])
+        db.create_tables([RedditWatchedSearch, SeenPost, OutboxPush, SubredditCursor, \
+                ArchivedDeal, ArchivedDealSearch, archived_deal_title()])
+
+# helper function to add the columns that newer versions added to the models
+# to an existing database
+def migrate_tables(models = None):
+    from playhouse.migrate import SqliteMigrator, migrate
+    if models is None: models = [RedditWatchedSearch, OutboxPush, ArchivedDeal]
+    migrator = SqliteMigrator(db)
+    with db.atomic():
+        for model in models:
+            table = model._meta.table_name
+            existing = {c.name for c in db.get_columns(table)}
+            for field in model._meta.sorted_fields:
+                if field.column_name not in existing:
+                    migrate(migrator.add_column(table, field.column_name, field))
 
 # testing functions
 def push_test():
@@ -49,6 +1001,753 @@ def push_test():
     pb = PushbulletAccount(PB_ACCESS_TOKEN)
     pb.push_link(test)
 
+# a requests session with keep-alive connection pools, shared by all of the
+# classes that talk to reddit or pushbullet so connections are reused
+class HTTPPool:
+    def __init__(self, pool_connections = HTTP_POOL_CONNECTIONS, pool_maxsize = HTTP_POOL_MAXSIZE, \
+            timeout = HTTP_TIMEOUT, max_retries = 0):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.mount(HTTPAdapter(pool_connections = pool_connections, \
+                pool_maxsize = pool_maxsize, max_retries = max_retries))
+
+    # replace the transport for all urls starting with one of the prefixes,
+    # e.g. with a LocalTransport in tests
+    def mount(self, transport, prefixes = ('https://', 'http://')):
+        for prefix in prefixes:
+            self.session.mount(prefix, transport)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.post(url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+_http_pool = None
+
+def default_http_pool():
+    global _http_pool
+    if _http_pool is None:
+        _http_pool = HTTPPool()
+    return _http_pool
+
+# use the given pool for every class that does not have its own, returns the
+# pool that was used before
+def set_default_http_pool(pool):
+    global _http_pool
+    previous = _http_pool
+    _http_pool = pool
+    return previous
+
+# a transport that answers requests from canned responses instead of the
+# network, responses are matched by the longest registered url prefix. It has
+# the send() and close() of a requests adapter without subclassing one.
+class LocalTransport:
+    def __init__(self):
+        self._routes = {} # url prefix -> list of (status, headers, body)
+        self.requests = [] # every request that was sent, in order
+
+    # with queue=True the response is served after the ones already added
+    # for the prefix instead of replacing them, the last one is repeated
+    def add(self, url_prefix, body = None, status = 200, headers = None, queue = False):
+        if not isinstance(body, (bytes, str)):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        response = (status, headers or {}, body)
+        if queue and url_prefix in self._routes:
+            self._routes[url_prefix].append(response)
+        else:
+            self._routes[url_prefix] = [response]
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        status, headers, body = self._next_response(request.url)
+
+        import requests
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers)
+        response._content = body
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def _next_response(self, url):
+        matches = [p for p in self._routes if url.startswith(p)]
+        if len(matches) == 0:
+            return 404, {}, b'{}'
+        responses = self._routes[max(matches, key = len)]
+        return responses.pop(0) if len(responses) > 1 else responses[0]
+
+    def close(self):
+        pass
+
+# the raw http traffic of --record runs: index.jsonl has a line per request,
+# responses.z the zlib compressed request and response bodies that the lines
+# point to, read back through mmap. start.db is the database as it was when
+# the first run recorded into the directory.
+class Capture:
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, 'index.jsonl')
+        self.data_path = os.path.join(directory, 'responses.z')
+        self.database_path = os.path.join(directory, 'start.db')
+        self._lock = threading.Lock()
+        self._index = None
+        self._data = None
+        self._map = None
+
+    # a copy of the database, once per capture, before anything is recorded
+    def save_database(self, database):
+        if os.path.exists(self.database_path):
+            return
+        import sqlite3
+        os.makedirs(self.directory, exist_ok = True)
+        copy = sqlite3.connect(self.database_path + '.tmp')
+        try:
+            database.connection().backup(copy)
+        finally:
+            copy.close()
+        os.replace(self.database_path + '.tmp', self.database_path)
+
+    def append(self, method, url, request_body, status, headers, body):
+        import zlib
+        with self._lock:
+            if self._index is None:
+                os.makedirs(self.directory, exist_ok = True)
+                self._index = open(self.index_path, 'a')
+                self._data = open(self.data_path, 'ab')
+            entry = {'method': method, 'url': url, 'status': status, 'headers': headers, 'time': time.time()}
+            for name, content in (('request', request_body), ('body', body)):
+                if content is None:
+                    entry[name] = None
+                    continue
+                if isinstance(content, str): content = content.encode('utf-8')
+                compressed = zlib.compress(content)
+                entry[name] = [self._data.tell(), len(compressed)]
+                self._data.write(compressed)
+            # the data first, so that an index line never points past its end
+            self._data.flush()
+            self._index.write(json.dumps(entry) + '\n')
+            self._index.flush()
+
+    def entries(self):
+        try:
+            with open(self.index_path) as f:
+                return [json.loads(line) for line in f if line.strip() != '']
+        except FileNotFoundError:
+            return []
+
+    # the bytes of an entry's 'body' or 'request'
+    def read(self, location):
+        if location is None:
+            return None
+        import zlib
+        if self._map is None:
+            import mmap
+            with open(self.data_path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        offset, length = location
+        return zlib.decompress(self._map[offset:offset + length])
+
+    def close(self):
+        with self._lock:
+            for f in (self._index, self._data, self._map):
+                if f is not None: f.close()
+            self._index = self._data = self._map = None
+
+# records every request sent through another transport, e.g. the default
+# pool's HTTPAdapter, into a Capture
+class RecordingTransport:
+    def __init__(self, transport, capture):
+        self.transport = transport
+        self.capture = capture
+
+    def send(self, request, **kwargs):
+        response = self.transport.send(request, **kwargs)
+        headers = {k: v for k, v in response.headers.items() if k.lower() in CAPTURE_HEADERS}
+        self.capture.append(request.method, request.url, request.body, response.status_code, \
+                headers, response.content)
+        return response
+
+    def close(self):
+        self.transport.close()
+        self.capture.close()
+
+# answers requests from a Capture: each url gets its recorded responses in
+# order and then repeats the last one, like a LocalTransport. A url that was
+# not recorded gets the responses of the longest recorded url it starts
+# with, and a 404 if there is none. Bodies are only decompressed when served.
+class ReplayTransport(LocalTransport):
+    def __init__(self, capture):
+        super().__init__()
+        self.capture = capture
+        for entry in capture.entries():
+            self._routes.setdefault(entry['url'], []).append( \
+                    (entry['status'], entry['headers'], entry['body'], entry['time']))
+        self.pending = sum(len(responses) for responses in self._routes.values()) # recorded, not served yet
+        self._served_last = set()
+        self.time = None # the replay clock, a unix time
+
+    # the replay clock: when the latest response served was recorded, or
+    # after advance() the next one to serve
+    def now(self):
+        if self.time is None:
+            return datetime.utcnow()
+        return datetime.utcfromtimestamp(self.time)
+
+    # moves the clock on to when the next response still to serve was
+    # recorded, so that a replayed cycle starts when the recorded one did
+    def advance(self):
+        upcoming = [responses[0][3] for prefix, responses in self._routes.items() \
+                if len(responses) > 1 or prefix not in self._served_last]
+        if len(upcoming) > 0:
+            self._tick(min(upcoming))
+
+    def _tick(self, recorded):
+        if self.time is None or recorded > self.time:
+            self.time = recorded
+
+    def _next_response(self, url):
+        matches = [p for p in self._routes if url.startswith(p)]
+        if len(matches) == 0:
+            return 404, {}, b'{}'
+        prefix = max(matches, key = len)
+        responses = self._routes[prefix]
+        if len(responses) > 1:
+            status, headers, body, recorded = responses.pop(0)
+            self.pending -= 1
+        else:
+            status, headers, body, recorded = responses[0]
+            if prefix not in self._served_last:
+                self._served_last.add(prefix)
+                self.pending -= 1
+        self._tick(recorded)
+        return status, headers, self.capture.read(body) or b''
+
+    def close(self):
+        self.capture.close()
+
+# mixin for the classes that make http requests, an instance (or subclass)
+# can set its own http_pool, otherwise the shared default pool is used
+class UsesHTTPPool:
+    _http_pool = None
+
+    @property
+    def http_pool(self):
+        if self._http_pool is None:
+            return default_http_pool()
+        return self._http_pool
+
+    @http_pool.setter
+    def http_pool(self, value):
+        self._http_pool = value
+
+class RedditRequestError(Exception):
+    pass
+
+# a token bucket that every reddit request goes through. Waiting requests are
+# served by priority (lower first, e.g. the time a search is due), 429 and
+# 5xx responses are retried with jittered exponential backoff.
+class RateLimiter:
+    def __init__(self, per_minute = REDDIT_REQUESTS_PER_MINUTE, burst = REDDIT_BURST, \
+            max_retries = REDDIT_MAX_RETRIES, backoff = REDDIT_BACKOFF):
+        self.rate = per_minute / 60.0 # tokens per second
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0 # no request is sent before this time
+        self._waiting = [] # heap of (priority, ticket number)
+        self._tickets = itertools.count()
+        self._cond = threading.Condition()
+
+        self.throttled = 0 # 429 responses
+        self.retried = 0 # requests sent again after a 429 or 5xx
+        self.dropped = 0 # requests given up on
+
+    @property
+    def counters(self):
+        return {
+            'throttled': self.throttled,
+            'retried': self.retried,
+            'dropped': self.dropped
+        }
+
+    # blocks until this request may be sent
+    def acquire(self, priority = 0):
+        with self._cond:
+            ticket = (priority, next(self._tickets))
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                now = self._refill()
+                if self._waiting[0] == ticket and self._tokens >= 1 and now >= self._blocked_until:
+                    heapq.heappop(self._waiting)
+                    self._tokens -= 1
+                    self._cond.notify_all()
+                    return
+                self._cond.wait(self._time_until_ready(now))
+
+    # lower the budget to what reddit says is left in the current window
+    def update(self, response):
+        remaining = response.headers.get('X-Ratelimit-Remaining')
+        reset = response.headers.get('X-Ratelimit-Reset')
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining, reset = float(remaining), float(reset)
+        except ValueError:
+            return
+        with self._cond:
+            now = self._refill()
+            self._tokens = min(self._tokens, remaining)
+            if remaining < 1:
+                self._blocked_until = max(self._blocked_until, now + reset)
+
+    # stop every request for 'seconds', e.g. after a 429
+    def block(self, seconds):
+        with self._cond:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+
+    def backoff_delay(self, attempt):
+        return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    # sends a GET through the limiter, retrying 429 and 5xx responses. Raises
+    # RedditRequestError if the request is given up on.
+    def get(self, http_pool, url, priority = 0, **kwargs):
+        import requests
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self.retried += 1
+            self.acquire(priority)
+            try:
+                r = http_pool.get(url, **kwargs)
+            except requests.RequestException as e:
+                # not retried, reddit being unreachable is not a throttle
+                self.dropped += 1
+                raise RedditRequestError('{} failed: {!r}'.format(url, e))
+
+            self.update(r)
+            if r.status_code == 429:
+                self.throttled += 1
+                error = RedditRequestError('{} throttled (429)'.format(url))
+                self.block(self._retry_after(r) or self.backoff_delay(attempt))
+            elif r.status_code >= 500:
+                error = RedditRequestError('{} failed ({})'.format(url, r.status_code))
+                time.sleep(self.backoff_delay(attempt))
+            elif not r.ok:
+                self.dropped += 1
+                raise RedditRequestError('{} failed ({})'.format(url, r.status_code))
+            else:
+                return r
+
+        self.dropped += 1
+        raise error
+
+    @staticmethod
+    def _retry_after(response):
+        try:
+            return float(response.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return None
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return now
+
+    def _time_until_ready(self, now):
+        wait_for_token = max(0.0, (1 - self._tokens) / self.rate)
+        return max(wait_for_token, self._blocked_until - now, 0.001)
+
+_rate_limiter = None
+
+def default_rate_limiter():
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter()
+    return _rate_limiter
+
+# use the given limiter for every reddit request, returns the previous one
+def set_default_rate_limiter(limiter):
+    global _rate_limiter
+    previous = _rate_limiter
+    _rate_limiter = limiter
+    return previous
+
+class CachedResponse:
+    def __init__(self, value, etag, last_modified, stored):
+        self.value         = value
+        self.etag          = etag
+        self.last_modified = last_modified
+        self.stored        = stored
+
+# an LRU cache of parsed responses keyed by request url and query string. A
+# fresh entry is returned without a request, a stale one is revalidated with
+# a conditional GET and reused as is on a 304, so it is never parsed again.
+class ResponseCache:
+    def __init__(self, ttl = RESPONSE_CACHE_TTL, max_entries = RESPONSE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0 # served without a request
+        self.revalidated = 0 # served after a 304
+        self.misses = 0 # fetched and parsed
+
+    @staticmethod
+    def key(url, params = None):
+        if params:
+            return url + '?' + params
+        return url
+
+    # 'get' sends the request with the given extra headers, 'parse' turns a
+    # 200 response into the value that is cached and returned
+    def fetch(self, key, get, parse):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if now - entry.stored < self.ttl:
+                    self.hits += 1
+                    return entry.value
+
+        headers = {}
+        if entry is not None:
+            if entry.etag: headers['If-None-Match'] = entry.etag
+            if entry.last_modified: headers['If-Modified-Since'] = entry.last_modified
+
+        r = get(headers)
+        if r.status_code == 304 and entry is not None:
+            with self._lock:
+                entry.stored = now
+                self.revalidated += 1
+            return entry.value
+
+        value = parse(r)
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = CachedResponse(value, r.headers.get('ETag'), \
+                    r.headers.get('Last-Modified'), now)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+_response_cache = None
+
+def default_response_cache():
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+    return _response_cache
+
+# use the given cache for every reddit request, returns the previous one
+def set_default_response_cache(cache):
+    global _response_cache
+    previous = _response_cache
+    _response_cache = cache
+    return previous
+
+# the latencies of one stage or search, as cumulative prometheus buckets
+class Histogram:
+    def __init__(self, buckets = METRICS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    # (upper bound, number of observations <= it) pairs, ending with +Inf
+    def cumulative(self):
+        bounds = [str(b) for b in self.buckets] + ['+Inf']
+        return list(zip(bounds, itertools.accumulate(self.counts)))
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+# latency histograms and counters of the poll cycle, keyed by metric name and
+# labels. Stages are timed per batch (a whole listing, a whole cycle's
+# dedup) rather than per post, so that timing never costs more than the work.
+class Metrics:
+    enabled = True
+
+    def __init__(self, buckets = METRICS_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {} # (name, labels) -> Histogram
+        self._counters = {} # (name, labels) -> number
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def count(self, name, amount = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    # context manager that observes how long its block took
+    def timer(self, name, **labels):
+        return _Timer(self, name, labels)
+
+    # one of the stages of a cycle: http, parse, decode, dedup, db_write,
+    # push or cycle
+    def stage(self, stage):
+        return _Timer(self, 'reddit_watcher_stage_seconds', {'stage': stage})
+
+    def histogram(self, name, **labels):
+        return self._histograms.get(self._key(name, labels))
+
+    def counter(self, name, **labels):
+        return self._counters.get(self._key(name, labels), 0)
+
+    @staticmethod
+    def _format_labels(labels, extra = ()):
+        labels = list(labels) + list(extra)
+        if len(labels) == 0:
+            return ''
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join('{}="{}"'.format(k, escape(v)) for k, v in labels) + '}'
+
+    # the prometheus text exposition format
+    def prometheus_text(self):
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append('# TYPE {} histogram'.format(name))
+                typed.add(name)
+            for bound, count in histogram.cumulative():
+                lines.append('{}_bucket{} {}'.format(name, self._format_labels(labels, [('le', bound)]), count))
+            lines.append('{}_sum{} {}'.format(name, self._format_labels(labels), histogram.sum))
+            lines.append('{}_count{} {}'.format(name, self._format_labels(labels), histogram.count))
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append('# TYPE {} counter'.format(name))
+                typed.add(name)
+            lines.append('{}{} {}'.format(name, self._format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    # a json-able copy of every metric
+    def snapshot(self):
+        with self._lock:
+            histograms = [{
+                    'name': name,
+                    'labels': dict(labels),
+                    'count': h.count,
+                    'sum': h.sum,
+                    'buckets': dict(h.cumulative())
+                } for (name, labels), h in sorted(self._histograms.items())]
+            counters = [{'name': name, 'labels': dict(labels), 'value': value} \
+                    for (name, labels), value in sorted(self._counters.items())]
+        return {'histograms': histograms, 'counters': counters}
+
+    # writes the snapshot to 'path', replacing the file in one step so that
+    # readers never see half of it
+    def dump_json(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f, indent = 2)
+        os.replace(tmp_path, path)
+
+    # serves prometheus_text() over http from a daemon thread, returns the
+    # server so that the caller can shut it down
+    def serve(self, port, host = '127.0.0.1'):
+        server = metrics_server((host, port), self)
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        return server
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+# the default, records nothing so that the instrumentation costs a method
+# call per batch when metrics are off
+class NullMetrics:
+    enabled = False
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+    def count(self, name, amount = 1, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return _NULL_TIMER
+
+    def stage(self, stage):
+        return _NULL_TIMER
+
+# an http server for Metrics.serve(), its classes are only defined when one
+# is started so that importing this module does not import http.server
+def metrics_server(address, metrics):
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = self.server.metrics.prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class MetricsServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = MetricsServer(address, MetricsHandler)
+    server.metrics = metrics
+    return server
+
+_metrics = NullMetrics()
+
+def default_metrics():
+    return _metrics
+
+# record the poll cycle's metrics in the given Metrics, or stop recording
+# with NullMetrics(). Returns the previous one.
+def set_default_metrics(metrics):
+    global _metrics
+    previous = _metrics
+    _metrics = metrics
+    return previous
+
+# the label of a search or feed in the per-search metrics
+def metrics_label(source):
+    for attr in ('title', 'query', 'url'):
+        value = getattr(source, attr, None)
+        if value:
+            return value
+    return str(source)
+
+# mixin for the classes that fetch from reddit, their GETs go through the
+# shared RateLimiter and ResponseCache unless an instance sets its own
+class UsesRedditAPI(UsesHTTPPool):
+    _rate_limiter = None
+    _response_cache = None
+
+    @property
+    def response_cache(self):
+        if self._response_cache is None:
+            return default_response_cache()
+        return self._response_cache
+
+    @response_cache.setter
+    def response_cache(self, value):
+        self._response_cache = value
+
+    @property
+    def rate_limiter(self):
+        if self._rate_limiter is None:
+            return default_rate_limiter()
+        return self._rate_limiter
+
+    @rate_limiter.setter
+    def rate_limiter(self, value):
+        self._rate_limiter = value
+
+    # lower values are sent first when requests have to wait
+    @property
+    def request_priority(self):
+        return 0
+
+    def _reddit_get(self, url, **kwargs):
+        with default_metrics().stage('http'):
+            return self.rate_limiter.get(self.http_pool, url, priority = self.request_priority, **kwargs)
+
+    # a GET whose parsed result comes from the response cache when possible
+    def _reddit_get_parsed(self, url, parse, headers, params = None):
+        def get(cache_headers):
+            all_headers = dict(headers, **cache_headers)
+            return self._reddit_get(url, headers = all_headers, params = params)
+
+        # a 200 that is not a listing, e.g. a maintenance page, fails like
+        # any other request instead of the whole poll cycle
+        def checked_parse(r):
+            try:
+                return parse(r)
+            except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                raise RedditRequestError('{} returned no listing: {!r}'.format(url, e))
+
+        return self.response_cache.fetch(ResponseCache.key(url, params), get, checked_parse)
+
+# decodes a json response body straight from its bytes, unlike
+# requests.Response.json() this never guesses the text encoding first
+def parse_json(response):
+    with default_metrics().stage('parse'):
+        return json.loads(response.content)
+
 # model definitions -- the standard "pattern" is to define a base model class
 # that specifies which database to use.  then, any subclasses will automatically
 # use the correct storage.
@@ -63,29 +1762,31 @@ class BaseModel(Model):
             print(record)
 
 # TODO: Add generalized RedditGetRequest class
-class RedditGetRequest:
-    def __init__(self, url):
+class RedditGetRequest(UsesRedditAPI):
+    def __init__(self, url, params = None):
         self._url = url
+        self._params = params
 
     @property
     def items(self):
+        return self.get_items(self._params)
+
+    def get_items(self, params = None):
         headers = {
                 'User-Agent': self.user_agent
             }
 
-        # TODO: figure out how to include params
-        r = requests.get(self.url + '.json', headers = headers)
+        query = urllib.parse.urlencode(params) if params else None
+        result_posts = self._reddit_get_parsed(self.url + '.json', self._parse, headers, params = query)
+        return list(result_posts)
+
+    def _parse(self, r):
         # TODO: come up with a less primitive way of determining if the json
         #     result is a post or search
-        json_data = r.json() # contains a list of dicts, with each dict containing a result post's data
+        json_data = parse_json(r) # contains a list of dicts, with each dict containing a result post's data
         listing = self._first_listing(json_data)
         item_list = listing['data']['children'] # contains a list of dicts, with each dict containing a result post's data
-
-        result_posts = []
-        for item_data in item_list:
-            result_posts.append(RedditPost.decode(item_data))
-
-        return result_posts
+        return RedditPost.decode_children(item_list)
 
     @property
     def url(self):
@@ -101,7 +1802,7 @@ class RedditGetRequest:
             return json_data[0]
         return json_data # otherwise this IS a listing
 
-class RedditSearch:
+class RedditSearch(UsesRedditAPI):
     _reddit_search_url = 'https://reddit.com/search'
     _reddit_json_search = _reddit_search_url + '.json'
 
@@ -112,23 +1813,32 @@ class RedditSearch:
         self.query = query
 
     def result(self, limit = None, print_search_url=False, print_json_result=False):
+        return self.result_page(limit = limit, print_search_url = print_search_url, \
+                print_json_result = print_json_result).posts
+
+    # one page of results, 'before' and 'after' are reddit fullnames that the
+    # page should start after or end before
+    def result_page(self, limit = None, before = None, after = None, \
+            print_search_url=False, print_json_result=False):
         headers = {
                 'User-Agent': self.user_agent
             }
-        payload = self.params(limit = limit)
         # print(self.query)
-
-        r = requests.get(self._reddit_json_search, headers = headers, params = self.query_string(payload))
-        json_data = r.json()['data']['children'] # contains a list of dicts, with each dict containing a result post's data
-        # if print_search_url: print(r.url) # print json search url
         if print_search_url: print(self.reddit_url) # print human-readable search url
-        if print_json_result: print(json.dumps(json_data, indent=2))
 
-        result_posts = []
-        for item_data in json_data:
-            result_posts.append(RedditPost.decode(item_data))
+        def parse(r):
+            listing_data = parse_json(r)['data']
+            json_data = listing_data['children'] # contains a list of dicts, with each dict containing a result post's data
+            # if print_search_url: print(r.url) # print json search url
+            if print_json_result: print(json.dumps(json_data, indent=2))
+
+            result_posts = RedditPost.decode_children(json_data)
+            return RedditListing(result_posts, listing_data.get('before'), listing_data.get('after'))
 
-        return result_posts
+        params = self.params_string(limit = limit, before = before, after = after)
+        listing = self._reddit_get_parsed(self._reddit_json_search, parse, headers, params = params)
+        # copy the posts so that callers can not change the cached listing
+        return RedditListing(list(listing.posts), listing.before, listing.after)
 
     # returns None if there is no result
     def first_result(self):
@@ -137,9 +1847,19 @@ class RedditSearch:
             return None
         return result[0]
 
+    # the posts a poll cycle should consider, the default is just the result
+    def poll(self):
+        return self.result(print_search_url=False, print_json_result=False)
+
+    # awaitable version of result(), the blocking request runs in the executor
+    async def result_async(self, limit = None, executor = None):
+        import asyncio
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, lambda: self.result(limit = limit))
+
     @property
     def reddit_url(self):
-        return _reddit_search_url + self.query_string(self.params())
+        return self._reddit_search_url + '?' + self.params_string()
 
     @property
     def user_agent(self):
@@ -154,27 +1874,92 @@ class RedditSearch:
         return self._sort
 
     # if sort is redefined in a subclass, it changes the sorting method
-    def params(self, limit = None):
+    def params(self, limit = None, before = None, after = None):
         if limit is None: limit = self.def_search_limit
-        return {
+        params = {
                 'limit': limit,
                 'q': self.query,
                 'sort': self.sort,
                 'type': 'link'
             }
+        if before is not None: params['before'] = before
+        if after is not None: params['after'] = after
+        return params
 
     @staticmethod
     def query_string(params):
         # custom encode the params to make the query string shorter
         return urllib.parse.urlencode(params, safe='()')
 
+    # the query as it appears in the query string
+    @property
+    def encoded_query(self):
+        return encode_query(self.query)
+
+    # the same string as query_string(params(...)), but the query is taken
+    # from encoded_query, which RedditWatchedSearch stores in the database
+    def params_string(self, limit = None, before = None, after = None):
+        parts = []
+        for key, value in self.params(limit = limit, before = before, after = after).items():
+            if key == 'q':
+                parts.append('q=' + self.encoded_query)
+            else:
+                parts.append(key + '=' + encode_query(str(value)))
+        return '&'.join(parts)
+
     def __eq__(self, other):
         if isinstance(self, other.__class__):
             return self.query == other.query
         return False
 
     def __hash__(self):
-        return 1
+        return hash(self.query)
+
+def encode_query(query):
+    return urllib.parse.quote_plus(query, safe = '()')
+
+# the posts newer than the cursor, newest first. 'fetch_page(before)'
+# returns the page of posts just newer than 'before', or the newest page for
+# None, newest first. Reddit answers 'before' with an empty page when the
+# cursor's post was removed, so the newest page comes first: usually it has
+# the cursor and is the only request. Otherwise this pages from the cursor
+# towards the newest post until a page comes back short. Returns (posts,
+# found), with found False and the newest page as posts if the cursor's
+# post is gone.
+def fetch_newer_posts(fetch_page, cursor, page_limit, max_pages):
+    newest = fetch_page(None)
+    for i, post in enumerate(newest):
+        if post.post_id == cursor:
+            return newest[:i], True
+    if len(newest) < page_limit:
+        return newest, False
+
+    posts = []
+    before = cursor
+    for _ in range(max_pages):
+        page = fetch_page(before)
+        # every page is newer than the pages before it
+        posts = page + posts
+        if len(page) < page_limit or page[0].post_id is None:
+            break
+        before = page[0].post_id
+    if len(posts) == 0:
+        return newest, False
+    return posts, True
+
+# the fullname of the newest post with one, or 'default' if there is none
+def newest_fullname(posts, default = None):
+    for post in posts:
+        if post.post_id is not None:
+            return post.post_id
+    return default
+
+# a page of posts and the fullnames reddit gives to fetch its neighbours
+class RedditListing:
+    def __init__(self, posts, before = None, after = None):
+        self.posts  = posts
+        self.before = before
+        self.after  = after
 
 class RedditWatchedSearch(BaseModel, RedditSearch):
     uuid            = UUIDField()
@@ -182,23 +1967,216 @@ class RedditWatchedSearch(BaseModel, RedditSearch):
     query           = TextField()
     user_agent_base = TextField()
     last_run_utc    = TimestampField()
+    # fullname of the newest post seen so far, None before the first poll
+    last_seen_fullname = TextField(null = True)
+    # seconds between polls in daemon mode, and when the next one is due
+    poll_interval   = IntegerField(default = DEFAULT_POLL_INTERVAL)
+    # deals of an urgent search are pushed right away instead of in a digest
+    urgent          = BooleanField(default = False)
+    next_poll_utc   = TimestampField(null = True, index = True)
+    # encode_query(query), so that polling never encodes the query again.
+    # None in rows from before the column existed.
+    encoded_query   = TextField(null = True)
+    # posts over max_price, under min_percent_off or without every one of the
+    # comma separated required_keywords are not pushed, see DealFilter
+    max_price         = FloatField(null = True)
+    min_percent_off   = FloatField(null = True)
+    required_keywords = TextField(null = True)
+    # times of day, see DailyWindows, in the IANA timezone (UTC if None). A
+    # search is only polled in its active_hours, its deals found in
+    # quiet_hours are pushed together once they end, and a cadence like
+    # '18:00-23:00=60' polls it at least every 60 seconds in that window.
+    timezone          = TextField(null = True)
+    active_hours      = TextField(null = True)
+    quiet_hours       = TextField(null = True)
+    cadence           = TextField(null = True)
 
     # override the superclass limit and sort, used in RedditSearch.params()
     _def_search_limit = 10
     _sort = 'new'
 
+    # reddit returns at most 100 posts per page, stop paging after _max_pages
+    _page_limit = 100
+    _max_pages = 10
+
     class Meta:
         table_name = 'searches'
 
+    # only fetch the posts newer than the cursor, paging towards the newest
+    # post until a page comes back short. Before the first cursor exists, the
+    # newest page is filtered by last_run_utc instead. Moves the cursor to the
+    # newest post, but does not save it.
+    def poll(self):
+        cursor = self.last_seen_fullname
+        if cursor is None:
+            posts, found = self.result(), False
+        else:
+            fetch_page = lambda before: self.result_page(limit = self._page_limit, before = before).posts
+            posts, found = fetch_newer_posts(fetch_page, cursor, self._page_limit, self._max_pages)
+        if not found:
+            # the first poll, or the cursor's post was removed: the posts
+            # since the last run, and the cursor moves to the newest post
+            newest = posts
+            posts = list(itertools.takewhile(lambda post: post.posted_utc >= self.last_run_utc, newest))
+            if cursor is not None: cursor = newest_fullname(newest, cursor)
+
+        self.last_seen_fullname = newest_fullname(posts, cursor)
+        return posts
+
     # redefine the user agent such that each search has a different one
     @property
     def user_agent(self):
         return USER_AGENT_BEG + self.user_agent_base + '_' + USER_AGENT_END
 
+    def params_string(self, limit = None, before = None, after = None):
+        if self.encoded_query is None: self.encoded_query = encode_query(self.query)
+        return super().params_string(limit = limit, before = before, after = after)
+
+    def save(self, *args, **kwargs):
+        self.encoded_query = encode_query(self.query)
+        return super().save(*args, **kwargs)
+
+    # the fields that rebuild this search in another process
+    def poll_fields(self):
+        return {f.name: getattr(self, f.name) for f in self._meta.sorted_fields}
+
     def __str__(self):
         return '{self.uuid!s} {self.user_agent_base}'.format(self=self)
 
-    def __eq__(self):
+    # the searches that are due soonest get to send their requests first
+    @property
+    def request_priority(self):
+        if self.next_poll_utc is None:
+            return 0
+        return self.next_poll_utc.timestamp()
+
+    # halve the interval of a search that had hits, and back off a quiet one.
+    # In a cadence window the search waits at most the window's seconds,
+    # times 'speedup' (see budget_speedup), and the next poll never falls
+    # outside the active hours.
+    def reschedule(self, hits, now, speedup = 1.0):
+        interval = self.poll_interval or DEFAULT_POLL_INTERVAL
+        if hits > 0:
+            interval = interval * POLL_SPEEDUP
+        else:
+            interval = interval * POLL_BACKOFF
+        self.poll_interval = int(min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, interval)))
+
+        delay = self.poll_interval
+        cadence = self._windows(self.cadence)
+        if cadence is not None:
+            window_interval = cadence.value_at(now)
+            if window_interval is not None:
+                delay = max(MIN_POLL_INTERVAL, min(delay, window_interval) * speedup)
+        next_poll = now + timedelta(seconds = delay)
+        if cadence is not None:
+            # a window that starts earlier brings the poll forward
+            next_poll = min(next_poll, cadence.next_start(now))
+        self.next_poll_utc = self.next_active(next_poll)
+
+    def is_active(self, now):
+        active = self._windows(self.active_hours)
+        return active is None or active.contains(now)
+
+    # 'now' if the search is active then, otherwise when it next becomes active
+    def next_active(self, now):
+        active = self._windows(self.active_hours)
+        if active is None or active.contains(now):
+            return now
+        return active.next_start(now)
+
+    # when the quiet hours that 'now' is in end, None if it is in none
+    def quiet_end(self, now):
+        quiet = self._windows(self.quiet_hours)
+        return None if quiet is None else quiet.end(now)
+
+    def _windows(self, spec):
+        if not spec:
+            return None
+        return daily_windows(spec, self.timezone)
+
+    # the factor that the delays of the searches in a cadence window are
+    # multiplied with, so that together with the other active searches they
+    # use POLL_BUDGET_SHARE of 'per_minute' polls. 1 when there is nothing
+    # to spare or no search is in a cadence window.
+    @classmethod
+    def budget_speedup(cls, now, per_minute = REDDIT_REQUESTS_PER_MINUTE):
+        if not cls.select().where(cls.cadence.is_null(False) & (cls.cadence != '')).exists():
+            return 1.0
+        demand = peak = 0.0
+        query = cls.select(cls.poll_interval, cls.timezone, cls.active_hours, cls.cadence)
+        for s in query:
+            if not s.is_active(now):
+                continue
+            interval = s.poll_interval or DEFAULT_POLL_INTERVAL
+            cadence = s._windows(s.cadence)
+            window_interval = None if cadence is None else cadence.value_at(now)
+            if window_interval is not None:
+                rate = 60.0 / max(MIN_POLL_INTERVAL, min(interval, window_interval))
+                peak += rate
+            else:
+                rate = 60.0 / max(MIN_POLL_INTERVAL, interval)
+            demand += rate
+        spare = per_minute * POLL_BUDGET_SHARE - demand
+        if peak == 0 or spare <= 0:
+            return 1.0
+        return peak / (peak + spare)
+
+    # poll again soon without changing the interval, e.g. after a failed push
+    def retry_soon(self, now):
+        self.next_poll_utc = now + timedelta(seconds = MIN_POLL_INTERVAL)
+
+    # the searches that are due at 'now', including ones never polled
+    @classmethod
+    def due(cls, now):
+        return cls.select().where(cls.next_poll_utc.is_null() | (cls.next_poll_utc <= now))
+
+    # the searches that are due at 'now', read SQLITE_BATCH_SIZE rows at a
+    # time by id so that they never all have to be in memory
+    @classmethod
+    def iter_due(cls, now, due_only = True):
+        last_id = 0
+        while True:
+            query = cls.select().where(cls.id > last_id)
+            if due_only:
+                query = query.where(cls.next_poll_utc.is_null() | (cls.next_poll_utc <= now))
+            batch = list(query.order_by(cls.id).limit(SQLITE_BATCH_SIZE))
+            yield from batch
+            if len(batch) < SQLITE_BATCH_SIZE:
+                return
+            last_id = batch[-1].id
+
+    # the earliest next_poll_utc of all searches, None if there are none
+    @classmethod
+    def next_due_utc(cls):
+        # sqlite sorts nulls first, and a search never polled is due already
+        first = cls.select(cls.next_poll_utc).order_by(cls.next_poll_utc.asc()).first()
+        if first is None:
+            return None
+        if first.next_poll_utc is None:
+            return datetime.utcfromtimestamp(0)
+        return first.next_poll_utc
+
+    # write the run time and cursor of many searches in one bulk update
+    @classmethod
+    def save_poll_state(cls, searches, last_run_utc):
+        for s in searches:
+            s.last_run_utc = last_run_utc
+        cls._bulk_save(searches, [cls.last_run_utc, cls.last_seen_fullname])
+
+    @classmethod
+    def save_schedule(cls, searches):
+        cls._bulk_save(searches, [cls.poll_interval, cls.next_poll_utc])
+
+    @classmethod
+    def _bulk_save(cls, searches, fields):
+        # each row binds an id plus two parameters per field
+        batch_size = SQLITE_BATCH_SIZE // (1 + 2 * len(fields))
+        with cls._meta.database.atomic():
+            for batch in batched(searches, batch_size):
+                cls.bulk_update(batch, fields = fields)
+
+    def __eq__(self, other):
         if isinstance(self, other.__class__):
             return RedditSearch.__eq__(self, other) \
                     and self.uuid == other.uuid \
@@ -207,7 +2185,1032 @@ class RedditWatchedSearch(BaseModel, RedditSearch):
                     and self.last_run_utc == other.last_run_utc
         return False
 
+    # only hash the fields that do not change between runs
+    def __hash__(self):
+        return hash((self.uuid, self.query))
+
+_DAILY_WINDOW = re.compile(r'^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*(?:=\s*(\d+)\s*)?$')
+
+# windows of time that repeat every day, e.g. '08:00-12:00, 18:00-02:00' in
+# a timezone, where a window that ends before it starts runs past midnight.
+# A window can carry a number of seconds, e.g. '18:00-23:00=60'. Times go in
+# and come out as naive utc datetimes, like everywhere else.
+class DailyWindows:
+    def __init__(self, spec, timezone_name = None):
+        self.windows = [] # (start minute, end minute, value)
+        for part in spec.split(','):
+            m = _DAILY_WINDOW.match(part)
+            if m is None:
+                raise ValueError("expected 'HH:MM-HH:MM' or 'HH:MM-HH:MM=SECONDS', got {!r}".format(part.strip()))
+            start_h, start_m, end_h, end_m = (int(g) for g in m.groups()[:4])
+            if max(start_h, end_h) > 24 or max(start_m, end_m) > 59:
+                raise ValueError('{!r} is not a time of day'.format(part.strip()))
+            start, end = start_h * 60 + start_m, end_h * 60 + end_m
+            if start % 1440 == end % 1440:
+                raise ValueError('{!r} is empty'.format(part.strip()))
+            self.windows.append((start, end, None if m.group(5) is None else int(m.group(5))))
+
+        if timezone_name is None:
+            self.tz = timezone.utc
+        else:
+            import zoneinfo
+            try:
+                self.tz = zoneinfo.ZoneInfo(timezone_name)
+            except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+                raise ValueError('unknown timezone {!r}'.format(timezone_name))
+
+    def contains(self, now):
+        return self._window_at(now) is not None
+
+    # the value of the window 'now' is in, None outside the windows
+    def value_at(self, now):
+        window = self._window_at(now)
+        return None if window is None else window[2]
+
+    # when the window 'now' is in ends, None outside the windows
+    def end(self, now):
+        window = self._window_at(now)
+        return None if window is None else self._utc(window[1])
+
+    # the first start of a window after 'now'
+    def next_start(self, now):
+        local = self._local(now)
+        day = datetime(local.year, local.month, local.day)
+        starts = [day + timedelta(days = days, minutes = start) \
+                for days in (0, 1) for start, _, _ in self.windows]
+        return self._utc(min(start for start in starts if start > local))
+
+    # (local start, local end, value) of the window 'now' is in
+    def _window_at(self, now):
+        local = self._local(now)
+        day = datetime(local.year, local.month, local.day)
+        for start, end, value in self.windows:
+            for days in (-1, 0):
+                window_start = day + timedelta(days = days, minutes = start)
+                window_end = window_start + timedelta(minutes = (end - start) % 1440)
+                if window_start <= local < window_end:
+                    return window_start, window_end, value
+        return None
+
+    def _local(self, utc):
+        return utc.replace(tzinfo = timezone.utc).astimezone(self.tz).replace(tzinfo = None)
+
+    def _utc(self, local):
+        return local.replace(tzinfo = self.tz).astimezone(timezone.utc).replace(tzinfo = None)
+
+@functools.lru_cache(maxsize = 1024)
+def daily_windows(spec, timezone_name = None):
+    return DailyWindows(spec, timezone_name)
+
+# when a deal found at 'now' may be pushed: None right away, or the end of
+# the quiet hours that every search that hit it is in
+def quiet_until(searches, now):
+    ends = []
+    for s in searches:
+        quiet_end = getattr(s, 'quiet_end', None)
+        end = None if quiet_end is None else quiet_end(now)
+        if end is None:
+            return None
+        ends.append(end)
+    return min(ends) if len(ends) > 0 else None
+
+class SearchImportError(ValueError):
+    pass
+
+# the columns of an exported search, and what an imported one may give
+SEARCH_EXPORT_FIELDS = ('uuid', 'title', 'query', 'user_agent_base', 'poll_interval', 'urgent', \
+        'max_price', 'min_percent_off', 'required_keywords', 'timezone', 'active_hours', 'quiet_hours', 'cadence')
+
+# reads searches from a json list of objects or a csv file with a header row
+def read_searches(f, format = 'json'):
+    if format == 'json':
+        rows = json.load(f)
+        if isinstance(rows, dict): rows = rows.get('searches')
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise SearchImportError('expected a list of searches')
+        return rows
+    if format == 'csv':
+        import csv
+        # empty cells mean the field is not given
+        return [{k: v for k, v in row.items() if v not in (None, '')} for row in csv.DictReader(f)]
+    raise ValueError('unknown format {!r}'.format(format))
+
+# validates every row before writing any of them, then inserts and updates
+# them all in one transaction. A row whose uuid is already in the database
+# replaces that search, every other row is a new search. Returns the number
+# of (inserted, updated) searches.
+def import_searches(rows, now = None):
+    if now is None: now = datetime.utcnow()
+    searches, errors = [], []
+    for line, row in enumerate(rows, 1):
+        try:
+            searches.append(_search_from_row(row, now))
+        except KeyError as e:
+            errors.append('search {}: no {}'.format(line, e))
+        except (TypeError, ValueError) as e:
+            errors.append('search {}: {}'.format(line, e))
+    if len(errors) > 0:
+        raise SearchImportError('\n'.join(errors))
+
+    uuids = [s.uuid for s in searches]
+    if len(set(uuids)) != len(uuids):
+        raise SearchImportError('the same uuid is given more than once')
+
+    cls = RedditWatchedSearch
+    with cls._meta.database.atomic():
+        existing = {}
+        for batch in batched(uuids):
+            existing.update((s.uuid, s.id) for s in cls.select(cls.id, cls.uuid).where(cls.uuid.in_(batch)))
+        new = [s for s in searches if s.uuid not in existing]
+        changed = [s for s in searches if s.uuid in existing]
+
+        fields = [cls.uuid, cls.title, cls.query, cls.user_agent_base, cls.last_run_utc, \
+                cls.poll_interval, cls.urgent, cls.encoded_query, \
+                cls.max_price, cls.min_percent_off, cls.required_keywords, \
+                cls.timezone, cls.active_hours, cls.quiet_hours, cls.cadence]
+        rows = [[getattr(s, f.name) for f in fields] for s in new]
+        for batch in batched(rows, SQLITE_BATCH_SIZE // len(fields)):
+            cls.insert_many(batch, fields = fields).execute()
+
+        for s in changed:
+            s.id = existing[s.uuid]
+        cls._bulk_save(changed, [cls.title, cls.query, cls.user_agent_base, \
+                cls.poll_interval, cls.urgent, cls.encoded_query, \
+                cls.max_price, cls.min_percent_off, cls.required_keywords, \
+                cls.timezone, cls.active_hours, cls.quiet_hours, cls.cadence])
+    return len(new), len(changed)
+
+def _search_from_row(row, now):
+    title, query = str(row['title']).strip(), str(row['query']).strip()
+    if title == '':
+        raise ValueError('empty title')
+    # only what reddit itself can not search is rejected, a query that the
+    # local matcher can not parse is searched on reddit instead
+    if query == '':
+        raise ValueError('empty query')
+    if len(query) > REDDIT_MAX_QUERY_LENGTH:
+        raise ValueError('the query is longer than the {} characters reddit takes'.format(REDDIT_MAX_QUERY_LENGTH))
+    urgent = row.get('urgent', False)
+    if isinstance(urgent, str):
+        if urgent.lower() not in ('true', 'false', '1', '0', 'yes', 'no'):
+            raise ValueError("'urgent' must be true or false, got {!r}".format(urgent))
+        urgent = urgent.lower() in ('true', '1', 'yes')
+    poll_interval = int(row.get('poll_interval', DEFAULT_POLL_INTERVAL))
+    if poll_interval <= 0:
+        raise ValueError("'poll_interval' must be positive")
+    thresholds = {}
+    for field in ('max_price', 'min_percent_off'):
+        value = row.get(field)
+        thresholds[field] = None if value is None else float(value)
+    keywords = row.get('required_keywords')
+    if isinstance(keywords, list): keywords = ', '.join(keywords)
+    schedule = {field: row.get(field) or None for field in ('timezone', 'active_hours', 'quiet_hours', 'cadence')}
+    # raises ValueError for a bad timezone or window
+    if schedule['timezone'] is not None: daily_windows('00:00-01:00', schedule['timezone'])
+    for field in ('active_hours', 'quiet_hours', 'cadence'):
+        if schedule[field] is None:
+            continue
+        windows = daily_windows(schedule[field], schedule['timezone']).windows
+        if field == 'cadence' and any(value is None for _, _, value in windows):
+            raise ValueError("every window of 'cadence' needs '=SECONDS'")
+        if field != 'cadence' and any(value is not None for _, _, value in windows):
+            raise ValueError("the windows of '{}' take no '=SECONDS'".format(field))
+    return RedditWatchedSearch(
+            uuid = uuid.UUID(str(row['uuid'])) if 'uuid' in row else uuid.uuid4(),
+            title = title,
+            query = query,
+            user_agent_base = row.get('user_agent_base') or re.sub(r'\W+', '_', title.lower()),
+            # the first poll only pushes posts from after the import
+            last_run_utc = now,
+            poll_interval = poll_interval,
+            urgent = bool(urgent),
+            encoded_query = encode_query(query),
+            required_keywords = keywords or None,
+            **thresholds,
+            **schedule
+        )
+
+# writes every search as a json list of objects or a csv file with a header
+# row, either of which import_searches() reads back
+def export_searches(f, format = 'json'):
+    cls = RedditWatchedSearch
+    rows = ({f: getattr(s, f) for f in SEARCH_EXPORT_FIELDS} for s in cls.iter_due(None, due_only = False))
+    if format == 'json':
+        f.write('[')
+        for i, row in enumerate(rows):
+            row['uuid'] = str(row['uuid'])
+            f.write(('\n  ' if i == 0 else ',\n  ') + json.dumps(row))
+        f.write('\n]\n')
+    elif format == 'csv':
+        import csv
+        writer = csv.DictWriter(f, SEARCH_EXPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        raise ValueError('unknown format {!r}'.format(format))
+
+# split a sequence into lists of at most 'size' items
+def batched(items, size = SQLITE_BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+# the posts that were already pushed, keyed by RedditPost.dedup_key. Every
+# lookup and write is done in batches, one query per batch of keys.
+class SeenPost(BaseModel):
+    post_key = TextField(primary_key = True)
+    seen_utc = TimestampField(index = True)
+
+    class Meta:
+        table_name = 'seen_posts'
+
+    @classmethod
+    def seen_keys(cls, keys):
+        seen = set()
+        for batch in batched(set(keys)):
+            query = cls.select(cls.post_key).where(cls.post_key.in_(batch))
+            seen.update(key for (key,) in query.tuples())
+        return seen
+
+    @classmethod
+    def mark_seen(cls, keys, seen_utc = None):
+        if seen_utc is None: seen_utc = datetime.utcnow()
+        with cls._meta.database.atomic():
+            for batch in batched(set(keys)):
+                rows = [{'post_key': k, 'seen_utc': seen_utc} for k in batch]
+                cls.insert_many(rows).on_conflict_replace().execute()
+
+    # forget the posts seen before 'older_than', returns how many were removed
+    @classmethod
+    def prune(cls, older_than):
+        return cls.delete().where(cls.seen_utc < older_than).execute()
+
+# every deal that was queued for pushing, with the searches that hit it
+class ArchivedDeal(BaseModel):
+    post_key     = TextField(unique = True) # RedditPost.dedup_key
+    title        = TextField()
+    url          = TextField()
+    domain       = TextField(null = True)
+    posted_utc   = TimestampField(index = True)
+    archived_utc = TimestampField()
+    # cluster_fields() of the deal, '' for a url of None. Rows from before
+    # these columns are hashed when DealClusters loads them.
+    signature    = BlobField(null = True)
+    match_url    = TextField(null = True)
+
+    class Meta:
+        table_name = 'deals'
+        indexes = (
+            (('domain', 'posted_utc'), False),
+        )
+
+    # the archived deals newest first, a page of at most 'limit'. 'search' is
+    # a search title, 'text' a full text query on the titles (FTS5 syntax)
+    # and 'domain' a host without www. Pass the cursor of a page's last deal
+    # as 'before' to get the next page. The search titles of the page are
+    # read with one more query.
+    @classmethod
+    def query(cls, search = None, text = None, domain = None, since = None, until = None, \
+            before = None, limit = ARCHIVE_PAGE_SIZE):
+        query = cls._filtered(search, text, domain, since, until)
+        # the index of the table that is filtered on also gives the order
+        posted, deal_id = cls.posted_utc, cls.id
+        if search is not None:
+            posted, deal_id = ArchivedDealSearch.posted_utc, ArchivedDealSearch.deal
+        if before is not None:
+            before_utc, before_id = parse_archive_cursor(before)
+            query = query.where((posted < before_utc) | ((posted == before_utc) & (deal_id < before_id)))
+        deals = list(query.order_by(posted.desc(), deal_id.desc()).limit(limit))
+
+        titles = {}
+        for batch in batched(deal.id for deal in deals):
+            links = ArchivedDealSearch.select(ArchivedDealSearch.deal, ArchivedDealSearch.search_title) \
+                    .where(ArchivedDealSearch.deal.in_(batch)).tuples()
+            for deal_id, search_title in links:
+                titles.setdefault(deal_id, []).append(search_title)
+        for deal in deals:
+            deal._search_titles = sorted(titles.get(deal.id, []))
+        return deals
+
+    @classmethod
+    def count_matching(cls, search = None, text = None, domain = None, since = None, until = None):
+        return cls._filtered(search, text, domain, since, until).count()
+
+    @classmethod
+    def _filtered(cls, search, text, domain, since, until):
+        query = cls.select()
+        posted = cls.posted_utc
+        if search is not None:
+            query = query.join(ArchivedDealSearch).where(ArchivedDealSearch.search_title == search)
+            posted = ArchivedDealSearch.posted_utc
+        if text is not None:
+            titles = archived_deal_title()
+            matching = titles.select(titles.rowid).where(titles.match(text))
+            query = query.where(cls.id.in_(matching))
+        if domain is not None:
+            query = query.where(cls.domain == domain.lower())
+        if since is not None:
+            query = query.where(posted >= since)
+        if until is not None:
+            query = query.where(posted < until)
+        return query
+
+    @property
+    def cursor(self):
+        return '{}:{}'.format(int((self.posted_utc - datetime.utcfromtimestamp(0)).total_seconds()), self.id)
+
+    @property
+    def search_titles(self):
+        titles = self.__dict__.get('_search_titles')
+        if titles is None:
+            links = ArchivedDealSearch.select(ArchivedDealSearch.search_title).where(ArchivedDealSearch.deal == self)
+            titles = self._search_titles = sorted(link.search_title for link in links)
+        return titles
+
+    def __str__(self):
+        return '{} {} [{}] {}'.format(self.posted_utc.strftime('%Y-%m-%d %H:%M'), self.title, \
+                ', '.join(self.search_titles), self.url)
+
+# the searches that hit an archived deal, with the post time copied so that
+# one index answers 'the deals of this search in this time range'
+class ArchivedDealSearch(BaseModel):
+    deal         = ForeignKeyField(ArchivedDeal, backref = 'searches', on_delete = 'CASCADE')
+    search_uuid  = UUIDField()
+    search_title = TextField()
+    posted_utc   = TimestampField()
+
+    class Meta:
+        table_name = 'deal_searches'
+        indexes = (
+            (('deal', 'search_uuid'), True),
+            (('search_title', 'posted_utc', 'deal'), False),
+            (('search_uuid', 'posted_utc', 'deal'), False),
+        )
+
+# the model of the full text index of the archived titles, its rowid is the
+# ArchivedDeal id. It is made on first use, so that only the runs that
+# archive or search deals import playhouse.sqlite_ext.
+@functools.lru_cache(maxsize = None)
+def archived_deal_title():
+    from playhouse.sqlite_ext import FTS5Model, RowIDField, SearchField
+
+    class ArchivedDealTitle(FTS5Model):
+        rowid = RowIDField()
+        title = SearchField()
+
+        class Meta:
+            database = db
+            table_name = 'deal_titles'
+            options = {'tokenize': 'porter unicode61'}
+
+    return ArchivedDealTitle
+
+# parses the 'POSTED:ID' cursor of ArchivedDeal.cursor
+def parse_archive_cursor(cursor):
+    try:
+        posted, deal_id = (int(part) for part in cursor.split(':'))
+    except ValueError:
+        raise ValueError('expected a cursor like 1700000000:42, got {!r}'.format(cursor))
+    return datetime.utcfromtimestamp(posted), deal_id
+
+# the host of a url without a leading www., e.g. 'newegg.com'
+def url_domain(url):
+    host = urllib.parse.urlsplit(url.strip()).hostname
+    if host is None:
+        return None
+    return host[4:] if host.startswith('www.') else host
+
+# collects the deals of a cycle and writes them to the archive in batches
+class DealArchive:
+    def __init__(self):
+        self._deals = []
+
+    def add(self, deals, now):
+        self._deals.extend((deal, now) for deal in deals)
+
+    # writes the collected deals, returns how many were new to the archive
+    def write(self):
+        deals, self._deals = self._deals, []
+        if len(deals) == 0:
+            return 0
+        with ArchivedDeal._meta.database.atomic():
+            keys = list(OrderedDict.fromkeys(deal.dedup_key for deal, _ in deals))
+            archived = set()
+            for batch in batched(keys):
+                query = ArchivedDeal.select(ArchivedDeal.post_key).where(ArchivedDeal.post_key.in_(batch))
+                archived.update(row.post_key for row in query)
+
+            rows = OrderedDict()
+            for deal, now in deals:
+                if deal.dedup_key not in archived and deal.dedup_key not in rows:
+                    _, signature, match_url = cluster_fields(deal)
+                    rows[deal.dedup_key] = {
+                            'post_key': deal.dedup_key,
+                            'title': deal.title,
+                            'url': deal.url,
+                            'domain': url_domain(deal.url),
+                            'posted_utc': deal.posted_utc,
+                            'archived_utc': now,
+                            'signature': signature,
+                            'match_url': match_url or ''
+                        }
+            # eight parameters per row
+            for batch in batched(list(rows.values()), SQLITE_BATCH_SIZE // 8):
+                ArchivedDeal.insert_many(batch).execute()
+
+            ids = {}
+            for batch in batched(keys):
+                query = ArchivedDeal.select(ArchivedDeal.id, ArchivedDeal.post_key) \
+                        .where(ArchivedDeal.post_key.in_(batch))
+                ids.update((row.post_key, row.id) for row in query)
+
+            new_titles = [{'rowid': ids[key], 'title': row['title']} for key, row in rows.items()]
+            links = []
+            for deal, _ in deals:
+                deal_id = ids[deal.dedup_key]
+                for search in deal.searches:
+                    links.append({'deal': deal_id, 'search_uuid': search.uuid, \
+                            'search_title': search.title, 'posted_utc': deal.posted_utc})
+            for batch in batched(new_titles, SQLITE_BATCH_SIZE // 2):
+                archived_deal_title().insert_many(batch).execute()
+            for batch in batched(links, SQLITE_BATCH_SIZE // 4):
+                ArchivedDealSearch.insert_many(batch).on_conflict_ignore().execute()
+        return len(new_titles)
+
+    def __len__(self):
+        return len(self._deals)
+
+# polls many searches at once, with at most 'concurrency' requests in flight
+class RedditPoller:
+    streams = True # iter_results() yields each search as soon as it is done
+
+    def __init__(self, concurrency = POLL_CONCURRENCY):
+        if not isinstance(concurrency, int) or concurrency < 1:
+            raise ValueError("'concurrency' must be a positive int")
+        self.concurrency = concurrency
+        self.errors = {} # search -> RedditRequestError of the last results()
+
+    # returns a list with the polled posts of each search, in the same order
+    # as the given searches. A search whose request failed gets an empty list
+    # and its error in self.errors.
+    def results(self, searches):
+        searches = list(searches)
+        results = [None] * len(searches)
+        for i, _, posts in self._stream(searches):
+            results[i] = posts
+        return results
+
+    # yields (search, posts) for each search as it finishes, with at most
+    # 'concurrency' searches in flight. The next search is only started when
+    # the consumer asks for more, so a slow consumer slows the fetching down
+    # instead of piling up results. If no search finishes within 'timeout'
+    # seconds None is yielded. Failed searches get an empty list and their
+    # error in self.errors.
+    def iter_results(self, searches, timeout = None):
+        if not self.streams:
+            searches = list(searches)
+            yield from zip(searches, self.results(searches))
+            return
+        for result in self._stream(searches, timeout):
+            yield None if result is None else result[1:]
+
+    # yields (position, search, posts) as the searches finish, see iter_results()
+    def _stream(self, searches, timeout = None):
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        self.errors = {}
+        searches = enumerate(searches)
+        pending = {} # future -> (position, search)
+        executor = ThreadPoolExecutor(max_workers = self.concurrency)
+        try:
+            while True:
+                for i, search in itertools.islice(searches, self.concurrency - len(pending)):
+                    pending[executor.submit(self._poll_search, search)] = (i, search)
+                if len(pending) == 0:
+                    return
+                done, _ = wait(pending, timeout = timeout, return_when = FIRST_COMPLETED)
+                if len(done) == 0:
+                    yield None
+                for future in done:
+                    i, search = pending.pop(future)
+                    try:
+                        posts = future.result()
+                    except RedditRequestError as e:
+                        self.errors[search] = e
+                        posts = []
+                    yield i, search, posts
+        finally:
+            executor.shutdown(wait = True)
+
+    def _poll_search(self, search):
+        metrics = default_metrics()
+        start = time.perf_counter()
+        try:
+            return search.poll()
+        finally:
+            if metrics.enabled:
+                metrics.observe('reddit_watcher_search_seconds', time.perf_counter() - start, \
+                        search = metrics_label(search))
+
+    # called by poll_cycle in the transaction that saves the searches
+    def save_state(self):
+        pass
+
+    def close(self):
+        pass
+
+# consistent hashing of search uuids onto shards, so that changing the number
+# of shards only moves about 1/shards of the searches. The hash is stable
+# across processes and hosts, unlike hash() of a str.
+class HashRing:
+    def __init__(self, shards, replicas = SHARD_REPLICAS):
+        if not isinstance(shards, int) or shards < 1:
+            raise ValueError("'shards' must be a positive int")
+        self.shards = shards
+        points = sorted((self._hash('{}-{}'.format(shard, r)), shard) \
+                for shard in range(shards) for r in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def shard_of(self, key):
+        i = bisect.bisect(self._hashes, self._hash(str(key))) % len(self._hashes)
+        return self._owners[i]
+
+    # the searches split into one list per shard, keyed by their uuid
+    def split(self, searches):
+        parts = [[] for _ in range(self.shards)]
+        for s in searches:
+            parts[self.shard_of(s.uuid)].append(s)
+        return parts
+
+    def owned(self, shard, searches):
+        return [s for s in searches if self.shard_of(s.uuid) == shard]
+
+# polls each shard of the searches in its own worker process, which keeps its
+# own connections and a RateLimiter with 1/shards of the budget. The posts
+# come back to this process, so poll_cycle merges the deals of every shard
+# before anything is delivered.
+class ShardedPoller(RedditPoller):
+    streams = False
+
+    def __init__(self, shards, concurrency = POLL_CONCURRENCY, per_minute = None, \
+            http_pool_factory = HTTPPool):
+        super().__init__(concurrency = concurrency)
+        self.ring = HashRing(shards)
+        if per_minute is None: per_minute = max(1, REDDIT_REQUESTS_PER_MINUTE // shards)
+        self.per_minute = per_minute
+        # called in each worker for its HTTPPool, must be picklable
+        self.http_pool_factory = http_pool_factory
+        # one single process executor per shard pins each shard to a process
+        self._executors = [None] * shards
+
+    def results(self, searches):
+        searches = list(searches)
+        self.errors = {}
+        parts = self.ring.split(searches)
+        futures = [self._submit(shard, part) if len(part) > 0 else None \
+                for shard, part in enumerate(parts)]
+
+        from concurrent.futures.process import BrokenProcessPool
+        posts = {}
+        for shard, (part, future) in enumerate(zip(parts, futures)):
+            if future is None:
+                continue
+            try:
+                shard_results = future.result()
+            except BrokenProcessPool as e:
+                # the worker died, the next cycle starts a new one
+                self._executors[shard] = None
+                shard_results = [([], s.last_seen_fullname, 'worker failed: {!r}'.format(e)) for s in part]
+            for s, (fields, cursor, error) in zip(part, shard_results):
+                s.last_seen_fullname = cursor
+                if error is not None: self.errors[s] = RedditRequestError(error)
+                posts[s] = [RedditPost._from_fields(*f) for f in fields]
+        return [posts[s] for s in searches]
+
+    def _submit(self, shard, searches):
+        from concurrent.futures import ProcessPoolExecutor
+        if self._executors[shard] is None:
+            self._executors[shard] = ProcessPoolExecutor(max_workers = 1)
+        rows = [s.poll_fields() for s in searches]
+        return self._executors[shard].submit(_poll_shard, rows, self.concurrency, self.per_minute, \
+                self.http_pool_factory)
+
+    def close(self):
+        for executor in self._executors:
+            if executor is not None: executor.shutdown(wait = True)
+        self._executors = [None] * len(self._executors)
+
+_shard_worker_pid = None
+
+# runs in a ShardedPoller worker process, returns (post fields, cursor,
+# error message or None) for each search
+def _poll_shard(rows, concurrency, per_minute, http_pool_factory = HTTPPool):
+    global _shard_worker_pid
+    if _shard_worker_pid != os.getpid():
+        # a forked worker must not share the parent's connections
+        _shard_worker_pid = os.getpid()
+        set_default_http_pool(http_pool_factory())
+        set_default_response_cache(ResponseCache())
+        set_default_rate_limiter(RateLimiter(per_minute = per_minute, burst = min(REDDIT_BURST, per_minute)))
+
+    searches = [RedditWatchedSearch(**row) for row in rows]
+    poller = RedditPoller(concurrency = concurrency)
+    results = []
+    for s, posts in zip(searches, poller.results(searches)):
+        error = poller.errors.get(s)
+        results.append(([(p.title, p.url, p.posted_utc, p.post_id) for p in posts], \
+                s.last_seen_fullname, None if error is None else str(error)))
+    return results
+
+class QuerySyntaxError(ValueError):
+    pass
+
+# raised for a valid query that uses a field the local matcher does not know
+class QueryNotLocalError(ValueError):
+    pass
+
+# the parts of a post that queries are matched against, computed once per
+# post and shared by every matcher
+class PostText:
+    __slots__ = ('words', 'padded', 'url', 'domain', 'subreddit')
+
+    def __init__(self, post, subreddit = None):
+        tokens = _WORD.findall(post.title.lower())
+        self.words     = set(tokens)
+        self.padded    = ' ' + ' '.join(tokens) + ' '
+        self.url       = post.url.lower()
+        self.domain    = urllib.parse.urlsplit(self.url).netloc.split(':')[0]
+        self.subreddit = subreddit.lower() if subreddit else None
+
+_WORD = re.compile(r'\w+')
+_QUERY_TOKEN = re.compile(r'\s*(?:(\()|(\))|([^\s()":]+):"([^"]*)"|"([^"]*)"|([^\s()"]+))')
+_QUERY_OPERATORS = ('AND', 'OR', 'NOT')
+
+# a reddit search query compiled into a function of a PostText. Supports
+# AND, OR, NOT in any case, parentheses, quoted phrases, implicit AND between terms and
+# the title:, subreddit:, site: and url: fields. Words only match the title,
+# reddit's stemming and selftext matching are not reproduced.
+class CompiledQuery:
+    def __init__(self, query):
+        self.query = query
+        tree = _QueryParser(query).parse()
+        self.matches = _compile_node(tree)
+        # the subreddits the query is confined to, None if it is not
+        self.subreddits = _confining_subreddits(tree)
+
+    # a query can only be matched locally if it is confined to subreddits,
+    # one confined to none, e.g. 'subreddit:a subreddit:b', is left to reddit
+    @property
+    def is_local(self):
+        return self.subreddits is not None and len(self.subreddits) > 0
+
+@functools.lru_cache(maxsize = 4096)
+def compile_query(query):
+    return CompiledQuery(query)
+
+class _QueryParser:
+    def __init__(self, query):
+        self.tokens = self._tokenize(query)
+        self.pos = 0
+
+    @staticmethod
+    def _tokenize(query):
+        tokens = []
+        pos = 0
+        query = query.rstrip()
+        while pos < len(query):
+            m = _QUERY_TOKEN.match(query, pos)
+            if m is None:
+                raise QuerySyntaxError('unmatched quote in {!r}'.format(query))
+            pos = m.end()
+            if m.group(1): tokens.append(('(', None))
+            elif m.group(2): tokens.append((')', None))
+            elif m.group(3) is not None: tokens.append(('field', (m.group(3), m.group(4))))
+            elif m.group(5) is not None: tokens.append(('phrase', m.group(5)))
+            elif m.group(6).upper() in _QUERY_OPERATORS: tokens.append((m.group(6).upper(), None))
+            else: tokens.append(('term', m.group(6)))
+        return tokens
+
+    def parse(self):
+        if len(self.tokens) == 0:
+            raise QuerySyntaxError('empty query')
+        tree = self._or()
+        if self.pos != len(self.tokens):
+            raise QuerySyntaxError('unexpected {!r}'.format(self.tokens[self.pos][0]))
+        return tree
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][0]
+        return None
+
+    def _or(self):
+        children = [self._and()]
+        while self._peek() == 'OR':
+            self.pos += 1
+            children.append(self._and())
+        return children[0] if len(children) == 1 else ('or', children)
+
+    def _and(self):
+        children = [self._not()]
+        while self._peek() not in (None, 'OR', ')'):
+            if self._peek() == 'AND':
+                self.pos += 1
+            children.append(self._not())
+        return children[0] if len(children) == 1 else ('and', children)
+
+    def _not(self):
+        if self._peek() == 'NOT':
+            self.pos += 1
+            return ('not', self._not())
+        return self._primary()
+
+    def _primary(self):
+        kind = self._peek()
+        if kind is None:
+            raise QuerySyntaxError('query ends early')
+        value = self.tokens[self.pos][1]
+        self.pos += 1
+        if kind == '(':
+            tree = self._or()
+            if self._peek() != ')':
+                raise QuerySyntaxError('unclosed parenthesis')
+            self.pos += 1
+            return tree
+        if kind == 'phrase':
+            return ('term', 'title', value)
+        if kind == 'field':
+            # a field with a quoted value, e.g. title:"rtx 4070"
+            field, field_value = value
+            return ('term', field.lower(), field_value)
+        if kind == 'term':
+            field, sep, field_value = value.partition(':')
+            if sep and field and field_value:
+                return ('term', field.lower(), field_value)
+            return ('term', 'title', value)
+        raise QuerySyntaxError('unexpected {!r}'.format(kind))
+
+def _compile_node(node):
+    kind = node[0]
+    if kind == 'and':
+        children = [_compile_node(c) for c in node[1]]
+        return lambda text: all(c(text) for c in children)
+    if kind == 'or':
+        children = [_compile_node(c) for c in node[1]]
+        return lambda text: any(c(text) for c in children)
+    if kind == 'not':
+        child = _compile_node(node[1])
+        return lambda text: not child(text)
+    return _compile_term(node[1], node[2])
+
+def _compile_term(field, value):
+    value = value.lower()
+    if field == 'title':
+        words = _WORD.findall(value)
+        if len(words) == 0:
+            return lambda text: True # reddit ignores terms without words
+        if len(words) == 1:
+            word = words[0]
+            return lambda text: word in text.words
+        phrase = ' ' + ' '.join(words) + ' '
+        return lambda text: phrase in text.padded
+    if field == 'subreddit':
+        return lambda text: text.subreddit == value
+    if field == 'site':
+        return lambda text: text.domain == value or text.domain.endswith('.' + value)
+    if field == 'url':
+        return lambda text: value in text.url
+    raise QueryNotLocalError('the {}: field can not be matched locally'.format(field))
+
+def _confining_subreddits(node):
+    kind = node[0]
+    if kind == 'term':
+        return frozenset([node[2].lower()]) if node[1] == 'subreddit' else None
+    if kind == 'and':
+        confined = [_confining_subreddits(c) for c in node[1]]
+        confined = [c for c in confined if c is not None]
+        if len(confined) == 0:
+            return None
+        return frozenset.intersection(*confined)
+    if kind == 'or':
+        confined = [_confining_subreddits(c) for c in node[1]]
+        if any(c is None for c in confined):
+            return None
+        return frozenset.union(*confined)
+    return None
+
+# the /new listing of a subreddit, fetched from a cursor like a watched search
+class SubredditFeed(RedditGetRequest):
+    _first_limit = 25
+    _page_limit = 100
+    _max_pages = 10
+
+    def __init__(self, subreddit, cursor = None):
+        super().__init__('https://www.reddit.com/r/{}/new'.format(subreddit))
+        self.subreddit = subreddit.lower()
+        self.cursor = cursor
+        self.had_cursor = cursor is not None
+
+    # the posts newer than the cursor, newest first, moves the cursor
+    def poll(self):
+        if self.cursor is None:
+            posts = self.get_items({'limit': self._first_limit})
+        else:
+            cursor = self.cursor
+            fetch_page = lambda before: self.get_items({'limit': self._page_limit}) if before is None \
+                    else self.get_items({'limit': self._page_limit, 'before': before})
+            posts, found = fetch_newer_posts(fetch_page, cursor, self._page_limit, self._max_pages)
+            # the cursor's post was removed, the searches then filter the
+            # newest page by their last run as on the first poll
+            if not found: self.had_cursor = False
+        self.cursor = newest_fullname(posts, self.cursor)
+        return posts
+
+# the cursor of each subreddit feed polled in local matching mode
+class SubredditCursor(BaseModel):
+    subreddit          = TextField(primary_key = True)
+    last_seen_fullname = TextField(null = True)
+
+    class Meta:
+        table_name = 'subreddit_cursors'
+
+# polls each subreddit once per cycle and matches every search confined to
+# it locally, so the number of requests scales with subreddits and not with
+# searches. Searches that can not be matched locally are searched on reddit.
+class LocalMatchPoller(RedditPoller):
+    streams = False # a feed's posts are matched against all of its searches at once
+
+    def __init__(self, concurrency = POLL_CONCURRENCY):
+        super().__init__(concurrency = concurrency)
+        self._feeds = {} # subreddit -> SubredditFeed of the last results()
+
+    @staticmethod
+    def local_query(search):
+        try:
+            compiled = compile_query(search.query)
+        except ValueError:
+            return None
+        return compiled if compiled.is_local else None
+
+    # the searches plus every other local search that shares a subreddit
+    # with them, since polling a subreddit moves its cursor for all of them
+    def expand(self, searches, all_searches):
+        searches = list(searches)
+        subreddits = set()
+        for s in searches:
+            compiled = self.local_query(s)
+            if compiled is not None: subreddits |= compiled.subreddits
+        chosen = set(searches)
+        for s in all_searches:
+            compiled = self.local_query(s)
+            if s not in chosen and compiled is not None and compiled.subreddits & subreddits:
+                searches.append(s)
+                chosen.add(s)
+        return searches
+
+    def results(self, searches):
+        searches = list(searches)
+        compiled = {s: self.local_query(s) for s in searches}
+        remote = [s for s in searches if compiled[s] is None]
+        local = [s for s in searches if compiled[s] is not None]
+
+        posts = {}
+        remote_results = super().results(remote)
+        errors = dict(self.errors)
+        posts.update(zip(remote, remote_results))
+
+        # one feed per subreddit, matched against each of its searches
+        by_subreddit = {}
+        for s in local:
+            for sub in compiled[s].subreddits:
+                by_subreddit.setdefault(sub, []).append(s)
+            posts[s] = []
+        feeds = self._load_feeds(sorted(by_subreddit))
+        feed_results = super().results(feeds)
+        for feed, error in self.errors.items():
+            for s in by_subreddit[feed.subreddit]:
+                errors[s] = error
+
+        for feed, feed_posts in zip(feeds, feed_results):
+            group = [(s, compiled[s].matches) for s in by_subreddit[feed.subreddit] if s not in errors]
+            for post in feed_posts:
+                text = PostText(post, feed.subreddit)
+                for s, matches in group:
+                    # a feed without a cursor also has posts from before the
+                    # search's last run
+                    if not feed.had_cursor and post.posted_utc < s.last_run_utc:
+                        continue
+                    if matches(text):
+                        posts[s].append(post)
+
+        self.errors = errors
+        return [posts[s] for s in searches]
+
+    # feeds start from the saved cursors every cycle, so that a cycle that
+    # failed before saving does not skip posts
+    def _load_feeds(self, subreddits):
+        cursors = {}
+        for batch in batched(subreddits):
+            query = SubredditCursor.select().where(SubredditCursor.subreddit.in_(batch))
+            cursors.update((row.subreddit, row.last_seen_fullname) for row in query)
+        self._feeds = {sub: SubredditFeed(sub, cursors.get(sub)) for sub in subreddits}
+        return [self._feeds[sub] for sub in subreddits]
+
+    # saves the feed cursors, poll_cycle calls this in its transaction
+    def save_state(self):
+        rows = [{'subreddit': f.subreddit, 'last_seen_fullname': f.cursor} \
+                for f in self._feeds.values() if f.cursor is not None]
+        for batch in batched(rows, SQLITE_BATCH_SIZE // 2):
+            SubredditCursor.insert_many(batch).on_conflict_replace().execute()
+
+# keeps polling the searches that are due until it gets SIGINT or SIGTERM,
+# a cycle that has started is always finished before stopping
+class PollDaemon:
+    max_sleep = MIN_POLL_INTERVAL
+
+    def __init__(self, sinks, poller = None, print_pushes = True, metrics_file = None, shard = None):
+        self.sinks = sinks
+        self.poller = poller or RedditPoller(concurrency = POLL_CONCURRENCY)
+        self.delivery = PushDelivery(sinks, print_pushes = print_pushes)
+        self.metrics_file = metrics_file # the metrics are dumped here after each cycle
+        # (index, shards) of the searches this daemon polls, None for all
+        self.shard = shard
+        self._ring = HashRing(shard[1]) if shard is not None else None
+        self._stop = threading.Event()
+        self.clusters = None # loaded from the archive on the first cycle
+
+    def stop(self, *args):
+        self._stop.set()
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+    # runs until stopped, or for at most 'max_cycles' cycles with due searches
+    def run(self, max_cycles = None):
+        handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                handlers[signum] = signal.signal(signum, self.stop)
+        try:
+            self._run(max_cycles)
+        finally:
+            self.delivery.close()
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def _run(self, max_cycles):
+        cycles = 0
+        while not self.stopped:
+            due = self._owned(RedditWatchedSearch.due(datetime.utcnow()))
+            if len(due) > 0 and isinstance(self.poller, LocalMatchPoller):
+                due = self.poller.expand(due, RedditWatchedSearch.select())
+            if len(due) == 0:
+                # pushes that failed earlier are retried between cycles
+                self.delivery.flush()
+            else:
+                try:
+                    if self.clusters is None:
+                        self.clusters = DealClusters()
+                        self.clusters.load_recent(datetime.utcnow())
+                    poll_cycle(due, self.sinks, poller = self.poller, delivery = self.delivery, \
+                            clusters = self.clusters)
+                except Exception as e:
+                    # the searches stay due, so wait before trying them again
+                    print('Poll cycle failed: {!r}'.format(e))
+                    self._stop.wait(self.max_sleep)
+                cycles += 1
+                if self.metrics_file is not None:
+                    default_metrics().dump_json(self.metrics_file)
+                if max_cycles is not None and cycles >= max_cycles:
+                    break
+            self._stop.wait(self.seconds_until_due())
+
+    def _owned(self, searches):
+        if self._ring is None:
+            return list(searches)
+        return self._ring.owned(self.shard[0], searches)
+
+    # the next time one of this daemon's searches is due, None if there are none
+    def next_due_utc(self):
+        return next_due_utc(self.shard)
+
+    def seconds_until_due(self):
+        due_times = [self.next_due_utc(), self.delivery.next_attempt()]
+        due_times = [t for t in due_times if t is not None]
+        if len(due_times) == 0:
+            return self.max_sleep
+        next_due = min(due_times)
+        wait = (next_due - datetime.utcnow()).total_seconds()
+        return min(self.max_sleep, max(0, wait))
+
 class Pushable:
+    __slots__ = ()
+
     @property
     def push_title(self):
         raise NotImplementedError
@@ -239,14 +3242,69 @@ class Pushable:
         return False
 
     def __hash__(self):
-        return 1
+        return hash((self.push_title, self.push_body, self.push_url))
+
+# lowercase the scheme and host and drop the fragment and any trailing slash,
+# so that the same link written differently compares equal
+# query parameters that only track where a click came from, compared in
+# lower case. utm_ parameters are dropped as well.
+TRACKING_PARAMS = frozenset([
+        'fbclid', 'gclid', 'dclid', 'gbraid', 'wbraid', 'msclkid', 'yclid', 'igshid',
+        'mc_cid', 'mc_eid', '_hsenc', '_hsmi', 'ref', 'ref_', 'tag', 'ascsubtag',
+        'linkcode', 'linkid', 'creative', 'creativeasin', 'camp', 'cjevent',
+        'irclickid', 'irgwc', 'clickid', 'affid', 'aff_id'
+    ])
+
+def normalize_url(url):
+    parts = urllib.parse.urlsplit(url.strip())
+    path = parts.path.rstrip('/')
+    query = parts.query
+    if query != '':
+        params = urllib.parse.parse_qsl(query, keep_blank_values = True)
+        kept = [(k, v) for k, v in params if not _is_tracking_param(k)]
+        if len(kept) < len(params):
+            query = urllib.parse.urlencode(kept)
+    return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), \
+            path, query, ''))
+
+def _is_tracking_param(name):
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith('utm_')
 
 # TODO: write a RedditPost factory
 class RedditPost(Pushable):
-    def __init__(self, title, url, posted_utc):
+    __slots__ = ('_title', '_url', '_posted_utc', '_post_id')
+
+    def __init__(self, title, url, posted_utc, post_id = None):
         self.title      = title
         self.url        = url
         self.posted_utc = posted_utc # should be datetime object
+        self.post_id    = post_id # reddit fullname, e.g. 't3_79z05m'
+
+    # builds a post without running the type checks of the setters, for
+    # fields that come straight from reddit's json
+    @classmethod
+    def _from_fields(cls, title, url, posted_utc, post_id):
+        post = cls.__new__(cls)
+        post._title      = title
+        post._url        = url
+        post._posted_utc = posted_utc
+        post._post_id    = post_id
+        return post
+
+    # decodes the 'children' of a listing, reading only the fields a post
+    # needs
+    @classmethod
+    def decode_children(cls, children):
+        from_fields = cls._from_fields
+        from_timestamp = datetime.utcfromtimestamp
+        posts = []
+        with default_metrics().stage('decode'):
+            for item_data in children:
+                post_data = item_data['data']
+                posts.append(from_fields(post_data['title'], post_data['url'], \
+                        from_timestamp(int(post_data['created_utc'])), post_data.get('name')))
+        return posts
 
     @staticmethod
     def decode(item_data):
@@ -254,11 +3312,12 @@ class RedditPost(Pushable):
         title      = post_data['title']
         url        = post_data['url']
         posted_utc = post_data['created_utc']
+        post_id    = post_data.get('name')
 
         # convert the posted_utc integer to a datetime object
         posted_utc = datetime.utcfromtimestamp(int(posted_utc))
 
-        return RedditPost(title, url, posted_utc)
+        return RedditPost(title, url, posted_utc, post_id)
 
     def from_get_request(url):
        return RedditGetRequest(url).items[0]
@@ -293,6 +3352,24 @@ class RedditPost(Pushable):
             raise TypeError("'posted_utc' must be a datetime")
         self._posted_utc = value
 
+    @property
+    def post_id(self):
+        return self._post_id
+
+    @post_id.setter
+    def post_id(self, value):
+        if value is not None and not isinstance(value, str):
+            raise TypeError("'post_id' must be a str or None")
+        self._post_id = value
+
+    # the key that identifies the same post across searches, the reddit
+    # fullname if it is known and otherwise the normalized url
+    @property
+    def dedup_key(self):
+        if self.post_id is not None:
+            return self.post_id
+        return normalize_url(self.url)
+
     @property
     def push_title(self):
         return self._title
@@ -322,91 +3399,203 @@ class RedditPost(Pushable):
         return False
 
     def __hash__(self):
-        return 1
+        return hash((self.title, self.url, self.posted_utc))
 
+# the deals of a cycle, indexed by RedditPost.dedup_key so that a post hit by
+# several searches becomes a single deal
 class Deals:
     def __init__(self):
-        self.deals = []
+        self._index = {} # dedup_key -> RedditDeal, in insertion order
 
     def add(self, new_deal):
-        if new_deal in self.deals:
-            ind = self.deals.index(other)
-            existing = self.deals.pop(i)
-            existing.combine_searches(new_deal)
-            self.deals.insert(ind, existing)
+        key = new_deal.dedup_key
+        existing = self._index.get(key)
+        if existing is None:
+            self._index[key] = new_deal
         else:
-            self.deals.append(new_deal)
+            existing.combine_searches(new_deal)
+
+    @property
+    def deals(self):
+        return list(self._index.values())
+
+    # remove the deals whose posts were already pushed in an earlier run
+    def drop_seen(self, seen_store = None):
+        if seen_store is None: seen_store = SeenPost
+        seen = seen_store.seen_keys(self._index.keys())
+        for key in seen:
+            del self._index[key]
+        return len(seen)
+
+    def __contains__(self, deal):
+        return deal.dedup_key in self._index
+
+    def __len__(self):
+        return len(self._index)
 
     def __iter__(self):
-        for d in self.deals:
-            yield d
+        return iter(list(self._index.values()))
 
 class RedditDeal(RedditPost):
+    __slots__ = ('_searches', '_sources')
+
     def __init__(self, search, post):
-        super().__init__(post.title, post.url, post.posted_utc)
+        super().__init__(post.title, post.url, post.posted_utc, post.post_id)
         # TODO: check if the following will work instead
         # self = post
 
-        self._searches = [search]
-        # TODO: rewrite to take advantage of sets
-        # self._searches = {search}
+        self._searches = {search}
+        self._sources = [] # the near duplicate posts merged into this deal
 
     def combine_searches(self, other):
-        self.searches.extend(other.searches)
-        # TODO: rewrite to take advantage of sets
-        # self.searches.union(other.searches)
+        self._searches |= other.searches
+
+    # folds a near duplicate of this deal, e.g. a repost, into it
+    def merge(self, other):
+        self.combine_searches(other)
+        keys = self.source_keys
+        for post in [other] + other.sources:
+            if post.dedup_key not in keys:
+                self._sources.append(RedditPost(post.title, post.url, post.posted_utc, post.post_id))
+                keys.add(post.dedup_key)
 
     @property
     def searches(self):
         return self._searches
 
+    @property
+    def sources(self):
+        return list(self._sources)
+
+    # the dedup keys of this deal's post and of the posts merged into it
+    @property
+    def source_keys(self):
+        return {self.dedup_key} | {p.dedup_key for p in self._sources}
+
+    @property
+    def push_body(self):
+        if len(self._sources) == 0:
+            return None
+        return 'Also posted as:\n' + '\n'.join(p.url for p in self._sources)
+
     @property
     def push_title(self):
         return self._format_searches_str() + ' deal: ' + self.title
 
     def _str_data(self):
         str_data = super()._str_data()
-        str_data['result of searches'] = ", ".join([s.user_agent_base for s in self.searches])
+        str_data['result of searches'] = ", ".join([s.user_agent_base for s in self._sorted_searches()])
+        if len(self._sources) > 0:
+            str_data['also posted as'] = ", ".join(p.url for p in self._sources)
         return str_data
 
+    # the searches are a set, sort them so that titles are stable
+    def _sorted_searches(self):
+        return sorted(self.searches, key = lambda s: s.title.lower())
+
     def _format_searches_str(self):
-        out = ''
-        length = len(self.searches)
-        for i in range(0, length):
-            s_title = self.searches[i].title.lower()
-            if i == 0:
-                out += s_title.capitalize()
-            elif i == length - 1:
-                out += ', and ' + s_title
-            else:
-                out += ', ' + s_title
+        return format_search_titles([s.title for s in self._sorted_searches()])
+
+    # urgent if any of the searches that hit it is
+    @property
+    def urgent(self):
+        return any(getattr(s, 'urgent', False) for s in self.searches)
+
+# joins search titles the way push titles use them, e.g. 'Gpu, and monitor'
+def format_search_titles(titles):
+    out = ''
+    length = len(titles)
+    for i in range(0, length):
+        s_title = titles[i].lower()
+        if i == 0:
+            out += s_title.capitalize()
+        elif i == length - 1:
+            out += ', and ' + s_title
+        else:
+            out += ', ' + s_title
 
-        return out
+    return out
+
+# several held deals pushed together as a note
+class DealDigest(Pushable):
+    __slots__ = ('_pushes', '_search_titles')
+
+    def __init__(self, pushes, search_titles):
+        self._pushes = list(pushes)
+        self._search_titles = sorted(set(search_titles), key = str.lower)
+
+    @property
+    def push_title(self):
+        return '{} deals: {} new'.format(format_search_titles(self._search_titles), len(self._pushes))
+
+    @property
+    def push_body(self):
+        return '\n\n'.join('{}\n{}'.format(p.push_title, p.push_url) for p in self._pushes)
 
-class PushbulletAccount:
+    @property
+    def push_url(self):
+        return None
+
+# somewhere pushables are delivered to. push_status() returns an http style
+# status: 2xx when delivered, None, 429 or 5xx to retry later and anything
+# else to drop the push. Each sink has its own outbox rows, keyed by its name,
+# so a sink that fails only delays its own pushes.
+class PushSink:
+    name = None
+    concurrency = None # pushes in flight at once, PushDelivery's workers if None
+
+    def push_status(self, p):
+        raise NotImplementedError
+
+    # returns True if the sink accepted the push
+    def push_link(self, p):
+        status = self.push_status(p)
+        return status is not None and 200 <= status < 300
+
+    @staticmethod
+    def _payload(p):
+        return {'title': p.push_title, 'body': p.push_body, 'url': p.push_url}
+
+class PushbulletAccount(UsesHTTPPool, PushSink):
+    name = 'pushbullet'
     user_agent = USER_AGENT_BEG + USER_AGENT_END
     pb_create_push_url = 'https://api.pushbullet.com/v2/pushes'
 
     def __init__(self, access_token):
         self.access_token = access_token
 
-    def push_link(self, p):
+    # returns the http status of the push, None if it could not be sent. A
+    # pushable without a url, like a DealDigest, is sent as a note.
+    def push_status(self, p):
+        import requests
         payload = {
                 'type': 'link',
                 'title': p.push_title,
                 'body': p.push_body,
                 'url': p.push_url
             }
-
-        r = requests.post(self.pb_create_push_url, headers = self._post_headers(), json = payload)
+        if p.push_url is None:
+            payload['type'] = 'note'
+            del payload['url']
+
+        try:
+            with default_metrics().stage('push'):
+                r = self.http_pool.post(self.pb_create_push_url, headers = self._post_headers(), json = payload)
+        except requests.RequestException:
+            return None
         # print(r.json)
+        return r.status_code
 
+    # returns a list of the pushables that were delivered
     def push_iterable(self, p_list, print_pushes=False):
         if print_pushes: print('Pushed the following pushables:')
 
+        delivered = []
         for p in p_list:
-            self.push_link(p)
-            if print_pushes: print(p)
+            if self.push_link(p):
+                delivered.append(p)
+                if print_pushes: print(p)
+        return delivered
 
     def _post_headers(self):
         return {
@@ -414,5 +3603,324 @@ class PushbulletAccount:
                 'User-Agent': self.user_agent
             }
 
+# posts each push as json to a url
+class WebhookSink(UsesHTTPPool, PushSink):
+    def __init__(self, url, headers = None, name = 'webhook'):
+        self.url = url
+        self.headers = dict(headers or {})
+        self.headers.setdefault('User-Agent', USER_AGENT_BEG + USER_AGENT_END)
+        self.name = name
+
+    def push_status(self, p):
+        import requests
+        try:
+            r = self.http_pool.post(self.url, headers = self.headers, json = self._payload(p))
+        except requests.RequestException:
+            return None
+        return r.status_code
+
+# appends each push to a file as one line of json
+class JSONLinesSink(PushSink):
+    concurrency = 1
+
+    def __init__(self, path, name = 'jsonl'):
+        self.path = path
+        self.name = name
+        self._lock = threading.Lock()
+
+    def push_status(self, p):
+        line = json.dumps(self._payload(p)) + '\n'
+        try:
+            with self._lock, open(self.path, 'a', encoding = 'utf-8') as f:
+                f.write(line)
+        except OSError:
+            return None
+        return 200
+
+class StdoutSink(PushSink):
+    name = 'stdout'
+    concurrency = 1
+
+    def push_status(self, p):
+        print(Pushable.__str__(p))
+        return 200
+
+# keeps the pushes in a list, a stand-in for a real sink. 'status' is
+# returned for every push, after waiting 'delay' seconds.
+class MemorySink(PushSink):
+    def __init__(self, name = 'memory', status = 200, delay = 0, concurrency = None):
+        self.name = name
+        self.status = status
+        self.delay = delay
+        self.concurrency = concurrency
+        self.pushes = []
+        self._lock = threading.Lock()
+
+    def push_status(self, p):
+        if self.delay > 0: time.sleep(self.delay)
+        if self.status is not None and 200 <= self.status < 300:
+            with self._lock:
+                self.pushes.append(self._payload(p))
+        return self.status
+
+# builds a sink from a --sink value: pushbullet, stdout, jsonl:PATH or
+# webhook:URL
+def make_sink(spec, pb_access_token = None):
+    kind, _, arg = spec.partition(':')
+    if kind == 'pushbullet' and arg == '':
+        return PushbulletAccount(pb_access_token)
+    if kind == 'stdout' and arg == '':
+        return StdoutSink()
+    if kind == 'jsonl' and arg != '':
+        return JSONLinesSink(arg)
+    if kind == 'webhook' and arg != '':
+        return WebhookSink(arg)
+    raise ValueError('unknown sink {!r}, expected pushbullet, stdout, jsonl:PATH or webhook:URL'.format(spec))
+
+# a push waiting to be delivered, stored so that it survives a crash
+class OutboxPush(BaseModel, Pushable):
+    title            = TextField(null = True)
+    body             = TextField(null = True)
+    url              = TextField(null = True)
+    created_utc      = TimestampField()
+    attempts         = IntegerField(default = 0)
+    next_attempt_utc = TimestampField(index = True)
+    # a held push waits to be coalesced into a digest until next_attempt_utc
+    held             = BooleanField(default = False, index = True)
+    # a held push from quiet hours, it waits until next_attempt_utc however
+    # many pushes are held with it
+    quiet            = BooleanField(default = False)
+    search_titles    = TextField(null = True) # json list, used by digests
+    # the PushSink.name this push goes to, every sink has its own rows
+    sink             = TextField(default = PushbulletAccount.name, index = True)
+
+    class Meta:
+        table_name = 'outbox'
+
+    @classmethod
+    def from_pushable(cls, p, now, sink = PushbulletAccount.name):
+        searches = getattr(p, 'searches', None) or []
+        return cls(title = p.push_title, body = p.push_body, url = p.push_url, \
+                created_utc = now, next_attempt_utc = now, sink = sink, \
+                search_titles = json.dumps(sorted(s.title for s in searches)))
+
+    # the pushes that are due, only those of the given sink names if given
+    @classmethod
+    def due(cls, now, sinks = None):
+        return cls._of_sinks(sinks).where((cls.next_attempt_utc <= now) & ~cls.held).order_by(cls.id)
+
+    @classmethod
+    def held_pushes(cls, sink = None, quiet = False):
+        return cls._of_sinks(None if sink is None else [sink]).where(cls.held & (cls.quiet == quiet)).order_by(cls.id)
+
+    @classmethod
+    def next_attempt(cls, sinks = None):
+        first = cls._of_sinks(sinks, cls.next_attempt_utc).order_by(cls.next_attempt_utc.asc()).first()
+        if first is None:
+            return None
+        return first.next_attempt_utc
+
+    @classmethod
+    def _of_sinks(cls, sinks, *fields):
+        query = cls.select(*fields)
+        if sinks is not None:
+            query = query.where(cls.sink.in_(list(sinks)))
+        return query
+
+    @property
+    def push_title(self):
+        return self.title
+
+    @property
+    def push_body(self):
+        return self.body
+
+    @property
+    def push_url(self):
+        return self.url
+
+    def __str__(self):
+        return Pushable.__str__(self)
+
+# delivers the outbox to one or more PushSinks. Every pushable gets a row per
+# sink, and every sink is sent its rows from its own pool of workers, all at
+# the same time, so a slow or failing sink does not hold up the others. A
+# push that fails with a 429, a 5xx, a connection error or an exception stays
+# queued for its sink and is retried with exponential backoff, any other
+# failure is dropped. Deals that are not urgent are held and coalesced into
+# DealDigests, set digest_window to 0 to push every deal on its own.
+class PushDelivery:
+    def __init__(self, sinks, workers = PUSH_WORKERS, backoff = PUSH_BACKOFF, \
+            max_backoff = PUSH_MAX_BACKOFF, digest_window = DIGEST_WINDOW, \
+            digest_max_deals = DIGEST_MAX_DEALS, print_pushes = True):
+        if isinstance(sinks, PushSink): sinks = [sinks]
+        self.sinks = OrderedDict((sink.name, sink) for sink in sinks)
+        if len(self.sinks) != len(sinks):
+            raise ValueError('every sink needs its own name')
+        self.workers = workers
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.digest_window = digest_window
+        self.digest_max_deals = digest_max_deals
+        self.print_pushes = print_pushes
+        self._executors = {} # sink name -> its workers, kept between flushes
+        self._in_flight = {} # future -> the OutboxPush it is sending
+
+    def enqueue(self, pushables, now = None):
+        if now is None: now = datetime.utcnow()
+        pushables = list(pushables)
+        rows = []
+        with OutboxPush._meta.database.atomic():
+            for sink in self.sinks:
+                # held deals join the digest that is already open, if any
+                window_end = None
+                for p in pushables:
+                    row = OutboxPush.from_pushable(p, now, sink)
+                    quiet_end = quiet_until(getattr(p, 'searches', None) or [], now)
+                    if quiet_end is not None:
+                        row.held = row.quiet = True
+                        row.next_attempt_utc = quiet_end
+                    elif self._should_hold(p):
+                        if window_end is None: window_end = self._window_end(now, sink)
+                        row.held = True
+                        row.next_attempt_utc = window_end
+                    row.save(force_insert = True)
+                    rows.append(row)
+        return rows
+
+    # the next time a push to one of these sinks is due, None if there are none
+    def next_attempt(self):
+        return OutboxPush.next_attempt(self.sinks)
+
+    def _should_hold(self, p):
+        return self.digest_window > 0 and hasattr(p, 'searches') and not p.urgent
+
+    def _window_end(self, now, sink):
+        first = OutboxPush.held_pushes(sink).first()
+        if first is None:
+            return now + timedelta(seconds = self.digest_window)
+        return first.next_attempt_utc
+
+    # turns the held pushes of each sink into one digest once the window has
+    # closed or enough deals are held, a single held deal is sent as it is.
+    # The pushes of quiet hours that have ended are released as one more
+    # batch. Returns the pushes that were released.
+    def coalesce(self, now = None):
+        if now is None: now = datetime.utcnow()
+        released = []
+        for sink in self.sinks:
+            held = list(OutboxPush.held_pushes(sink))
+            if len(held) > 0 and (len(held) >= self.digest_max_deals or held[0].next_attempt_utc <= now):
+                released.append(self._coalesce(held, sink, now))
+            quiet = [row for row in OutboxPush.held_pushes(sink, quiet = True) if row.next_attempt_utc <= now]
+            if len(quiet) > 0:
+                released.append(self._coalesce(quiet, sink, now))
+        return released
+
+    def _coalesce(self, held, sink, now):
+        with OutboxPush._meta.database.atomic():
+            if len(held) == 1:
+                held[0].held = held[0].quiet = False
+                held[0].next_attempt_utc = now
+                held[0].save()
+                return held[0]
+
+            titles = []
+            for row in held:
+                titles.extend(json.loads(row.search_titles or '[]'))
+            digest = OutboxPush.from_pushable(DealDigest(held, titles), now, sink)
+            digest.save(force_insert = True)
+            for batch in batched([row.id for row in held]):
+                OutboxPush.delete().where(OutboxPush.id.in_(batch)).execute()
+        return digest
+
+    # sends every push that is due on the workers of its sink, and records
+    # each push as soon as it is done, so that a slow sink never keeps the
+    # pushes of the others in the outbox. Returns the pushes that were
+    # delivered: with 'wait' once nothing is in flight any more, without it
+    # only those done by now, the rest are recorded by a later flush.
+    def flush(self, now = None, wait = True):
+        if now is None: now = datetime.utcnow()
+        self.coalesce(now)
+        sending = {row.id for row in self._in_flight.values()}
+        for row in OutboxPush.due(now, self.sinks):
+            if row.id not in sending:
+                future = self._executor(row.sink).submit(self._push_status, self.sinks[row.sink], row)
+                self._in_flight[future] = row
+        return self._collect(now, wait)
+
+    # waits for the pushes in flight and stops the workers of the sinks
+    def close(self):
+        self._collect(datetime.utcnow(), wait = True)
+        for executor in self._executors.values():
+            executor.shutdown(wait = True)
+        self._executors = {}
+
+    # records the pushes in flight that are done, all of them with 'wait'
+    def _collect(self, now, wait):
+        from concurrent.futures import wait as wait_futures, FIRST_COMPLETED
+        delivered = []
+        while len(self._in_flight) > 0:
+            done, _ = wait_futures(list(self._in_flight), timeout = None if wait else 0, \
+                    return_when = FIRST_COMPLETED)
+            if len(done) == 0:
+                break
+            delivered.extend(self._record([(self._in_flight.pop(f), f.result()) for f in done], now))
+        return delivered
+
+    def _executor(self, name):
+        executor = self._executors.get(name)
+        if executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            workers = self.sinks[name].concurrency or self.workers
+            executor = self._executors[name] = ThreadPoolExecutor(max_workers = workers)
+        return executor
+
+    # saves what became of the (row, status) of finished pushes, returns the
+    # delivered rows
+    def _record(self, finished, now):
+        delivered, dropped, retry = [], [], []
+        for row, status in finished:
+            if status is not None and 200 <= status < 300:
+                delivered.append(row)
+            elif status is None or status == 429 or status >= 500:
+                row.attempts += 1
+                delay = min(self.max_backoff, self.backoff * 2 ** (row.attempts - 1))
+                row.next_attempt_utc = now + timedelta(seconds = delay * random.uniform(0.5, 1.5))
+                retry.append(row)
+            else:
+                print('Dropped push to {} ({}): {}'.format(row.sink, status, row.title))
+                dropped.append(row)
+
+        metrics = default_metrics()
+        if metrics.enabled:
+            for result, rows in (('delivered', delivered), ('retry', retry), ('dropped', dropped)):
+                for row in rows:
+                    metrics.count('reddit_watcher_pushes_total', result = result, sink = row.sink)
+
+        with OutboxPush._meta.database.atomic():
+            done = [row.id for row in delivered + dropped]
+            for batch in batched(done):
+                OutboxPush.delete().where(OutboxPush.id.in_(batch)).execute()
+            for batch in batched(retry, SQLITE_BATCH_SIZE // 5):
+                OutboxPush.bulk_update(batch, fields = [OutboxPush.attempts, OutboxPush.next_attempt_utc])
+
+        if self.print_pushes and len(delivered) > 0:
+            print('Pushed the following pushables:')
+            for row in delivered:
+                print(row)
+        return delivered
+
+    # a sink that raises only fails its own push, which is retried
+    @staticmethod
+    def _push_status(sink, row):
+        try:
+            return sink.push_status(row)
+        except Exception as e:
+            print('Push to {} failed: {!r}'.format(sink.name, e))
+            return None
+
+_import_finished = time.perf_counter()
+
 if __name__ == "__main__":
     main()
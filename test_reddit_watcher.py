@@ -1,8 +1,21 @@
 import unittest
 import pytest
+import json
+import requests
 from reddit_watcher import *
+import reddit_watcher
+import bench_reddit_watcher
 import urllib
-from datetime import datetime
+import threading
+import time
+import uuid
+import os
+import argparse
+import subprocess
+import sys
+import io
+import tempfile
+from datetime import datetime, timedelta
 
 # helper function to test lists
 def assert_list_is_expected(self, test_list, limit, list_type):
@@ -18,6 +31,36 @@ def assert_value_equal(self, key, dict1, dict2):
 def assert_value_not_equal(self, key, dict1, dict2):
     self.assertNotEqual(dict1[key], dict2[key])
 
+# helper function to build a reddit listing the way the json api returns it
+def listing_json(posts, before = None, after = None):
+    children = []
+    for i, post in enumerate(posts):
+        title, url, created_utc = post[:3]
+        post_id = post[3] if len(post) > 3 else 'p{}'.format(i)
+        children.append({'kind': 't3', 'data': {
+                'id': post_id,
+                'name': 't3_' + post_id,
+                'title': title,
+                'url': url,
+                'created_utc': float(created_utc)
+            }})
+    return {'kind': 'Listing', 'data': {'children': children, 'before': before, 'after': after}}
+
+# binds the models to a fresh in-memory database for every test
+class InMemoryDatabaseTestCase(unittest.TestCase):
+    models = [RedditWatchedSearch, SeenPost, OutboxPush, SubredditCursor, \
+            ArchivedDeal, ArchivedDealSearch, archived_deal_title()]
+
+    def setUp(self):
+        self.db = SqliteDatabase(':memory:')
+        self._bind = self.db.bind_ctx(self.models)
+        self._bind.__enter__()
+        self.db.create_tables(self.models)
+
+    def tearDown(self):
+        self._bind.__exit__(None, None, None)
+        self.db.close()
+
 class BaseTestCases():
     class BaseRedditPostTestCase(unittest.TestCase):
         def setUp(self):
@@ -94,6 +137,264 @@ class RedditSearchTestCase(unittest.TestCase):
 
                 self.assertEqual(s.query, decoded_query)
 
+class RedditPollerTestCase(unittest.TestCase):
+    # stands in for a search, counting how many polls run at the same time
+    class CountingSearch:
+        lock = threading.Lock()
+        running = 0
+        max_running = 0
+
+        def __init__(self, query):
+            self.query = query
+
+        def poll(self):
+            cls = self.__class__
+            with cls.lock:
+                cls.running += 1
+                cls.max_running = max(cls.max_running, cls.running)
+            time.sleep(0.02)
+            with cls.lock:
+                cls.running -= 1
+            return [RedditPost(self.query, 'www.thisisatest.com', datetime.utcfromtimestamp(123456))]
+
+    def setUp(self):
+        self.CountingSearch.running = 0
+        self.CountingSearch.max_running = 0
+        self.searches = [self.CountingSearch(str(i)) for i in range(12)]
+
+    def test_results_keep_search_order(self):
+        results = RedditPoller(concurrency = 4).results(self.searches)
+        self.assertEqual(len(results), len(self.searches))
+        for s, posts in zip(self.searches, results):
+            assert_list_is_expected(self, posts, 1, RedditPost)
+            self.assertEqual(posts[0].title, s.query)
+
+    def test_concurrency_limit(self):
+        RedditPoller(concurrency = 3).results(self.searches)
+        self.assertTrue(1 < self.CountingSearch.max_running <= 3)
+
+    def test_no_searches(self):
+        self.assertEqual(RedditPoller().results([]), [])
+
+    def test_invalid_concurrency(self):
+        with self.assertRaises(ValueError):
+            RedditPoller(concurrency = 0)
+
+class DecodeChildrenTestCase(unittest.TestCase):
+    def setUp(self):
+        self.children = listing_json([
+                ('C', 'www.c.com', 3000, 'c'),
+                ('B', 'www.b.com', 2000, 'b'),
+                ('A', 'www.a.com', 1000, 'a')
+            ])['data']['children']
+
+    def test_matches_decode(self):
+        posts = RedditPost.decode_children(self.children)
+        self.assertEqual(posts, [RedditPost.decode(c) for c in self.children])
+        self.assertEqual([p.post_id for p in posts], ['t3_c', 't3_b', 't3_a'])
+        self.assertEqual(posts[0].posted_utc, datetime.utcfromtimestamp(3000))
+
+    def test_posts_are_slotted(self):
+        post = RedditPost.decode_children(self.children)[0]
+        self.assertFalse(hasattr(post, '__dict__'))
+
+class HTTPPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.transport = LocalTransport()
+        self.pool = HTTPPool()
+        self.pool.mount(self.transport)
+
+        self.transport.add('https://reddit.com/search.json', listing_json([
+                ('First Post', 'www.first.com', 1509485184),
+                ('Second Post', 'www.second.com', 1509485000)
+            ]))
+        self.transport.add('https://www.reddit.com/r/homelab/comments/79z05m/', [listing_json([
+                ('NVMe recommendations', 'https://www.reddit.com/r/homelab/comments/79z05m/', 1509485184)
+            ])])
+        self.transport.add(PushbulletAccount.pb_create_push_url, {'active': True})
+        self.previous_cache = set_default_response_cache(ResponseCache())
+
+    def tearDown(self):
+        set_default_response_cache(self.previous_cache)
+
+    def test_search_result(self):
+        s = RedditSearch('this AND that')
+        s.http_pool = self.pool
+        result = s.result(limit = 2)
+        assert_list_is_expected(self, result, 2, RedditPost)
+        self.assertEqual(result[0].title, 'First Post')
+        self.assertEqual(result[1].posted_utc, datetime.utcfromtimestamp(1509485000))
+
+        request = self.transport.requests[-1]
+        self.assertEqual(request.headers['User-Agent'], s.user_agent)
+        self.assertIn('q=this+AND+that', request.url)
+
+    def test_get_request_items(self):
+        req = RedditGetRequest('https://www.reddit.com/r/homelab/comments/79z05m/')
+        req.http_pool = self.pool
+        items = req.items
+        assert_list_is_expected(self, items, 1, RedditPost)
+        self.assertEqual(items[0].title, 'NVMe recommendations')
+
+    def test_push_link(self):
+        pb = PushbulletAccount('token')
+        pb.http_pool = self.pool
+        pb.push_link(RedditPost('Test Push', 'www.push.com', datetime.utcnow()))
+        request = self.transport.requests[-1]
+        self.assertEqual(request.method, 'POST')
+        self.assertEqual(request.headers['Access-Token'], 'token')
+        self.assertEqual(json.loads(request.body.decode('utf-8'))['url'], 'www.push.com')
+
+    def test_default_pool_is_shared(self):
+        previous = set_default_http_pool(self.pool)
+        try:
+            self.assertIs(RedditSearch('reddit').http_pool, self.pool)
+            self.assertIs(PushbulletAccount('token').http_pool, self.pool)
+            self.assertEqual(len(RedditSearch('reddit').result()), 2)
+        finally:
+            set_default_http_pool(previous)
+
+    def test_unknown_url(self):
+        r = self.pool.get('https://example.com/')
+        self.assertEqual(r.status_code, 404)
+
+class CompiledQueryTestCase(unittest.TestCase):
+    # helper function to match a query against a title
+    def matches(self, query, title, url = 'https://www.example.com/deal', subreddit = None):
+        post = RedditPost(title, url, datetime.utcfromtimestamp(123456))
+        return compile_query(query).matches(PostText(post, subreddit))
+
+    def test_operators(self):
+        cases = [
+                ('this is a search query', 'Is this a search query?', True),
+                ('this is a search query', 'this is a query', False),
+                ('this AND that', 'That and this', True),
+                ('this AND that', 'this only', False),
+                ('days OR nights', 'Long nights', True),
+                ('days OR nights', 'Long weeks', False),
+                ('days or nights', 'Long nights', True),
+                ('ssd and not refurbished', 'Refurbished SSD', False),
+                ('(complicated AND search) OR (queries but) NOT simple', 'a complicated search', True),
+                ('(complicated AND search) OR (queries but) NOT simple', 'queries but hard', True),
+                ('(complicated AND search) OR (queries but) NOT simple', 'queries but simple', False),
+                ('"also check" AND ("that quotes" OR "work too")', 'Also check: work too', True),
+                ('"also check" AND ("that quotes" OR "work too")', 'check also, work too', False),
+                ('NOT refurbished', 'New SSD', True)
+            ]
+        for query, title, expected in cases:
+            with self.subTest('Query: "{}", title: "{}"'.format(query, title)):
+                self.assertEqual(self.matches(query, title), expected)
+
+    def test_fields(self):
+        self.assertTrue(self.matches('site:example.com', 'Anything'))
+        self.assertFalse(self.matches('site:amazon.com', 'Anything'))
+        self.assertTrue(self.matches('url:deal', 'Anything'))
+        self.assertTrue(self.matches('subreddit:buildapcsales ssd', '[SSD] Cheap', subreddit = 'BuildAPCSales'))
+        self.assertFalse(self.matches('subreddit:buildapcsales ssd', '[SSD] Cheap', subreddit = 'homelab'))
+        self.assertTrue(self.matches('subreddit:buildapcsales title:"rtx 4070"', '[GPU] RTX 4070 - $549', \
+                subreddit = 'buildapcsales'))
+        self.assertFalse(self.matches('title:"rtx 4070"', '[GPU] RTX 4080 - $4070'))
+        self.assertTrue(self.matches('site:"example.com" AND title:"cheap"', 'Cheap thing'))
+
+    def test_syntax_errors(self):
+        for query in ['how about gib%$3@!^)(-_eriSh', '(unclosed AND', '"unmatched quote', 'this AND', '']:
+            with self.subTest('Query: "{}"'.format(query)):
+                with self.assertRaises(QuerySyntaxError):
+                    compile_query(query)
+
+    def test_unknown_field_is_not_local(self):
+        with self.assertRaises(QueryNotLocalError):
+            compile_query('selftext:ssd')
+
+    def test_confining_subreddits(self):
+        cases = [
+                ('subreddit:buildapcsales gpu', {'buildapcsales'}),
+                ('(subreddit:a OR subreddit:b) AND ssd', {'a', 'b'}),
+                ('subreddit:a AND NOT subreddit:b', {'a'}),
+                ('gpu', None),
+                ('gpu OR subreddit:a', None),
+                ('subreddit:a or subreddit:b', {'a', 'b'}),
+                ('subreddit:a subreddit:b', set())
+            ]
+        for query, expected in cases:
+            with self.subTest('Query: "{}"'.format(query)):
+                compiled = compile_query(query)
+                subreddits = compiled.subreddits
+                self.assertEqual(None if subreddits is None else set(subreddits), expected)
+                self.assertEqual(compiled.is_local, bool(expected))
+
+class LocalMatchPollerTestCase(InMemoryDatabaseTestCase):
+    feed_url = 'https://www.reddit.com/r/buildapcsales/new.json'
+
+    def setUp(self):
+        super().setUp()
+        self.transport = LocalTransport()
+        self.pool = HTTPPool()
+        self.pool.mount(self.transport)
+        self.previous_pool = set_default_http_pool(self.pool)
+        self.previous_cache = set_default_response_cache(ResponseCache())
+        self.previous_limiter = set_default_rate_limiter(RateLimiter(per_minute = 6000, burst = 100))
+
+        self.gpu = make_watched_search('GPU', 'subreddit:buildapcsales GPU')
+        self.ssd = make_watched_search('SSD', 'subreddit:buildapcsales AND (ssd OR nvme)')
+        self.remote = make_watched_search('Monitor', 'monitor')
+        self.searches = [self.gpu, self.ssd, self.remote]
+        for s in self.searches:
+            s.urgent = True
+            s.save(force_insert = True)
+
+        self.transport.add(self.feed_url, listing_json([
+                ('[GPU] Cheap card', 'www.gpu.com', 3000, 'gpu'),
+                ('[SSD] 2TB NVMe', 'www.ssd.com', 2000, 'ssd'),
+                ('[Case] Small case', 'www.case.com', 1000, 'case')
+            ]))
+        self.transport.add(RedditSearch._reddit_json_search, listing_json([
+                ('Cheap monitor', 'www.monitor.com', 2500, 'monitor')
+            ]))
+        self.transport.add(PushbulletAccount.pb_create_push_url, {'active': True})
+
+    def tearDown(self):
+        set_default_http_pool(self.previous_pool)
+        set_default_response_cache(self.previous_cache)
+        set_default_rate_limiter(self.previous_limiter)
+        super().tearDown()
+
+    def test_one_request_per_subreddit(self):
+        poller = LocalMatchPoller()
+        results = poller.results(self.searches)
+        self.assertEqual([[p.post_id for p in posts] for posts in results],
+                [['t3_gpu'], ['t3_ssd'], ['t3_monitor']])
+        urls = [r.url for r in self.transport.requests]
+        self.assertEqual(len([u for u in urls if u.startswith(self.feed_url)]), 1)
+        self.assertEqual(len(urls), 2)
+
+    def test_cycle_saves_feed_cursor(self):
+        delivered = poll_cycle(self.searches, PushbulletAccount('token'), \
+                poller = LocalMatchPoller(), print_pushes = False)
+        self.assertEqual(len(delivered), 3)
+        self.assertEqual(SubredditCursor.get().last_seen_fullname, 't3_gpu')
+
+        # the next cycle finds the cursor on the newest page and stops there
+        delivered = poll_cycle(self.searches, PushbulletAccount('token'), \
+                poller = LocalMatchPoller(), print_pushes = False)
+        self.assertEqual(delivered, [])
+        feed_requests = [r.url for r in self.transport.requests if r.url.startswith(self.feed_url)]
+        self.assertEqual(len(feed_requests), 2)
+        self.assertEqual(SubredditCursor.get().last_seen_fullname, 't3_gpu')
+
+    def test_feed_recovers_from_removed_cursor(self):
+        SubredditCursor.create(subreddit = 'buildapcsales', last_seen_fullname = 't3_removed')
+        self.gpu.last_run_utc = self.ssd.last_run_utc = datetime.utcfromtimestamp(2500)
+        self.transport.add(self.feed_url + '?limit=100&before=t3_removed', listing_json([]))
+        results = LocalMatchPoller().results([self.gpu, self.ssd])
+        # the newest page is matched against each search's last run instead
+        self.assertEqual([[p.post_id for p in posts] for posts in results], [['t3_gpu'], []])
+
+    def test_expand_adds_searches_sharing_a_subreddit(self):
+        poller = LocalMatchPoller()
+        expanded = poller.expand([self.gpu], self.searches)
+        self.assertEqual(expanded, [self.gpu, self.ssd])
+
 class RedditWatchedSearchTestCase(unittest.TestCase):
     def setUp(self):
         self.searches = RedditWatchedSearch.select()
@@ -128,6 +429,79 @@ class RedditWatchedSearchTestCase(unittest.TestCase):
                 self.assertIn(str(s.uuid), string)
                 self.assertIn(s.user_agent_base, string)
 
+class RedditWatchedSearchPollTestCase(unittest.TestCase):
+    def setUp(self):
+        self.transport = LocalTransport()
+        self.search = make_watched_search('GPU')
+        self.search.http_pool = HTTPPool()
+        self.search.http_pool.mount(self.transport)
+        self.search.response_cache = ResponseCache()
+        self.search.rate_limiter = RateLimiter(per_minute = 6000, burst = 100)
+        self.search.last_run_utc = datetime.utcfromtimestamp(1000)
+
+    def page_url(self, **kwargs):
+        s = self.search
+        return s._reddit_json_search + '?' + s.query_string(s.params(**kwargs))
+
+    def test_first_poll_uses_last_run(self):
+        self.transport.add(self.page_url(), listing_json([
+                ('New', 'www.new.com', 2000, 'new'),
+                ('Old', 'www.old.com', 500, 'old')
+            ]))
+        posts = self.search.poll()
+        self.assertEqual([p.post_id for p in posts], ['t3_new'])
+        self.assertEqual(self.search.last_seen_fullname, 't3_new')
+
+    def test_poll_pages_until_short_page(self):
+        self.search._page_limit = 2
+        self.search.last_seen_fullname = 't3_seen'
+        # the newest page is full and does not reach back to the cursor
+        self.transport.add(self.page_url(limit = 2), listing_json([
+                ('C', 'www.c.com', 4000, 'c'),
+                ('B', 'www.b.com', 3000, 'b')
+            ]))
+        self.transport.add(self.page_url(limit = 2, before = 't3_seen'), listing_json([
+                ('B', 'www.b.com', 3000, 'b'),
+                ('A', 'www.a.com', 2000, 'a')
+            ]))
+        self.transport.add(self.page_url(limit = 2, before = 't3_b'), listing_json([
+                ('C', 'www.c.com', 4000, 'c')
+            ]))
+
+        posts = self.search.poll()
+        self.assertEqual([p.post_id for p in posts], ['t3_c', 't3_b', 't3_a'])
+        self.assertEqual(self.search.last_seen_fullname, 't3_c')
+        self.assertEqual(len(self.transport.requests), 3)
+
+    def test_poll_nothing_new(self):
+        self.search.last_seen_fullname = 't3_seen'
+        self.transport.add(self.page_url(limit = 100), listing_json([
+                ('Seen', 'www.seen.com', 900, 'seen'),
+                ('Older', 'www.older.com', 800, 'older')
+            ]))
+        self.assertEqual(self.search.poll(), [])
+        self.assertEqual(self.search.last_seen_fullname, 't3_seen')
+        self.assertEqual(len(self.transport.requests), 1)
+
+    def test_poll_recovers_from_removed_cursor(self):
+        # reddit answers 'before' with an empty page once the post is removed
+        self.search._page_limit = 2
+        self.search.last_seen_fullname = 't3_removed'
+        self.transport.add(self.page_url(limit = 2), listing_json([
+                ('New', 'www.new.com', 2000, 'new'),
+                ('Old', 'www.old.com', 500, 'old')
+            ]))
+        self.transport.add(self.page_url(limit = 2, before = 't3_removed'), listing_json([]))
+        posts = self.search.poll()
+        self.assertEqual([p.post_id for p in posts], ['t3_new'])
+        self.assertEqual(self.search.last_seen_fullname, 't3_new')
+
+        # nothing since the last run still moves the cursor off the removed post
+        self.search.last_seen_fullname = 't3_removed'
+        self.search.last_run_utc = datetime.utcfromtimestamp(3000)
+        self.assertEqual(self.search.poll(), [])
+        self.assertEqual(self.search.last_seen_fullname, 't3_new')
+
 @pytest.fixture(scope="class", params=[
     'base',
     'copy',
@@ -292,6 +666,1471 @@ class RedditPostFromGETRequestTestCase(RedditPostTestCase):
 #     self.assertNotEqual(TestRedditPost.post, \
 #             TestRedditPostFromConstructor4.post)
 
+# helper function to create a watched search without touching the database
+def make_watched_search(title, query = None):
+    return RedditWatchedSearch(
+            uuid = uuid.uuid4(),
+            title = title,
+            query = query or title.lower(),
+            user_agent_base = title.lower().replace(' ', '_'),
+            last_run_utc = datetime.utcfromtimestamp(0)
+        )
+
+class DealsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.gpu = make_watched_search('GPU')
+        self.monitor = make_watched_search('Monitor')
+        self.time = datetime.utcfromtimestamp(123456)
+        self.post = RedditPost('[GPU] Cheap card', 'https://Example.com/deal/', self.time, 't3_abc')
+
+    def test_overlapping_searches_merge(self):
+        deals = Deals()
+        deals.add(RedditDeal(self.gpu, self.post))
+        deals.add(RedditDeal(self.monitor, self.post))
+        deals.add(RedditDeal(self.gpu, self.post))
+
+        self.assertEqual(len(deals), 1)
+        deal = deals.deals[0]
+        self.assertEqual(deal.searches, {self.gpu, self.monitor})
+        self.assertEqual(deal.push_title, 'Gpu, and monitor deal: [GPU] Cheap card')
+
+    def test_distinct_posts_kept_in_order(self):
+        deals = Deals()
+        for i in range(100):
+            post = RedditPost('Deal {}'.format(i), 'www.deal{}.com'.format(i), self.time, 't3_{}'.format(i))
+            deals.add(RedditDeal(self.gpu, post))
+        self.assertEqual([d.post_id for d in deals], ['t3_{}'.format(i) for i in range(100)])
+
+    def test_dedup_by_normalized_url(self):
+        deals = Deals()
+        deals.add(RedditDeal(self.gpu, RedditPost('A', 'https://example.com/deal/', self.time)))
+        deals.add(RedditDeal(self.monitor, RedditPost('B', 'HTTPS://EXAMPLE.COM/deal#top', self.time)))
+        self.assertEqual(len(deals), 1)
+        self.assertIn(RedditDeal(self.gpu, RedditPost('C', 'https://example.com/deal', self.time)), deals)
+
+    def test_hashes(self):
+        copy = RedditPost(self.post.title, self.post.url, self.time, 't3_abc')
+        self.assertEqual(self.post, copy)
+        self.assertEqual(len({self.post, copy}), 1)
+        self.assertNotEqual(hash(self.gpu), hash(self.monitor))
+        self.assertEqual(len({RedditSearch('a'), RedditSearch('b'), RedditSearch('a')}), 2)
+
+class SeenPostTestCase(InMemoryDatabaseTestCase):
+    def test_mark_and_lookup_in_batches(self):
+        keys = ['t3_{}'.format(i) for i in range(1200)]
+        SeenPost.mark_seen(keys[:700])
+        self.assertEqual(SeenPost.seen_keys(keys), set(keys[:700]))
+
+    def test_prune(self):
+        SeenPost.mark_seen(['t3_old'], datetime.utcfromtimestamp(1000))
+        SeenPost.mark_seen(['t3_new'], datetime.utcfromtimestamp(5000))
+        self.assertEqual(SeenPost.prune(datetime.utcfromtimestamp(2000)), 1)
+        self.assertEqual(SeenPost.seen_keys(['t3_old', 't3_new']), {'t3_new'})
+
+    def test_deals_drop_seen(self):
+        search = make_watched_search('GPU')
+        deals = Deals()
+        for i in range(5):
+            post = RedditPost('Deal {}'.format(i), 'www.deal{}.com'.format(i), \
+                    datetime.utcfromtimestamp(123456), 't3_{}'.format(i))
+            deals.add(RedditDeal(search, post))
+        SeenPost.mark_seen(['t3_1', 't3_3', 't3_other'])
+
+        self.assertEqual(deals.drop_seen(), 2)
+        self.assertEqual([d.post_id for d in deals], ['t3_0', 't3_2', 't3_4'])
+
+class PollCycleTestCase(InMemoryDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.transport = LocalTransport()
+        self.pool = HTTPPool()
+        self.pool.mount(self.transport)
+        self.previous_pool = set_default_http_pool(self.pool)
+        self.previous_cache = set_default_response_cache(ResponseCache())
+        self.previous_limiter = set_default_rate_limiter(RateLimiter(per_minute = 6000, burst = 100))
+
+        # urgent searches push right away instead of waiting for a digest
+        self.searches = [make_watched_search('GPU'), make_watched_search('Monitor')]
+        for s in self.searches:
+            s.urgent = True
+            s.save(force_insert = True)
+
+        self.transport.add(RedditSearch._reddit_json_search, listing_json([
+                ('Shared Deal', 'www.shared.com', 2000, 'shared')
+            ]))
+        self.pb = PushbulletAccount('token')
+
+    def tearDown(self):
+        set_default_http_pool(self.previous_pool)
+        set_default_response_cache(self.previous_cache)
+        set_default_rate_limiter(self.previous_limiter)
+        super().tearDown()
+
+    def test_delivered_cycle_saves_state(self):
+        self.transport.add(PushbulletAccount.pb_create_push_url, {'active': True})
+        delivered = poll_cycle(self.searches, self.pb, print_pushes = False)
+
+        self.assertEqual([d.url for d in delivered], ['www.shared.com'])
+        self.assertEqual(delivered[0].title, 'Gpu, and monitor deal: Shared Deal')
+        self.assertEqual(OutboxPush.select().count(), 0)
+        self.assertEqual(SeenPost.seen_keys(['t3_shared']), {'t3_shared'})
+        for s in RedditWatchedSearch.select():
+            self.assertEqual(s.last_seen_fullname, 't3_shared')
+            self.assertTrue(s.last_run_utc > datetime.utcfromtimestamp(0))
+
+        # the same post is not pushed again
+        self.assertEqual(poll_cycle(self.searches, self.pb, print_pushes = False), [])
+
+    def test_failed_push_stays_in_outbox(self):
+        self.transport.add(PushbulletAccount.pb_create_push_url, {'error': {}}, status = 500)
+        self.assertEqual(poll_cycle(self.searches, self.pb, print_pushes = False), [])
+
+        queued = OutboxPush.get()
+        self.assertEqual(queued.attempts, 1)
+        self.assertTrue(queued.next_attempt_utc > datetime.utcnow())
+        self.assertEqual(SeenPost.seen_keys(['t3_shared']), {'t3_shared'})
+        for s in RedditWatchedSearch.select():
+            self.assertEqual(s.last_seen_fullname, 't3_shared')
+
+        # a later flush, e.g. on the next start, delivers it
+        self.transport.add(PushbulletAccount.pb_create_push_url, {'active': True})
+        delivery = PushDelivery(self.pb, print_pushes = False)
+        self.assertEqual(delivery.flush(), [])
+        later = datetime.utcnow() + timedelta(seconds = 2 * PUSH_BACKOFF)
+        self.assertEqual([d.url for d in delivery.flush(later)], ['www.shared.com'])
+        self.assertEqual(OutboxPush.select().count(), 0)
+
+    def test_rejected_push_is_dropped(self):
+        self.transport.add(PushbulletAccount.pb_create_push_url, {'error': {}}, status = 400)
+        self.assertEqual(poll_cycle(self.searches, self.pb, print_pushes = False), [])
+        self.assertEqual(OutboxPush.select().count(), 0)
+
+    def test_delivery_workers(self):
+        self.transport.add(PushbulletAccount.pb_create_push_url, {'active': True})
+        delivery = PushDelivery(self.pb, workers = 3, print_pushes = False)
+        posts = [RedditPost('Deal {}'.format(i), 'www.deal{}.com'.format(i), datetime.utcnow()) for i in range(10)]
+        delivery.enqueue(posts)
+        delivered = delivery.flush()
+        self.assertEqual(sorted(d.url for d in delivered), sorted(p.url for p in posts))
+        self.assertEqual(len(self.transport.requests), 10)
+
+    def test_failed_search_keeps_state(self):
+        previous = set_default_rate_limiter(RateLimiter(max_retries = 1, backoff = 0.001))
+        try:
+            self.transport.add(PushbulletAccount.pb_create_push_url, {'active': True})
+            self.transport.add(RedditSearch._reddit_json_search, {}, status = 500)
+            self.assertEqual(poll_cycle(self.searches, self.pb, print_pushes = False), [])
+        finally:
+            set_default_rate_limiter(previous)
+
+        for s in RedditWatchedSearch.select():
+            self.assertIsNone(s.last_seen_fullname)
+            self.assertEqual(s.last_run_utc, datetime.utcfromtimestamp(0))
+
+    def test_body_without_listing_fails_the_search_only(self):
+        self.transport.add(PushbulletAccount.pb_create_push_url, {'active': True})
+        other = make_watched_search('SSD', 'ssd')
+        other.urgent = True
+        other.save(force_insert = True)
+        self.transport.add(RedditSearch._reddit_json_search + '?limit=10&q=ssd', listing_json([
+                ('SSD Deal', 'www.ssd.com', 2000, 'ssd')
+            ]))
+        for body in ['<html>down for maintenance</html>', {'kind': 'Listing'}, {'data': {'children': [{}]}}]:
+            with self.subTest(body = body):
+                self.transport.add(RedditSearch._reddit_json_search + '?limit=10&q=gpu', body)
+                poller = RedditPoller()
+                poll_cycle(self.searches[:1] + [other], self.pb, poller = poller, print_pushes = False)
+                self.assertEqual(list(poller.errors), self.searches[:1])
+                self.assertIsInstance(poller.errors[self.searches[0]], RedditRequestError)
+                failed = RedditWatchedSearch.get(RedditWatchedSearch.uuid == self.searches[0].uuid)
+                self.assertIsNone(failed.last_seen_fullname)
+        pushed = [json.loads(r.body)['url'] for r in self.transport.requests if r.method == 'POST']
+        self.assertEqual(pushed, ['www.ssd.com'])
+
+    def test_daemon_polls_due_searches(self):
+        self.transport.add(PushbulletAccount.pb_create_push_url, {'active': True})
+        self.searches[1].next_poll_utc = datetime.utcnow() + timedelta(hours = 1)
+        self.searches[1].save()
+
+        daemon = PollDaemon(self.pb, print_pushes = False)
+        daemon.run(max_cycles = 1)
+
+        polled = RedditWatchedSearch.get(RedditWatchedSearch.uuid == self.searches[0].uuid)
+        not_due = RedditWatchedSearch.get(RedditWatchedSearch.uuid == self.searches[1].uuid)
+        self.assertEqual(polled.last_seen_fullname, 't3_shared')
+        self.assertIsNone(not_due.last_seen_fullname)
+        self.assertEqual(list(RedditWatchedSearch.due(datetime.utcnow())), [])
+        self.assertTrue(0 < daemon.seconds_until_due() <= PollDaemon.max_sleep)
+
+    def test_daemon_stop(self):
+        daemon = PollDaemon(self.pb)
+        daemon.stop()
+        daemon.run()
+        self.assertTrue(daemon.stopped)
+
+class MetricsTestCase(InMemoryDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.transport = LocalTransport()
+        self.pool = HTTPPool()
+        self.pool.mount(self.transport)
+        self.previous_pool = set_default_http_pool(self.pool)
+        self.previous_cache = set_default_response_cache(ResponseCache())
+        self.previous_limiter = set_default_rate_limiter(RateLimiter(per_minute = 6000, burst = 100))
+        self.metrics = Metrics()
+        self.previous_metrics = set_default_metrics(self.metrics)
+
+        self.searches = [make_watched_search('GPU'), make_watched_search('Monitor')]
+        for s in self.searches:
+            s.urgent = True
+            s.save(force_insert = True)
+        self.transport.add(RedditSearch._reddit_json_search, listing_json([
+                ('Shared Deal', 'www.shared.com', 2000, 'shared')
+            ]))
+        self.pb = PushbulletAccount('token')
+
+    def tearDown(self):
+        set_default_http_pool(self.previous_pool)
+        set_default_response_cache(self.previous_cache)
+        set_default_metrics(self.previous_metrics)
+        set_default_rate_limiter(self.previous_limiter)
+        super().tearDown()
+
+    def test_cycle_records_stages_and_searches(self):
+        self.transport.add(PushbulletAccount.pb_create_push_url, {'active': True})
+        poll_cycle(self.searches, self.pb, print_pushes = False)
+
+        for stage in ('cycle', 'http', 'parse', 'decode', 'dedup', 'db_write', 'push'):
+            histogram = self.metrics.histogram('reddit_watcher_stage_seconds', stage = stage)
+            self.assertIsNotNone(histogram, stage)
+            self.assertTrue(histogram.count >= 1)
+        for s in self.searches:
+            self.assertEqual(self.metrics.histogram('reddit_watcher_search_seconds', search = s.title).count, 1)
+            self.assertEqual(self.metrics.counter('reddit_watcher_search_hits_total', search = s.title), 1)
+        self.assertEqual(self.metrics.counter('reddit_watcher_pushes_total', result = 'delivered', sink = 'pushbullet'), 1)
+
+    def test_failed_search_is_counted(self):
+        self.transport.add(RedditSearch._reddit_json_search, {'error': 403}, status = 403)
+        self.searches[0].rate_limiter = RateLimiter(max_retries = 0)
+        self.searches[1].rate_limiter = self.searches[0].rate_limiter
+        poll_cycle(self.searches, self.pb, print_pushes = False)
+        for s in self.searches:
+            self.assertEqual(self.metrics.counter('reddit_watcher_search_errors_total', search = s.title), 1)
+
+    def test_prometheus_text(self):
+        self.metrics.observe('latency_seconds', 0.02, search = 'a "b"')
+        self.metrics.count('hits_total', 3, search = 'a')
+        text = self.metrics.prometheus_text()
+        self.assertIn('# TYPE latency_seconds histogram', text)
+        self.assertIn('latency_seconds_bucket{search="a \\"b\\"",le="0.01"} 0', text)
+        self.assertIn('latency_seconds_bucket{search="a \\"b\\"",le="0.025"} 1', text)
+        self.assertIn('latency_seconds_bucket{search="a \\"b\\"",le="+Inf"} 1', text)
+        self.assertIn('latency_seconds_count{search="a \\"b\\""} 1', text)
+        self.assertIn('hits_total{search="a"} 3', text)
+
+        server = self.metrics.serve(0)
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+            self.assertEqual(requests.get(url).text, text)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_dump_json(self):
+        self.metrics.observe('latency_seconds', 0.02)
+        path = 'test_metrics_{}.json'.format(uuid.uuid4())
+        try:
+            self.metrics.dump_json(path)
+            with open(path) as f:
+                dumped = json.load(f)
+        finally:
+            os.remove(path)
+        self.assertEqual(dumped['histograms'][0]['count'], 1)
+        self.assertEqual(dumped['histograms'][0]['buckets']['+Inf'], 1)
+
+    def test_disabled_by_default(self):
+        set_default_metrics(self.previous_metrics)
+        self.assertFalse(default_metrics().enabled)
+        self.transport.add(PushbulletAccount.pb_create_push_url, {'active': True})
+        poll_cycle(self.searches, self.pb, print_pushes = False)
+        self.assertIsNone(self.metrics.histogram('reddit_watcher_stage_seconds', stage = 'cycle'))
+
+class PushSinkTestCase(InMemoryDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.posts = [RedditPost('Deal {}'.format(i), 'www.deal{}.com'.format(i), \
+                datetime.utcfromtimestamp(1000)) for i in range(3)]
+
+    def test_fans_out_to_every_sink(self):
+        first, second = MemorySink('first'), MemorySink('second')
+        delivery = PushDelivery([first, second], print_pushes = False)
+        delivery.enqueue(self.posts)
+        self.assertEqual(len(delivery.flush()), 6)
+        for sink in (first, second):
+            self.assertEqual(sorted(p['url'] for p in sink.pushes), ['www.deal0.com', 'www.deal1.com', 'www.deal2.com'])
+        self.assertEqual(OutboxPush.select().count(), 0)
+
+    def test_failing_sink_is_isolated(self):
+        class BrokenSink(PushSink):
+            name = 'broken'
+            def push_status(self, p):
+                raise RuntimeError('broken')
+
+        good, down = MemorySink('good'), MemorySink('down', status = 503)
+        delivery = PushDelivery([good, down, BrokenSink()], print_pushes = False)
+        delivery.enqueue(self.posts)
+        delivered = delivery.flush()
+
+        self.assertEqual({row.sink for row in delivered}, {'good'})
+        self.assertEqual(len(good.pushes), 3)
+        left = OutboxPush.select()
+        self.assertEqual(sorted(row.sink for row in left), ['broken'] * 3 + ['down'] * 3)
+        for row in left:
+            self.assertEqual(row.attempts, 1)
+        self.assertTrue(delivery.next_attempt() > datetime.utcnow())
+
+        # once the sink is back only its own pushes are sent again
+        down.status = 200
+        later = datetime.utcnow() + timedelta(seconds = 2 * PUSH_BACKOFF)
+        PushDelivery([good, down], print_pushes = False).flush(later)
+        self.assertEqual(len(good.pushes), 3)
+        self.assertEqual(len(down.pushes), 3)
+
+    def test_slow_sinks_run_at_the_same_time(self):
+        sinks = [MemorySink('slow{}'.format(i), delay = 0.2, concurrency = 1) for i in range(3)]
+        delivery = PushDelivery(sinks, print_pushes = False)
+        delivery.enqueue(self.posts[:1])
+        start = time.monotonic()
+        delivery.flush()
+        self.assertTrue(time.monotonic() - start < 0.5)
+        for sink in sinks:
+            self.assertEqual(len(sink.pushes), 1)
+
+    def test_fast_sink_is_not_held_back_by_a_slow_one(self):
+        release = threading.Event()
+        class BlockedSink(MemorySink):
+            def push_status(self, p):
+                release.wait(5)
+                return super().push_status(p)
+        fast, slow = MemorySink('fast'), BlockedSink('slow')
+        delivery = PushDelivery([fast, slow], print_pushes = False)
+        delivery.enqueue(self.posts[:1])
+        try:
+            delivered = delivery.flush(wait = False)
+            deadline = time.monotonic() + 2
+            while len(delivered) == 0 and time.monotonic() < deadline:
+                time.sleep(0.01)
+                delivered += delivery.flush(wait = False)
+            # the fast sink's push is recorded while the slow one still sends
+            self.assertEqual([row.sink for row in delivered], ['fast'])
+            self.assertEqual([row.sink for row in OutboxPush.select()], ['slow'])
+            self.assertEqual(len(slow.pushes), 0)
+
+            release.set()
+            self.assertEqual([row.sink for row in delivery.flush()], ['slow'])
+            self.assertEqual(OutboxPush.select().count(), 0)
+        finally:
+            release.set()
+            delivery.close()
+
+    def test_jsonl_and_webhook_sinks(self):
+        path = 'test_pushes_{}.jsonl'.format(uuid.uuid4())
+        transport = LocalTransport()
+        transport.add('https://hooks.example.com/deals', {'ok': True})
+        webhook = WebhookSink('https://hooks.example.com/deals')
+        webhook.http_pool = HTTPPool()
+        webhook.http_pool.mount(transport)
+        try:
+            delivery = PushDelivery([JSONLinesSink(path), webhook], print_pushes = False)
+            delivery.enqueue(self.posts[:2])
+            self.assertEqual(len(delivery.flush()), 4)
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+        finally:
+            os.remove(path)
+        self.assertEqual([line['title'] for line in lines], ['Deal 0', 'Deal 1'])
+        self.assertEqual(len(transport.requests), 2)
+        self.assertEqual(json.loads(transport.requests[0].body)['url'], 'www.deal0.com')
+
+    def test_make_sink(self):
+        self.assertIsInstance(make_sink('pushbullet', 'token'), PushbulletAccount)
+        self.assertIsInstance(make_sink('stdout'), StdoutSink)
+        self.assertEqual(make_sink('jsonl:pushes.jsonl').path, 'pushes.jsonl')
+        self.assertEqual(make_sink('webhook:https://example.com/hook').url, 'https://example.com/hook')
+        for spec in ('jsonl', 'email:me', 'stdout:x'):
+            with self.assertRaises(ValueError):
+                make_sink(spec)
+        with self.assertRaises(ValueError):
+            PushDelivery([MemorySink(), MemorySink()])
+
+class ResponseCacheTestCase(unittest.TestCase):
+    url = 'https://www.reddit.com/r/homelab/new'
+
+    def setUp(self):
+        self.transport = LocalTransport()
+        self.req = RedditGetRequest(self.url)
+        self.req.http_pool = HTTPPool()
+        self.req.http_pool.mount(self.transport)
+        self.req.response_cache = ResponseCache(ttl = 0)
+        self.req.rate_limiter = RateLimiter(per_minute = 6000, burst = 100)
+        self.parses = 0
+
+        parse = self.req._parse
+        def counting_parse(r):
+            self.parses += 1
+            return parse(r)
+        self.req._parse = counting_parse
+
+    def test_revalidates_with_etag(self):
+        self.transport.add(self.url, listing_json([('A', 'www.a.com', 1000)]), headers = {'ETag': '"v1"'})
+        self.transport.add(self.url, b'', status = 304, queue = True)
+
+        first = self.req.items
+        second = self.req.items
+        self.assertEqual([p.title for p in first], [p.title for p in second])
+        self.assertEqual(self.parses, 1)
+        self.assertEqual(self.transport.requests[-1].headers['If-None-Match'], '"v1"')
+        self.assertEqual(self.req.response_cache.revalidated, 1)
+
+    def test_fresh_entry_skips_request(self):
+        self.req.response_cache.ttl = 60
+        self.transport.add(self.url, listing_json([('A', 'www.a.com', 1000)]))
+        self.req.items
+        self.req.items.clear()
+        self.assertEqual(len(self.req.items), 1)
+        self.assertEqual(len(self.transport.requests), 1)
+        self.assertEqual(self.req.response_cache.hits, 2)
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(ttl = 60, max_entries = 2)
+        response = requests.Response()
+        response.status_code = 200
+        for key in ('a', 'b', 'a', 'c'):
+            cache.fetch(key, lambda headers: response, lambda r: key)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.fetch('b', lambda headers: response, lambda r: 'new b'), 'new b')
+        self.assertEqual(cache.misses, 4)
+
+class RateLimiterTestCase(unittest.TestCase):
+    url = 'https://reddit.com/search.json'
+
+    def setUp(self):
+        self.transport = LocalTransport()
+        self.pool = HTTPPool()
+        self.pool.mount(self.transport)
+        self.limiter = RateLimiter(per_minute = 6000, burst = 10, max_retries = 2, backoff = 0.001)
+
+    def test_retries_after_429(self):
+        self.transport.add(self.url, {}, status = 429, headers = {'Retry-After': '0.01'})
+        self.transport.add(self.url, listing_json([]), queue = True)
+        r = self.limiter.get(self.pool, self.url)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.limiter.counters, {'throttled': 1, 'retried': 1, 'dropped': 0})
+
+    def test_drops_after_max_retries(self):
+        self.transport.add(self.url, {}, status = 503)
+        with self.assertRaises(RedditRequestError):
+            self.limiter.get(self.pool, self.url)
+        self.assertEqual(len(self.transport.requests), 3)
+        self.assertEqual(self.limiter.counters, {'throttled': 0, 'retried': 2, 'dropped': 1})
+
+    def test_client_error_is_not_retried(self):
+        self.transport.add(self.url, {}, status = 404)
+        with self.assertRaises(RedditRequestError):
+            self.limiter.get(self.pool, self.url)
+        self.assertEqual(len(self.transport.requests), 1)
+
+    def test_honors_ratelimit_headers(self):
+        self.transport.add(self.url, listing_json([]), headers = {
+                'X-Ratelimit-Remaining': '0',
+                'X-Ratelimit-Reset': '0.1'
+            })
+        self.limiter.get(self.pool, self.url)
+        start = time.monotonic()
+        self.limiter.get(self.pool, self.url)
+        self.assertTrue(time.monotonic() - start >= 0.09)
+
+    def test_priority_order(self):
+        limiter = RateLimiter(per_minute = 300, burst = 1)
+        limiter.acquire()
+        order = []
+        threads = [threading.Thread(target = lambda p=p: order.append(limiter.acquire(p) or p)) \
+                for p in (3, 1, 2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(order, [1, 2, 3])
+
+class DigestTestCase(InMemoryDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.transport = LocalTransport()
+        self.transport.add(PushbulletAccount.pb_create_push_url, {'active': True})
+        self.pb = PushbulletAccount('token')
+        self.pb.http_pool = HTTPPool()
+        self.pb.http_pool.mount(self.transport)
+        self.delivery = PushDelivery(self.pb, digest_window = 60, digest_max_deals = 3, print_pushes = False)
+
+        self.gpu = make_watched_search('GPU')
+        self.ssd = make_watched_search('SSD')
+        self.urgent = make_watched_search('Monitor')
+        self.urgent.urgent = True
+        self.now = datetime.utcnow()
+
+    def deal(self, search, i):
+        post = RedditPost('Deal {}'.format(i), 'www.deal{}.com'.format(i), self.now, 't3_{}'.format(i))
+        return RedditDeal(search, post)
+
+    def sent_payloads(self):
+        return [json.loads(r.body.decode('utf-8')) for r in self.transport.requests]
+
+    def test_window_coalesces_into_one_note(self):
+        self.delivery.enqueue([self.deal(self.gpu, 0), self.deal(self.ssd, 1)], self.now)
+        self.assertEqual(self.delivery.flush(self.now), [])
+
+        delivered = self.delivery.flush(self.now + timedelta(seconds = 61))
+        self.assertEqual(len(delivered), 1)
+        payload = self.sent_payloads()[0]
+        self.assertEqual(payload['type'], 'note')
+        self.assertEqual(payload['title'], 'Gpu, and ssd deals: 2 new')
+        self.assertIn('www.deal1.com', payload['body'])
+        self.assertEqual(OutboxPush.select().count(), 0)
+
+    def test_count_threshold_closes_window(self):
+        self.delivery.enqueue([self.deal(self.gpu, i) for i in range(3)], self.now)
+        self.assertEqual(len(self.delivery.flush(self.now)), 1)
+        self.assertEqual(self.sent_payloads()[0]['title'], 'Gpu deals: 3 new')
+
+    def test_urgent_skips_digest(self):
+        self.delivery.enqueue([self.deal(self.urgent, 0), self.deal(self.gpu, 1)], self.now)
+        delivered = self.delivery.flush(self.now)
+        self.assertEqual([d.url for d in delivered], ['www.deal0.com'])
+        self.assertEqual(self.sent_payloads()[0]['type'], 'link')
+
+    def test_single_held_deal_sent_as_link(self):
+        self.delivery.enqueue([self.deal(self.gpu, 0)], self.now)
+        delivered = self.delivery.flush(self.now + timedelta(seconds = 61))
+        self.assertEqual([d.url for d in delivered], ['www.deal0.com'])
+
+    def test_later_deals_join_open_window(self):
+        self.delivery.enqueue([self.deal(self.gpu, 0)], self.now)
+        self.delivery.enqueue([self.deal(self.ssd, 1)], self.now + timedelta(seconds = 30))
+        self.assertEqual(len(self.delivery.flush(self.now + timedelta(seconds = 61))), 1)
+        self.assertEqual(self.sent_payloads()[0]['title'], 'Gpu, and ssd deals: 2 new')
+
+class RescheduleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.search = make_watched_search('GPU')
+        self.now = datetime.utcfromtimestamp(100000)
+
+    def test_hits_speed_up(self):
+        self.search.reschedule(3, self.now)
+        self.assertEqual(self.search.poll_interval, int(DEFAULT_POLL_INTERVAL * POLL_SPEEDUP))
+        self.assertEqual(self.search.next_poll_utc, self.now + timedelta(seconds = self.search.poll_interval))
+
+    def test_quiet_backs_off_to_max(self):
+        for _ in range(50):
+            self.search.reschedule(0, self.now)
+        self.assertEqual(self.search.poll_interval, MAX_POLL_INTERVAL)
+
+    def test_hot_never_below_min(self):
+        for _ in range(50):
+            self.search.reschedule(1, self.now)
+        self.assertEqual(self.search.poll_interval, MIN_POLL_INTERVAL)
+
+# the HTTPPool of the ShardedPoller workers, it is pickled by name
+def shard_worker_pool():
+    transport = LocalTransport()
+    transport.add(RedditSearch._reddit_json_search, listing_json([
+            ('Shared Deal', 'www.shared.com', 2000, 'shared')
+        ]))
+    pool = HTTPPool()
+    pool.mount(transport)
+    return pool
+
+class HashRingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.keys = [uuid.uuid4() for _ in range(2000)]
+
+    def test_stable_and_balanced(self):
+        ring = HashRing(4)
+        counts = [0] * 4
+        for key in self.keys:
+            self.assertEqual(ring.shard_of(key), HashRing(4).shard_of(key))
+            counts[ring.shard_of(key)] += 1
+        for count in counts:
+            self.assertTrue(250 < count < 750, counts)
+
+    def test_adding_a_shard_moves_few_keys(self):
+        before, after = HashRing(4), HashRing(5)
+        moved = sum(before.shard_of(k) != after.shard_of(k) for k in self.keys)
+        self.assertTrue(moved < len(self.keys) * 0.35, moved)
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard('1/3'), (1, 3))
+        for value in ('3/3', '-1/2', 'x', '1/0'):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                parse_shard(value)
+
+class ShardingTestCase(InMemoryDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.transport = LocalTransport()
+        self.transport.add(PushbulletAccount.pb_create_push_url, {'active': True})
+        self.pool = HTTPPool()
+        self.pool.mount(self.transport)
+        self.previous_pool = set_default_http_pool(self.pool)
+        self.pb = PushbulletAccount('token')
+
+        # one urgent search on each of two shards, both hit by the same post
+        ring = HashRing(2)
+        self.searches = [None, None]
+        while None in self.searches:
+            search = make_watched_search('GPU')
+            shard = ring.shard_of(search.uuid)
+            if self.searches[shard] is None:
+                self.searches[shard] = make_watched_search(('GPU', 'Monitor')[shard])
+                self.searches[shard].uuid = search.uuid
+                self.searches[shard].urgent = True
+        for s in self.searches:
+            s.save(force_insert = True)
+
+    def tearDown(self):
+        set_default_http_pool(self.previous_pool)
+        super().tearDown()
+
+    def test_shards_merge_deals_before_delivery(self):
+        poller = ShardedPoller(2, http_pool_factory = shard_worker_pool)
+        try:
+            delivered = poll_cycle(self.searches, self.pb, poller = poller, print_pushes = False)
+        finally:
+            poller.close()
+
+        self.assertEqual(poller.errors, {})
+        self.assertEqual([d.url for d in delivered], ['www.shared.com'])
+        self.assertIn('Gpu, and monitor', delivered[0].title)
+        for s in RedditWatchedSearch.select():
+            self.assertEqual(s.last_seen_fullname, 't3_shared')
+
+    def test_daemon_polls_only_its_shard(self):
+        poller = ShardedPoller(1, http_pool_factory = shard_worker_pool)
+        daemon = PollDaemon(self.pb, poller = poller, print_pushes = False, shard = (1, 2))
+        try:
+            daemon.run(max_cycles = 1)
+        finally:
+            poller.close()
+
+        other, mine = [RedditWatchedSearch.get(RedditWatchedSearch.uuid == s.uuid) for s in self.searches]
+        self.assertIsNone(other.last_seen_fullname)
+        self.assertEqual(mine.last_seen_fullname, 't3_shared')
+        self.assertEqual(daemon.next_due_utc(), mine.next_poll_utc)
+
+    def test_post_seen_by_another_shard_is_not_pushed(self):
+        SeenPost.mark_seen(['t3_shared'])
+        poller = ShardedPoller(2, http_pool_factory = shard_worker_pool)
+        try:
+            self.assertEqual(poll_cycle(self.searches, self.pb, poller = poller, print_pushes = False), [])
+        finally:
+            poller.close()
+        self.assertEqual(OutboxPush.select().count(), 0)
+
+class StartupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.database = 'test_startup_{}.db'.format(uuid.uuid4())
+        with open(self.database, 'wb') as f:
+            f.write(b'db')
+        self.now = datetime.utcnow()
+
+    def tearDown(self):
+        for path in (self.database, next_due_path(None, self.database), next_due_path((0, 2), self.database)):
+            if os.path.exists(path): os.remove(path)
+
+    def test_nothing_due_until_the_saved_time(self):
+        self.assertFalse(nothing_due(self.now, database = self.database))
+        save_next_due(self.now + timedelta(hours = 1), database = self.database)
+        self.assertTrue(nothing_due(self.now, database = self.database))
+        self.assertFalse(nothing_due(self.now + timedelta(hours = 2), database = self.database))
+        # each shard saves its own time
+        self.assertFalse(nothing_due(self.now, (0, 2), self.database))
+
+    def test_database_change_voids_the_saved_time(self):
+        save_next_due(None, database = self.database)
+        self.assertTrue(nothing_due(self.now + timedelta(days = 365), database = self.database))
+        with open(self.database, 'ab') as f:
+            f.write(b'changed')
+        self.assertFalse(nothing_due(self.now, database = self.database))
+
+    def test_import_is_lazy(self):
+        lazy = ('requests', 'asyncio', 'concurrent.futures', 'http.server', 'playhouse.sqlite_ext')
+        code = 'import sys, reddit_watcher; print(sorted(m for m in {!r} if m in sys.modules))'.format(lazy)
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(output.strip(), b'[]')
+
+    def test_profile_report(self):
+        profile = StartupProfile()
+        profile.mark('parse args')
+        out = io.StringIO()
+        profile.report(out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual([line.split()[0] for line in lines], ['import', 'parse', 'total'])
+        self.assertTrue(lines[-1].endswith(' ms'))
+
+class DedupWindowTestCase(unittest.TestCase):
+    def setUp(self):
+        self.gpu = make_watched_search('GPU')
+        self.monitor = make_watched_search('Monitor')
+        self.posted = datetime.utcfromtimestamp(1000)
+
+    def deal(self, search, i):
+        return RedditDeal(search, RedditPost('Deal {}'.format(i), 'www.deal{}.com'.format(i), self.posted, 't3_{}'.format(i)))
+
+    def test_searches_join_an_open_deal(self):
+        window = DedupWindow(window = 10)
+        self.assertTrue(window.add(self.deal(self.gpu, 1), 0))
+        self.assertFalse(window.add(self.deal(self.gpu, 1), 1))
+        self.assertTrue(window.add(self.deal(self.monitor, 1), 2))
+        self.assertEqual(window.release(5), [])
+        released = window.release(10)
+        self.assertEqual(len(released), 1)
+        self.assertEqual(released[0].searches, {self.gpu, self.monitor})
+        self.assertEqual(len(window), 0)
+
+    def test_oldest_released_past_max_open(self):
+        window = DedupWindow(window = 10, max_open = 2)
+        for i in range(3):
+            window.add(self.deal(self.gpu, i), i)
+        self.assertEqual([d.post_id for d in window.release(3)], ['t3_0'])
+        self.assertEqual([d.post_id for d in window.release()], ['t3_1', 't3_2'])
+
+class StreamingCycleTestCase(InMemoryDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.transport = LocalTransport()
+        self.pool = HTTPPool()
+        self.pool.mount(self.transport)
+        self.previous_pool = set_default_http_pool(self.pool)
+        self.previous_cache = set_default_response_cache(ResponseCache())
+        self.previous_limiter = set_default_rate_limiter(RateLimiter(per_minute = 6000, burst = 100))
+        self.transport.add(RedditSearch._reddit_json_search, listing_json([
+                ('Fast Deal', 'www.fast.com', 2000, 'fast')
+            ]))
+        self.sink = MemorySink()
+        self.pushed_at = []
+        push_status = self.sink.push_status
+        def timed_push_status(p):
+            self.pushed_at.append(time.monotonic())
+            return push_status(p)
+        self.sink.push_status = timed_push_status
+
+    def tearDown(self):
+        set_default_http_pool(self.previous_pool)
+        set_default_response_cache(self.previous_cache)
+        set_default_rate_limiter(self.previous_limiter)
+        super().tearDown()
+
+    def test_first_push_does_not_wait_for_the_slowest_search(self):
+        fast, slow = make_watched_search('Fast'), make_watched_search('Slow')
+        for s in (fast, slow):
+            s.urgent = True
+            s.save(force_insert = True)
+        slow_done = []
+        def slow_poll():
+            time.sleep(0.5)
+            slow_done.append(time.monotonic())
+            return []
+        slow.poll = slow_poll
+
+        delivered = poll_cycle([slow, fast], self.sink, window = 0.05, print_pushes = False)
+        self.assertEqual([d.url for d in delivered], ['www.fast.com'])
+        self.assertTrue(self.pushed_at[0] < slow_done[0])
+        for s in RedditWatchedSearch.select():
+            self.assertIsNotNone(s.next_poll_utc)
+        self.assertEqual(RedditWatchedSearch.get(RedditWatchedSearch.uuid == fast.uuid).last_seen_fullname, 't3_fast')
+
+    def test_searches_are_pulled_as_needed(self):
+        pulled = []
+        def searches():
+            for i in range(20):
+                search = make_watched_search('Search {}'.format(i))
+                pulled.append(search)
+                yield search
+        results = RedditPoller(concurrency = 2).iter_results(searches())
+        next(results)
+        self.assertTrue(len(pulled) <= 3, len(pulled))
+        self.assertEqual(len(list(results)), 19)
+        self.assertEqual(len(pulled), 20)
+
+    def test_iter_due_reads_in_batches(self):
+        for i in range(7):
+            make_watched_search('Search {}'.format(i)).save(force_insert = True)
+        later = make_watched_search('Later')
+        later.next_poll_utc = datetime.utcnow() + timedelta(hours = 1)
+        later.save(force_insert = True)
+
+        batch_size = reddit_watcher.SQLITE_BATCH_SIZE
+        reddit_watcher.SQLITE_BATCH_SIZE = 3
+        try:
+            due = list(RedditWatchedSearch.iter_due(datetime.utcnow()))
+            every = list(RedditWatchedSearch.iter_due(datetime.utcnow(), due_only = False))
+        finally:
+            reddit_watcher.SQLITE_BATCH_SIZE = batch_size
+        self.assertEqual(len(due), 7)
+        self.assertEqual(len(every), 8)
+
+class ArchiveTestCase(InMemoryDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.gpu = make_watched_search('GPU')
+        self.monitor = make_watched_search('Monitor')
+        self.now = datetime.utcfromtimestamp(100000)
+
+    def archive(self, *deals):
+        archive = DealArchive()
+        archive.add(deals, self.now)
+        return archive.write()
+
+    def deal(self, search, title, url, posted, post_id):
+        return RedditDeal(search, RedditPost(title, url, datetime.utcfromtimestamp(posted), post_id))
+
+    def test_write_once_per_post(self):
+        shared = self.deal(self.gpu, 'Cheap GPU and monitor', 'https://www.newegg.com/a', 1000, 't3_a')
+        shared.combine_searches(self.deal(self.monitor, 'Cheap GPU and monitor', 'https://www.newegg.com/a', 1000, 't3_a'))
+        self.assertEqual(self.archive(shared), 1)
+        self.assertEqual(self.archive(self.deal(self.gpu, 'Cheap GPU and monitor', 'https://www.newegg.com/a', 1000, 't3_a')), 0)
+
+        deal = ArchivedDeal.get()
+        self.assertEqual(deal.domain, 'newegg.com')
+        self.assertEqual(deal.search_titles, ['GPU', 'Monitor'])
+        self.assertEqual(archived_deal_title().select().count(), 1)
+
+    def test_filters(self):
+        self.archive(
+                self.deal(self.gpu, 'RTX 4070 graphics card', 'https://www.newegg.com/a', 1000, 't3_a'),
+                self.deal(self.gpu, 'Radeon graphics cards sale', 'https://amazon.com/b', 2000, 't3_b'),
+                self.deal(self.monitor, '27 inch monitor', 'https://newegg.com/c', 3000, 't3_c')
+            )
+        def titles(**filters):
+            return [d.title for d in ArchivedDeal.query(**filters)]
+
+        self.assertEqual(titles(), ['27 inch monitor', 'Radeon graphics cards sale', 'RTX 4070 graphics card'])
+        self.assertEqual(titles(search = 'GPU'), ['Radeon graphics cards sale', 'RTX 4070 graphics card'])
+        self.assertEqual(titles(text = 'card'), ['Radeon graphics cards sale', 'RTX 4070 graphics card'])
+        self.assertEqual(titles(domain = 'NewEgg.com'), ['27 inch monitor', 'RTX 4070 graphics card'])
+        self.assertEqual(titles(search = 'GPU', domain = 'newegg.com'), ['RTX 4070 graphics card'])
+        self.assertEqual(titles(since = datetime.utcfromtimestamp(2000), until = datetime.utcfromtimestamp(3000)), \
+                ['Radeon graphics cards sale'])
+        self.assertEqual(ArchivedDeal.count_matching(text = 'graphics'), 2)
+
+    def test_pages(self):
+        # pairs of posts with the same time, so that the cursor needs the id
+        deals = [self.deal(self.gpu, 'Deal {}'.format(i), 'www.deal{}.com'.format(i), 1000 + i // 2, 't3_{}'.format(i)) \
+                for i in range(7)]
+        self.archive(*deals)
+        for search in (None, 'GPU'):
+            pages, before = [], None
+            while True:
+                page = ArchivedDeal.query(search = search, before = before, limit = 3)
+                pages.append([d.title for d in page])
+                if len(page) < 3: break
+                before = page[-1].cursor
+            self.assertEqual(pages, [['Deal 6', 'Deal 5', 'Deal 4'], ['Deal 3', 'Deal 2', 'Deal 1'], ['Deal 0']])
+        with self.assertRaises(ValueError):
+            ArchivedDeal.query(before = 'yesterday')
+
+    def test_history_rejects_bad_text(self):
+        self.archive(self.deal(self.gpu, 'RTX 4070 graphics card', 'https://www.newegg.com/a', 1000, 't3_a'))
+        for argv in (['--history', '"rtx 4070'], ['--history', 'rtx AND', '--history-count']):
+            with self.subTest(argv = argv):
+                with self.assertRaises(SystemExit) as raised:
+                    print_history(parse_args(argv))
+                self.assertIn('not a valid full text query', str(raised.exception))
+
+    def test_page_reads_search_titles_at_once(self):
+        self.archive(*[self.deal(self.gpu, 'Deal {}'.format(i), 'www.deal{}.com'.format(i), 1000 + i, 't3_{}'.format(i)) \
+                for i in range(5)])
+        self.archive(self.deal(self.monitor, 'Deal 4', 'www.deal4.com', 1004, 't3_4'))
+        statements = []
+        execute_sql = self.db.execute_sql
+        def counting_execute_sql(sql, params = None, *args, **kwargs):
+            statements.append(sql)
+            return execute_sql(sql, params, *args, **kwargs)
+        self.db.execute_sql = counting_execute_sql
+
+        lines = [str(deal) for deal in ArchivedDeal.query()]
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(lines[0], '1970-01-01 00:16 Deal 4 [GPU, Monitor] www.deal4.com')
+        self.assertEqual(len(lines), 5)
+
+    def test_poll_cycle_archives(self):
+        transport = LocalTransport()
+        pool = HTTPPool()
+        pool.mount(transport)
+        previous_pool = set_default_http_pool(pool)
+        previous_cache = set_default_response_cache(ResponseCache())
+        try:
+            transport.add(RedditSearch._reddit_json_search, listing_json([
+                    ('Shared Deal', 'https://www.shared.com/deal', 2000, 'shared')
+                ]))
+            for s in (self.gpu, self.monitor):
+                s.urgent = True
+                s.save(force_insert = True)
+            poll_cycle([self.gpu, self.monitor], MemorySink(), print_pushes = False)
+        finally:
+            set_default_http_pool(previous_pool)
+            set_default_response_cache(previous_cache)
+
+        deals = ArchivedDeal.query(domain = 'shared.com')
+        self.assertEqual([d.title for d in deals], ['Shared Deal'])
+        self.assertEqual(deals[0].search_titles, ['GPU', 'Monitor'])
+
+    def test_url_domain(self):
+        self.assertEqual(url_domain('https://WWW.Amazon.com/dp/1?tag=x'), 'amazon.com')
+        self.assertEqual(url_domain('https://smile.amazon.com'), 'smile.amazon.com')
+        self.assertIsNone(url_domain('www.deal.com'))
+
+class SearchManagementTestCase(InMemoryDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.rows = [
+                {'title': 'GPU', 'query': 'subreddit:buildapcsales (gpu OR "graphics card")', 'urgent': True},
+                {'title': 'Big Monitor', 'query': 'monitor NOT 1080p', 'poll_interval': 600}
+            ]
+
+    def test_params_string_matches_query_string(self):
+        for query in ('gpu', 'subreddit:buildapcsales (gpu OR "graphics card")', 'a&b=c+d/é'):
+            for kwargs in ({}, {'limit': 100, 'before': 't3_abc'}, {'after': 't3_x'}):
+                with self.subTest(query = query, kwargs = kwargs):
+                    s = make_watched_search('Search', query)
+                    self.assertEqual(s.params_string(**kwargs), s.query_string(s.params(**kwargs)))
+                    r = RedditSearch(query)
+                    self.assertEqual(r.params_string(**kwargs), r.query_string(r.params(**kwargs)))
+
+    def test_import_stores_the_encoded_query(self):
+        self.assertEqual(import_searches(self.rows), (2, 0))
+        gpu = RedditWatchedSearch.get(RedditWatchedSearch.title == 'GPU')
+        self.assertTrue(gpu.urgent)
+        self.assertEqual(gpu.user_agent_base, 'gpu')
+        self.assertEqual(gpu.encoded_query, encode_query(gpu.query))
+        monitor = RedditWatchedSearch.get(RedditWatchedSearch.title == 'Big Monitor')
+        self.assertEqual((monitor.poll_interval, monitor.user_agent_base), (600, 'big_monitor'))
+
+        # polling uses the stored string
+        encode = reddit_watcher.encode_query
+        def encode_other(query):
+            self.assertNotEqual(query, gpu.query)
+            return encode(query)
+        reddit_watcher.encode_query = encode_other
+        try:
+            self.assertIn('q=' + gpu.encoded_query + '&', gpu.params_string(limit = 100))
+        finally:
+            reddit_watcher.encode_query = encode
+
+    def test_import_replaces_by_uuid(self):
+        import_searches(self.rows)
+        gpu = RedditWatchedSearch.get(RedditWatchedSearch.title == 'GPU')
+        self.assertEqual(import_searches([{'uuid': str(gpu.uuid), 'title': 'GPU', 'query': 'rtx'}]), (0, 1))
+        gpu = RedditWatchedSearch.get_by_id(gpu.id)
+        self.assertEqual((gpu.query, gpu.encoded_query, gpu.urgent), ('rtx', 'rtx', False))
+        self.assertEqual(RedditWatchedSearch.select().count(), 2)
+
+    def test_invalid_rows_import_nothing(self):
+        rows = self.rows + [{'title': 'Broken', 'query': ' '}, {'query': 'no title'}, \
+                {'title': 'Slow', 'query': 'slow', 'poll_interval': 'never'}, {'title': 'Long', 'query': 'x' * 513}]
+        with self.assertRaises(SearchImportError) as cm:
+            import_searches(rows)
+        message = str(cm.exception)
+        for line in ('search 3:', 'search 4: no', 'search 5:', 'search 6:'):
+            self.assertIn(line, message)
+        self.assertEqual(RedditWatchedSearch.select().count(), 0)
+
+    def test_queries_reddit_takes_import(self):
+        # the local matcher can not match these, reddit searches them instead
+        queries = ['flair:GPU monitor', 'author:foo x', 'self:yes deal', 'nsfw:no thing', \
+                'how about gib%$3@!^)(-_eriSh', 'gpu AND']
+        rows = [{'title': 'Search {}'.format(i), 'query': q} for i, q in enumerate(queries)]
+        self.assertEqual(import_searches(rows), (len(queries), 0))
+        self.assertEqual(sorted(s.query for s in RedditWatchedSearch.select()), sorted(queries))
+
+    def test_many_rows_in_batches(self):
+        rows = [{'title': 'Search {}'.format(i), 'query': 'deal {}'.format(i)} for i in range(1200)]
+        self.assertEqual(import_searches(rows), (1200, 0))
+        self.assertEqual(RedditWatchedSearch.select().count(), 1200)
+
+    def test_export_round_trip(self):
+        import_searches(self.rows)
+        for format in ('json', 'csv'):
+            with self.subTest(format = format):
+                f = io.StringIO()
+                export_searches(f, format)
+                f.seek(0)
+                rows = read_searches(f, format)
+                self.assertEqual([r['title'] for r in rows], ['GPU', 'Big Monitor'])
+                self.assertEqual(import_searches(rows), (0, 2))
+        self.assertEqual(RedditWatchedSearch.get(RedditWatchedSearch.title == 'GPU').urgent, True)
+
+class DealFilterTestCase(InMemoryDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.time = datetime.utcfromtimestamp(123456)
+        self.post_ids = 0
+
+    def post(self, title, url = 'https://www.newegg.com/deal'):
+        self.post_ids += 1
+        return RedditPost(title, url, self.time, 't3_{}'.format(self.post_ids))
+
+    def test_extract(self):
+        cases = [
+                ('[GPU] RTX 4070 - $549.99 ($599.99 - $50)', (549.99, 'USD', None)),
+                ('[CPU] Ryzen 5 5600 $129 CAD (33% off)', (129, 'CAD', 33)),
+                ('[Monitor] 27" 1440p EUR 1,299.00 -20%', (1299, 'EUR', 20)),
+                ('[SSD] 2TB NVMe $299 - $100 coupon = $199', (199, 'USD', 33.4)),
+                ('[Case] 20 GBP, free shipping', (20, 'GBP', None)),
+                ('[GPU] RTX 4070 $599 → $499', (499, 'USD', 16.7)),
+                ('[GPU] RTX 4070 $649 -> $599 -> $549', (549, 'USD', 15.4)),
+                ('[GPU] RTX 4070 ~~$599~~ $499 (10% off)', (499, 'USD', 10)),
+                ('[Laptop] MacBook Pro $1.5k', (1500, 'USD', None)),
+                ('[Prebuilt] RTX 4090 PC $3.2K → $2,899', (2899, 'USD', 9.4)),
+                ('[Meta] No price here', (None, None, None))
+            ]
+        for title, expected in cases:
+            with self.subTest(title = title):
+                info = DealInfo.extract(self.post(title))
+                self.assertEqual((info.price, info.currency, info.percent_off), expected)
+
+    def test_vendor(self):
+        for url, vendor in [('https://www.newegg.com/p/1', 'newegg'), ('https://smile.amazon.co.uk/dp/1', 'amazon'), \
+                ('https://bestbuy.ca/x', 'bestbuy'), ('self.buildapcsales', None)]:
+            self.assertEqual(DealInfo.extract(self.post('Deal', url)).vendor, vendor)
+
+    def test_thresholds(self):
+        search = make_watched_search('GPU')
+        search.max_price = 500
+        search.min_percent_off = 20
+        search.required_keywords = 'rtx, 4070'
+        posts = [
+                self.post('[GPU] RTX 4070 $449 (25% off)'),
+                self.post('[GPU] RTX 4070 $599 → $449 (25% off)'),
+                self.post('[GPU] RTX 4070 $549 (25% off)'), # too expensive
+                self.post('[GPU] RTX 4070 $449 (10% off)'), # not enough off
+                self.post('[GPU] RTX 4080 $449 (25% off)'), # missing a keyword
+                self.post('[GPU] rtx 4070 super, see comments') # no price is kept
+            ]
+        kept = DealFilter().filter(search, posts)
+        self.assertEqual([p.title for p in kept], ['[GPU] RTX 4070 $449 (25% off)', '[GPU] RTX 4070 $599 → $449 (25% off)', \
+                '[GPU] rtx 4070 super, see comments'])
+
+        # without thresholds nothing is extracted
+        deal_filter = DealFilter()
+        self.assertIs(deal_filter.filter(make_watched_search('Any'), posts), posts)
+        self.assertEqual(len(deal_filter._info), 0)
+
+    def test_poll_cycle_drops_filtered_deals(self):
+        transport = LocalTransport()
+        pool = HTTPPool()
+        pool.mount(transport)
+        previous_pool = set_default_http_pool(pool)
+        previous_cache = set_default_response_cache(ResponseCache())
+        try:
+            transport.add(RedditSearch._reddit_json_search, listing_json([
+                    ('[GPU] RTX 4070 $449', 'www.cheap.com', 2000, 'cheap'),
+                    ('[GPU] RTX 4090 $1,599', 'www.dear.com', 1999, 'dear')
+                ]))
+            cheap = make_watched_search('Cheap GPU', 'gpu')
+            cheap.max_price = 500
+            cheap.urgent = True
+            cheap.save(force_insert = True)
+            sink = MemorySink()
+            poll_cycle([cheap], sink, print_pushes = False)
+            self.assertEqual([p['url'] for p in sink.pushes], ['www.cheap.com'])
+        finally:
+            set_default_http_pool(previous_pool)
+            set_default_response_cache(previous_cache)
+
+class NearDuplicateTestCase(InMemoryDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.gpu = make_watched_search('GPU')
+        self.monitor = make_watched_search('Monitor')
+        self.time = datetime.utcfromtimestamp(100000)
+
+    def post(self, title, url, post_id, minutes = 0):
+        return RedditPost(title, url, self.time + timedelta(minutes = minutes), post_id)
+
+    def test_normalize_url_drops_tracking_params(self):
+        self.assertEqual(normalize_url('https://Newegg.com/p/1/?utm_source=reddit&item=N82E&fbclid=x&Tag=aff-20'), \
+                'https://newegg.com/p/1?item=N82E')
+        self.assertEqual(normalize_url('https://newegg.com/p/1?item=N82E&page=2'), 'https://newegg.com/p/1?item=N82E&page=2')
+
+    def test_clusters(self):
+        clusters = DealClusters()
+        first = self.post('[GPU] MSI RTX 4070 Ventus 2X 12GB - $549.99', 'https://www.newegg.com/p/1', 't3_a')
+        cases = [
+                (self.post('[GPU] MSI GeForce RTX 4070 Ventus 2X 12GB - $549.99', 'https://newegg.com/p/1?utm_source=x', 't3_b'), 't3_a'),
+                (self.post('[GPU] MSI RTX 4070 Ventus 2X 12GB $549.99 (Newegg)', 'https://www.reddit.com/r/bapcs/c', 't3_c'), 't3_a'),
+                (self.post('[gpu] msi rtx 4070 ventus 2x 12gb - $499.99', 'https://www.newegg.com/p/2', 't3_d'), 't3_d'),
+                (self.post('[GPU] MSI RTX 4070 Ventus 2X 12GB - $549.99', 'https://www.amazon.com/dp/1', 't3_e'), 't3_e'),
+                (self.post('[SSD] Samsung 990 Pro 2TB - $149.99', 'https://www.newegg.com/p/3', 't3_f'), 't3_f')
+            ]
+        self.assertEqual(clusters.key(first), 't3_a')
+        for post, cluster in cases:
+            with self.subTest(title = post.title, url = post.url):
+                self.assertEqual(clusters.key(post), cluster)
+        # a post keeps its cluster
+        self.assertEqual(clusters.key(cases[0][0]), 't3_a')
+
+    def test_rolling_window(self):
+        clusters = DealClusters(window = 3600, max_size = 3)
+        for i in range(4):
+            clusters.key(self.post('Deal {}'.format(i), 'https://shop.com/{}'.format(i), 't3_{}'.format(i), minutes = i))
+        self.assertEqual(len(clusters), 3)
+        clusters.key(self.post('Much later', 'https://shop.com/late', 't3_late', minutes = 120))
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual(clusters.key(self.post('Deal 3', 'https://shop.com/3', 't3_copy', minutes = 121)), 't3_copy')
+
+    def test_window_merges_copies(self):
+        window = DedupWindow(window = 10, clusters = DealClusters())
+        original = self.post('[GPU] RTX 4070 Ventus 2X - $549', 'https://newegg.com/p/1', 't3_a')
+        repost = self.post('[GPU] RTX 4070 Ventus 2X - $549', 'https://newegg.com/p/1?ref=bapcs', 't3_b')
+        self.assertTrue(window.add(RedditDeal(self.gpu, original), 0))
+        self.assertTrue(window.add(RedditDeal(self.monitor, repost), 1))
+        self.assertFalse(window.add(RedditDeal(self.gpu, repost), 2))
+
+        deal, = window.release()
+        self.assertEqual(deal.post_id, 't3_a')
+        self.assertEqual(deal.searches, {self.gpu, self.monitor})
+        self.assertEqual(deal.source_keys, {'t3_a', 't3_b'})
+        self.assertEqual(deal.push_body, 'Also posted as:\nhttps://newegg.com/p/1?ref=bapcs')
+
+        # a copy of a released deal is dropped
+        crosspost = self.post('[GPU] RTX 4070 Ventus 2X - $549', 'https://newegg.com/p/1', 't3_c')
+        self.assertFalse(window.add(RedditDeal(self.gpu, crosspost), 20))
+        self.assertEqual(len(window), 0)
+
+    def test_variants_are_different_deals(self):
+        clusters = DealClusters()
+        window = DedupWindow(window = 10, clusters = clusters)
+        plain = self.post('[GPU] MSI RTX 4070 Ventus 2X - $549 at Newegg', 'https://newegg.com/p/1', 't3_a')
+        ti = self.post('[GPU] MSI RTX 4070 Ti Ventus 2X - $549 at Newegg', 'https://newegg.com/p/2', 't3_b')
+        self.assertTrue(window.add(RedditDeal(self.gpu, plain), 0))
+        self.assertTrue(window.add(RedditDeal(self.gpu, ti), 1))
+        self.assertEqual(len(window), 2)
+
+        cases = [
+                ('[GPU] MSI RTX 4080 Ventus 2X - $549 at Newegg', 'https://www.reddit.com/r/bapcs/d', 't3_c', 't3_c'),
+                ('[GPU] MSI RTX 4070 Ti Ventus 2X - $549 at Newegg', 'https://www.reddit.com/r/bapcs/e', 't3_e', 't3_b'),
+                ('[GPU] MSI RTX 4070 Ventus 2X 12GB - $549 at Newegg', 'https://www.reddit.com/r/bapcs/f', 't3_f', 't3_a')
+            ]
+        for title, url, post_id, cluster in cases:
+            with self.subTest(title = title):
+                self.assertEqual(clusters.key(self.post(title, url, post_id)), cluster)
+
+    def test_archive_loads_on_first_key(self):
+        title = '[GPU] RTX 4070 Ventus 2X - $549'
+        archive = DealArchive()
+        archive.add([RedditDeal(self.gpu, self.post(title, 'https://newegg.com/p/1?utm_source=x', 't3_a'))], self.time)
+        archive.write()
+        row = ArchivedDeal.get()
+        self.assertEqual((row.match_url, len(row.signature)), ('https://newegg.com/p/1', 64))
+
+        repost = self.post(title, 'https://www.reddit.com/r/bapcs/c', 't3_b', minutes = 5)
+        for signature in (row.signature, None):
+            # rows archived before the signature column are hashed on load
+            ArchivedDeal.update(signature = signature).execute()
+            with self.subTest(stored = signature is not None):
+                clusters = DealClusters()
+                clusters.load_recent(self.time)
+                self.assertEqual(len(clusters), 0)
+                self.assertEqual(clusters.key(repost), 't3_a')
+                self.assertEqual(len(clusters), 2)
+
+    def test_poll_cycle_pushes_one_copy(self):
+        transport = LocalTransport()
+        pool = HTTPPool()
+        pool.mount(transport)
+        previous_pool = set_default_http_pool(pool)
+        previous_cache = set_default_response_cache(ResponseCache())
+        try:
+            now = int(time.time())
+            transport.add(RedditSearch._reddit_json_search, listing_json([
+                    ('[GPU] RTX 4070 Ventus 2X - $549', 'https://newegg.com/p/1?utm_source=reddit', now - 60, 'b'),
+                    ('[GPU] RTX 4070 Ventus 2X - $549', 'https://newegg.com/p/1', now - 120, 'a')
+                ]))
+            transport.add(RedditSearch._reddit_json_search, listing_json([
+                    ('[GPU] RTX 4070 Ventus 2X 12GB - $549', 'https://newegg.com/p/1?fbclid=1', now, 'c')
+                ]), queue = True)
+            self.gpu.urgent = True
+            self.gpu.save(force_insert = True)
+            sink = MemorySink()
+            poll_cycle([self.gpu], sink, print_pushes = False)
+            self.assertEqual(len(sink.pushes), 1)
+            self.assertEqual(SeenPost.seen_keys(['t3_a', 't3_b']), {'t3_a', 't3_b'})
+
+            # the next run finds the pushed deal in the archive
+            self.gpu.next_poll_utc = None
+            poll_cycle([self.gpu], sink, print_pushes = False)
+            self.assertEqual(len(sink.pushes), 1)
+        finally:
+            set_default_http_pool(previous_pool)
+            set_default_response_cache(previous_cache)
+
+class RecordReplayTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmpdir.name, 'capture')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_record_and_replay_transport(self):
+        network = LocalTransport()
+        network.add('https://reddit.com/r/a.json', listing_json([('First', 'www.a.com', 1000)]))
+        network.add('https://reddit.com/r/a.json', listing_json([('Second', 'www.b.com', 2000)]), queue = True)
+        network.add(PushbulletAccount.pb_create_push_url, {'active': True}, headers = {'Retry-After': '5', 'X-Other': 'x'})
+        pool = HTTPPool()
+        pool.mount(RecordingTransport(network, Capture(self.directory)))
+        recorded = [pool.get('https://reddit.com/r/a.json').content for _ in range(2)]
+        pool.post(PushbulletAccount.pb_create_push_url, json = {'title': 'deal'})
+        pool.close()
+
+        capture = Capture(self.directory)
+        entries = capture.entries()
+        self.assertEqual([e['method'] for e in entries], ['GET', 'GET', 'POST'])
+        self.assertEqual(json.loads(capture.read(entries[2]['request'])), {'title': 'deal'})
+        self.assertEqual(entries[2]['headers'], {'Retry-After': '5'})
+
+        transport = ReplayTransport(capture)
+        pool = HTTPPool()
+        pool.mount(transport)
+        self.assertEqual(transport.pending, 3)
+        replayed = [pool.get('https://reddit.com/r/a.json').content for _ in range(3)]
+        self.assertEqual(replayed, recorded + recorded[-1:])
+        self.assertEqual(pool.get('https://reddit.com/r/a.json?after=x').content, recorded[-1])
+        self.assertEqual(pool.post(PushbulletAccount.pb_create_push_url).json(), {'active': True})
+        self.assertEqual(pool.get('https://reddit.com/r/b.json').status_code, 404)
+        self.assertEqual(transport.pending, 0)
+        pool.close()
+
+    def test_replay_runs_cycles_on_a_copy_of_the_database(self):
+        os.makedirs(self.directory)
+        capture = Capture(self.directory)
+        search = make_watched_search('GPU')
+        search.urgent = True
+        models = [RedditWatchedSearch, SeenPost, OutboxPush, SubredditCursor, \
+                ArchivedDeal, ArchivedDealSearch, archived_deal_title()]
+        recorded = SqliteDatabase(capture.database_path)
+        with recorded.bind_ctx(models):
+            recorded.create_tables(models)
+            search.save(force_insert = True)
+        recorded.close()
+
+        now = int(time.time())
+        first = search._reddit_json_search + '?' + search.params_string()
+        capture.append('GET', first, None, 200, {}, json.dumps(listing_json([('RTX deal', 'www.a.com', now, 'a')])))
+        search.last_seen_fullname = 't3_a'
+        second = search._reddit_json_search + '?' + search.params_string(limit = search._page_limit)
+        capture.append('GET', second, None, 200, {}, json.dumps(listing_json([('RX deal', 'www.b.com', now, 'b'), \
+                ('RTX deal', 'www.a.com', now, 'a')])))
+        capture.close()
+
+        pushes = os.path.join(self.tmpdir.name, 'pushes.jsonl')
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            main(['--replay', self.directory, '--sink', 'jsonl:' + pushes])
+            main(['--replay', self.directory, '--sink', 'jsonl:' + pushes])
+        finally:
+            sys.stdout = stdout
+        with open(pushes) as f:
+            urls = [json.loads(line)['url'] for line in f]
+        # each replay starts from the recorded database
+        self.assertEqual(urls, ['www.a.com', 'www.b.com', 'www.a.com', 'www.b.com'])
+        self.assertEqual(db.database, DATABASE)
+
+    def test_replay_runs_on_the_recorded_clock(self):
+        os.makedirs(self.directory)
+        capture = Capture(self.directory)
+        # recorded half a day ago, in active hours that exclude the real time
+        recorded = datetime.utcfromtimestamp(int(time.time()) // 60 * 60) - timedelta(hours = 12)
+        search = make_watched_search('GPU')
+        search.active_hours = '{:%H:%M}-{:%H:%M}'.format(recorded - timedelta(minutes = 5), \
+                recorded + timedelta(minutes = 15))
+        models = [RedditWatchedSearch, SeenPost, OutboxPush, SubredditCursor, \
+                ArchivedDeal, ArchivedDealSearch, archived_deal_title()]
+        database = SqliteDatabase(capture.database_path)
+        with database.bind_ctx(models):
+            database.create_tables(models)
+            search.save(force_insert = True)
+        database.close()
+
+        posted = int((recorded - datetime.utcfromtimestamp(0)).total_seconds())
+        first = search._reddit_json_search + '?' + search.params_string()
+        capture.append('GET', first, None, 200, {}, json.dumps(listing_json([('RTX deal', 'www.a.com', posted - 60, 'a')])))
+        search.last_seen_fullname = 't3_a'
+        second = search._reddit_json_search + '?' + search.params_string(limit = search._page_limit)
+        capture.append('GET', second, None, 200, {}, json.dumps(listing_json([('RX deal', 'www.b.com', posted + 540, 'b'), \
+                ('RTX deal', 'www.a.com', posted - 60, 'a')])))
+        capture.close()
+        with open(capture.index_path) as f:
+            entries = [json.loads(line) for line in f]
+        for entry, seconds in zip(entries, (posted, posted + 600)):
+            entry['time'] = seconds
+        with open(capture.index_path, 'w') as f:
+            f.writelines(json.dumps(entry) + '\n' for entry in entries)
+
+        pushes = os.path.join(self.tmpdir.name, 'pushes.jsonl')
+        stderr = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            main(['--replay', self.directory, '--sink', 'jsonl:' + pushes])
+        finally:
+            sys.stderr = stderr
+        with open(pushes) as f:
+            pushed = [json.loads(line) for line in f]
+        # the second cycle, ten minutes later on the recorded clock, closes
+        # the digest of the first
+        self.assertEqual(len(pushed), 1)
+        self.assertIn('www.a.com', pushed[0]['body'])
+        self.assertIn('www.b.com', pushed[0]['body'])
+
+class ScheduleTestCase(InMemoryDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.day = datetime(2026, 1, 5)
+        self.search = make_watched_search('GPU')
+
+    def at(self, hours, minutes = 0, days = 0):
+        return self.day + timedelta(days = days, hours = hours, minutes = minutes)
+
+    def test_windows_wrap_midnight(self):
+        windows = DailyWindows('22:00-06:00, 12:00-13:00')
+        self.assertTrue(windows.contains(self.at(23)))
+        self.assertTrue(windows.contains(self.at(5, 59)))
+        self.assertFalse(windows.contains(self.at(6)))
+        self.assertEqual(windows.end(self.at(23)), self.at(6, days = 1))
+        self.assertEqual(windows.end(self.at(2)), self.at(6))
+        self.assertIsNone(windows.end(self.at(7)))
+        self.assertEqual(windows.next_start(self.at(7)), self.at(12))
+        self.assertEqual(windows.next_start(self.at(12)), self.at(22))
+
+    def test_windows_timezone(self):
+        # 09:00 in New York is 14:00 utc in January
+        windows = DailyWindows('09:00-17:00=120', 'America/New_York')
+        self.assertFalse(windows.contains(self.at(13, 59)))
+        self.assertEqual(windows.value_at(self.at(14)), 120)
+        self.assertEqual(windows.next_start(self.at(23)), self.at(14, days = 1))
+        for spec, tz in [('9-17', None), ('09:00-09:00', None), ('25:00-26:00', None), ('09:00-17:00', 'Mars/Olympus')]:
+            with self.subTest(spec = spec, tz = tz), self.assertRaises(ValueError):
+                DailyWindows(spec, tz)
+
+    def test_reschedule_waits_for_active_hours(self):
+        self.search.active_hours = '08:00-20:00'
+        self.assertFalse(self.search.is_active(self.at(21)))
+        self.search.reschedule(0, self.at(19, 59))
+        self.assertEqual(self.search.next_poll_utc, self.at(8, days = 1))
+        self.search.reschedule(0, self.at(9))
+        self.assertEqual(self.search.next_poll_utc, self.at(9) + timedelta(seconds = self.search.poll_interval))
+
+    def test_reschedule_cadence(self):
+        self.search.cadence = '18:00-23:00=90'
+        self.search.reschedule(0, self.at(19))
+        self.assertEqual(self.search.next_poll_utc, self.at(19) + timedelta(seconds = 90))
+        # a window that opens first brings the next poll forward
+        self.search.reschedule(0, self.at(17, 59))
+        self.assertEqual(self.search.next_poll_utc, self.at(18))
+        # the spare budget never goes below MIN_POLL_INTERVAL
+        self.search.reschedule(0, self.at(19), speedup = 0.1)
+        self.assertEqual(self.search.next_poll_utc, self.at(19) + timedelta(seconds = MIN_POLL_INTERVAL))
+
+    def test_budget_goes_to_cadence_windows(self):
+        self.search.save(force_insert = True)
+        self.assertEqual(RedditWatchedSearch.budget_speedup(self.at(19), per_minute = 10), 1.0)
+
+        peak = make_watched_search('Monitor')
+        peak.cadence = '18:00-23:00=60'
+        peak.save(force_insert = True)
+        night = make_watched_search('SSD')
+        night.active_hours = '00:00-06:00'
+        night.save(force_insert = True)
+        # 8 polls a minute to use, GPU takes 0.2 and Monitor 1
+        speedup = RedditWatchedSearch.budget_speedup(self.at(19), per_minute = 10)
+        self.assertAlmostEqual(speedup, 1 / (1 + 8 - 1.2))
+        # outside the window there is nothing to give
+        self.assertEqual(RedditWatchedSearch.budget_speedup(self.at(12), per_minute = 10), 1.0)
+        self.assertEqual(RedditWatchedSearch.budget_speedup(self.at(19), per_minute = 1), 1.0)
+
+    def test_quiet_hours_release_one_batch(self):
+        sink = MemorySink('memory')
+        delivery = PushDelivery(sink, digest_window = 0, print_pushes = False)
+        self.search.quiet_hours = '22:00-07:00'
+        awake = make_watched_search('SSD')
+        posts = [RedditPost('Deal {}'.format(i), 'www.deal{}.com'.format(i), self.at(23), 't3_{}'.format(i)) \
+                for i in range(3)]
+        shared = RedditDeal(self.search, posts[2])
+        shared.combine_searches(RedditDeal(awake, posts[2]))
+
+        delivery.enqueue([RedditDeal(self.search, posts[0]), RedditDeal(self.search, posts[1])], self.at(23))
+        delivery.enqueue([shared], self.at(23))
+        # a deal that a search outside its quiet hours hit is pushed right away
+        self.assertEqual([d.url for d in delivery.flush(self.at(23))], ['www.deal2.com'])
+        self.assertEqual(delivery.next_attempt(), self.at(7, days = 1))
+        self.assertEqual(delivery.flush(self.at(6, 59, days = 1)), [])
+
+        delivered = delivery.flush(self.at(7, days = 1))
+        self.assertEqual(len(delivered), 1)
+        self.assertEqual(sink.pushes[-1]['title'], 'Gpu deals: 2 new')
+        self.assertEqual(OutboxPush.select().count(), 0)
+
+    def test_cycle_skips_inactive_searches(self):
+        transport = LocalTransport()
+        transport.add(RedditSearch._reddit_json_search, listing_json([('Deal', 'www.deal.com', 2000, 'deal')]))
+        pool = HTTPPool()
+        pool.mount(transport)
+        previous_pool = set_default_http_pool(pool)
+        previous_cache = set_default_response_cache(ResponseCache())
+        try:
+            now = datetime.utcnow().replace(second = 0, microsecond = 0)
+            start = now + timedelta(hours = 2)
+            self.search.active_hours = '{:%H:%M}-{:%H:%M}'.format(start, start + timedelta(hours = 1))
+            self.search.save(force_insert = True)
+            awake = make_watched_search('SSD')
+            awake.urgent = True
+            awake.save(force_insert = True)
+
+            sink = MemorySink('memory')
+            delivered = poll_cycle([self.search, awake], sink, print_pushes = False)
+        finally:
+            set_default_http_pool(previous_pool)
+            set_default_response_cache(previous_cache)
+        self.assertEqual([d.url for d in delivered], ['www.deal.com'])
+        self.assertEqual(len(transport.requests), 1)
+        skipped = RedditWatchedSearch.get(RedditWatchedSearch.uuid == self.search.uuid)
+        self.assertEqual(skipped.next_poll_utc, start)
+        self.assertIsNone(skipped.last_seen_fullname)
+
+    def test_import_validates_schedule(self):
+        row = {'title': 'GPU', 'query': 'gpu', 'timezone': 'Europe/Berlin', 'active_hours': '08:00-23:00', \
+                'quiet_hours': '23:00-07:00', 'cadence': '18:00-22:00=60'}
+        search = import_searches([row], self.day) and RedditWatchedSearch.get()
+        self.assertEqual((search.timezone, search.cadence), ('Europe/Berlin', '18:00-22:00=60'))
+        for bad in [{'cadence': '18:00-22:00'}, {'active_hours': '08:00-23:00=60'}, {'timezone': 'Nowhere'}]:
+            with self.subTest(bad = bad), self.assertRaises(SearchImportError):
+                import_searches([dict(row, title = 'Other', **bad)], self.day)
+
+class BenchmarkRegressionsTestCase(unittest.TestCase):
+    def test_threshold(self):
+        baseline = {'cycle': 1.0, 'decode': 0.2, 'push': 0.5}
+        results = {
+                'cycle': 1.25,  # exactly at the threshold
+                'decode': 0.26, # 30% slower
+                'push': 0.4,    # faster
+                'archive': 9.0  # not in the baseline
+            }
+        self.assertEqual(bench_reddit_watcher.THRESHOLD, 0.25)
+        self.assertEqual(bench_reddit_watcher.regressions(results, baseline), ['decode'])
+        self.assertEqual(bench_reddit_watcher.regressions(results, baseline, threshold = 0.1), ['cycle', 'decode'])
+        self.assertEqual(bench_reddit_watcher.regressions(results, {}), [])
+
 # TODO: Write tests for RedditDeal
 # class RedditDealTestCase(RedditPostTestCase):
 #     @property